@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, re, socket, struct, sys
+import binascii, bisect, os, signal, socket, struct, sys
 
 # This is a pristine copy of the access functions that have made their
 #  way into quite a few of my Python network scripts.
@@ -42,51 +42,112 @@ def enable_colours(force = False):
 enable_colours()
 
 # Network Access Class
-# Required modules: re, socket, struct, sys
+# Required modules: binascii, bisect, os, signal, socket, struct
 ###
 
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
-    REGEX_INET4_CIDR='^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
+    # Rules are compiled into sorted, non-overlapping (start, end) ranges of integers and
+    #  checked with a binary search, so a check costs the same for 10 rules as for 100,000.
+    # Addresses live in IPv6 space, with IPv4 mapped into ::ffff:0:0/96, so that one set
+    #  of ranges covers both families (and IPv4-mapped clients on dual-stack sockets).
+
+    # Decisions are remembered per address string, up to this many addresses.
+    CACHE_SIZE = 65536
+    IPV4_MAPPED = 0xffff << 32
 
     def __init__(self):
         self.errors = []
-        self.allowed_addresses = []
-        self.allowed_networks = []
-        self.denied_addresses = []
-        self.denied_networks = []
-
-    def add_access(self, addr_list, net_list, candidate):
-        candidate = candidate.strip()
-        if re.match(self.REGEX_INET4_CIDR, candidate):
-            good, net, bits = self.ip_validate_cidr(candidate)
-            if good:
-                # No error
-                net_list.append((candidate, net, bits))
+        # Rules are (candidate, resolved address, start, end, source file) tuples.
+        self.allowed = []
+        self.denied = []
+        # Calls that built the rules, replayed by reload()
+        self.sources = []
+        self.compiled = None
+
+    def add_access(self, rules, candidate, path = None):
+        # Comments and blank lines are allowed, mostly for the benefit of access files.
+        candidate = candidate.split('#', 1)[0].strip()
+        if not candidate:
+            return True
+
+        address, slash, bits = candidate.partition('/')
+        try:
+            resolved = address
+            value, width = self.ip_ston(address)
+        except (OSError, ValueError):
+            try:
+                resolved = socket.gethostbyname(address)
+                value, width = self.ip_ston(resolved)
+            except (OSError, ValueError):
+                if slash:
+                    self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
+                else:
+                    self.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
+                return False
+
+        if slash:
+            if not bits.isdigit() or int(bits) > width:
+                self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
+                return False
+            host_bits = width - int(bits)
         else:
-            good, a, astr = self.ip_validate_address(candidate)
-            if good:
-                # No error
-                addr_list.append((a, candidate, astr))
-        return good
+            host_bits = 0
+
+        start = value >> host_bits << host_bits
+        rules.append((candidate, resolved, start, start | ((1 << host_bits) - 1), path))
+        self.compiled = None
+        return True
 
     def add_blacklist(self, candidate):
-        return self.add_access(self.denied_addresses, self.denied_networks, candidate)
+        self.sources.append(('add_blacklist', candidate))
+        return self.add_access(self.denied, candidate)
 
     def add_whitelist(self, candidate):
-        return self.add_access(self.allowed_addresses, self.allowed_networks, candidate)
+        self.sources.append(('add_whitelist', candidate))
+        return self.add_access(self.allowed, candidate)
 
     def announce_filter_actions(self):
-        for action, address_list, network_list in [("Allowing", self.allowed_addresses, self.allowed_networks), ("Denying", self.denied_addresses, self.denied_networks)]:
-            l = []
-            l.extend([("address", s, i) for n, s, i in address_list])
-            l.extend([("network", s, s) for n, s in network_list])
-
-            for title, ip, address in l:
-                if ip == address:
-                    print_notice("%s %s: %s" % (action, title, colour_text(address, COLOUR_GREEN)))
+        for action, rules in [("Allowing", self.allowed), ("Denying", self.denied)]:
+            files = []
+            for candidate, resolved, start, end, path in rules:
+                if path:
+                    # Access files can be very large, so they are summarized instead.
+                    if path not in files:
+                        files.append(path)
+                    continue
+
+                title = "address"
+                if '/' in candidate:
+                    title = "network"
+
+                if candidate.partition('/')[0] == resolved:
+                    print_notice("%s %s: %s" % (action, title, colour_text(candidate, COLOUR_GREEN)))
                 else:
-                    print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
+                    print_notice("%s %s: %s (%s)" % (action, title, colour_text(candidate, COLOUR_GREEN), colour_text(resolved, COLOUR_GREEN)))
+
+            for path in files:
+                count = len([r for r in rules if r[4] == path])
+                print_notice("%s %s addresses/ranges from file: %s" % (action, colour_text(count), colour_text(path, COLOUR_GREEN)))
+
+    def compile(self):
+        self.compiled = (self.compile_ranges(self.allowed), self.compile_ranges(self.denied), {})
+        return self.compiled
+
+    def compile_ranges(self, rules):
+        # Merge overlapping and adjacent ranges into parallel lists of starts and ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(r[2], r[3]) for r in rules]):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return (starts, ends)
+
+    def in_ranges(self, ranges, ip):
+        i = bisect.bisect_right(ranges[0], ip) - 1
+        return i >= 0 and ip <= ranges[1][i]
 
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
@@ -95,74 +156,85 @@ class NetAccess:
         a,b,c,d = struct.unpack('BBBB', socket.inet_aton(ip))
         return (a << 24) + (b << 16) + (c << 8) + d
 
-    def ip_validate_address(self, candidate):
-        try:
-            ip = socket.gethostbyname(candidate)
-            return (True, self.ip_strton(ip), ip)
-        except socket.gaierror:
-            self.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
-            return (False, None, None)
+    def ip_ston(self, address):
+        # Convert an IPv4 or IPv6 address string to an integer in IPv6 space,
+        #  along with the number of bits in the address family.
+        if ':' in address:
+            # Drop any zone index (e.g. fe80::1%eth0)
+            address = address.split('%', 1)[0]
+            return (int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, address)), 16), 128)
+        return (self.IPV4_MAPPED | int(binascii.hexlify(socket.inet_pton(socket.AF_INET, address)), 16), 32)
 
-    def ip_validate_cidr(self, candidate):
-        a = candidate.split("/")[0]
-        m = int(candidate.split("/")[1])
+    def is_allowed(self, address):
+        # Blacklist/Whitelist filtering
+        # A blacklist rule one-ups a whitelist rule in the event of a conflict.
+        allowed, denied, cache = self.compiled or self.compile()
+        if not allowed[0] and not denied[0]:
+            return True
+
+        result = cache.get(address)
+        if result is not None:
+            return result
 
         try:
-            # Will either succeed or throw an exception
-            ip = self.ip_strton(socket.gethostbyname(a))
-            if m <= 32:
-                return (True, ip, 32 - m)
-        except socket.gaierror:
-            pass
-        self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
-        return (False, None, None)
+            ip = self.ip_ston(address)[0]
+        except (OSError, ValueError):
+            # Not an address that any rule could match.
+            ip = -1
 
-    def is_allowed(self, address):
-        # Blacklist/Whitelist filtering
-        allowed = True
-
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
-            # Compare string-form against allowed addresses
-            if address in [a[2] for a in self.allowed_addresses]:
-                allowed = True
-            else:
-                # Try checking allowed networks
-                ip = self.ip_strton(address)
-                for net, bits in [(n[1], n[2]) for n in self.allowed_networks]:
-                    if (net >> bits) == (ip >> bits):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
-            # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
-
-            if address in [a[2] for a in self.denied_addresses]:
-                allowed = False
-            else:
-                # Try checking denied networks
-                ip = self.ip_strton(address)
-                for net, bits in [(n[1], n[2]) for n in self.denied_networks]:
-                    if (net >> bits) == (ip >> bits):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(self, fn, path, header):
+        # Whitelist processing, address is not allowed until it is cleared.
+        result = (not allowed[0] or self.in_ranges(allowed, ip)) and not self.in_ranges(denied, ip)
+
+        if len(cache) >= self.CACHE_SIZE:
+            cache.clear()
+        cache[address] = result
+        return result
+
+    def load_access_file(self, rules, path, header):
         if not os.path.isfile(path):
             self.errors.append("Path to %s file does not exist: %s" % (header, colour_text(path, COLOUR_GREEN)))
             return False
         with open(path) as f:
-            for l in f.readlines():
-                fn(l)
+            for l in f:
+                self.add_access(rules, l, path)
+        return True
 
     def load_blacklist_file(self, path):
-        return self.load_access_file(self.add_blacklist, path, "blacklist")
+        self.sources.append(('load_blacklist_file', path))
+        return self.load_access_file(self.denied, path, "blacklist")
 
     def load_whitelist_file(self, path):
-        return self.load_access_file(self.add_whitelist, path, "whitelist")
+        self.sources.append(('load_whitelist_file', path))
+        return self.load_access_file(self.allowed, path, "whitelist")
+
+    def reload(self):
+        # Rebuild the rules from the same addresses and files that they were first loaded from.
+        # The new rules replace the old ones in one step, and only if all of them loaded cleanly.
+        # Returns a list of errors, which is empty on success.
+        fresh = type(self)()
+        for method, value in self.sources:
+            getattr(fresh, method)(value)
+        if fresh.errors:
+            return fresh.errors
+
+        compiled = fresh.compile()
+        self.allowed = fresh.allowed
+        self.denied = fresh.denied
+        self.compiled = compiled
+        return []
+
+    def reload_on_signal(self, signum = signal.SIGHUP):
+        # Reload rules whenever the process receives a signal (SIGHUP by default).
+        # Signal handlers can only be set from the main thread.
+        def handler(signum, frame):
+            errors = self.reload()
+            for e in errors:
+                print_error(e)
+            if errors:
+                print_warning("Keeping the previous access rules.")
+            else:
+                print_notice("Reloaded access rules.")
+        signal.signal(signum, handler)
 
 # Demonstration of access-list
 if __name__ == "__main__": # pragma: no cover
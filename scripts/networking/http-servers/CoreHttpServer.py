@@ -5,14 +5,16 @@
 #   * https://docs.python.org/2/library/simplehttpserver.html
 
 # Basic includes
-import base64, getopt, getpass, os, mimetypes, posixpath, re, shutil, ssl, socket, struct, sys, time, urllib
+import base64, binascii, bisect, email.utils, errno, getopt, getpass, hashlib, json, os, mimetypes, posixpath, re, shutil, signal, ssl, socket, stat, struct, sys, threading, time, urllib, zlib
+from collections import OrderedDict
+from io import BytesIO
 from random import randint
 
 if sys.version_info[0] == 2:
     from BaseHTTPServer import HTTPServer
     from BaseHTTPServer import BaseHTTPRequestHandler
 
-    from SocketServer import ThreadingMixIn
+    from Queue import Empty, Full, Queue
 
     from urllib import unquote
     from urlparse import parse_qs
@@ -24,17 +26,28 @@ if sys.version_info[0] == 2:
 
     FileNotFoundError = OSError
 else:
-    import http.client
     from http.server import HTTPServer
     from http.server import BaseHTTPRequestHandler
 
-    from socketserver import ThreadingMixIn
+    from queue import Empty, Full, Queue
 
     from urllib.parse import unquote
     from urllib.parse import parse_qs
 
     from io import StringIO
 
+try:
+    import selectors
+except ImportError:
+    # Python 2, connections wait on their next request in a worker instead.
+    selectors = None
+
+try:
+    import brotli
+except ImportError:
+    # Optional, responses fall back to gzip.
+    brotli = None
+
 #
 # Common Colours and Message Functions
 ###
@@ -119,6 +132,14 @@ DEFAULT_AUTH_TIMEOUT = 300
 
 DEFAULT_TIMEOUT = 10
 
+DEFAULT_COMPRESSION_CACHE = 32*1024*1024
+
+DEFAULT_MAX_CONNECTIONS = 128
+DEFAULT_WORKERS = 16
+
+DEFAULT_LOG_FORMAT = "text"
+DEFAULT_LOG_MAX_SIZE = 64*1024*1024
+
 DEFAULT_BIND = "0.0.0.0"
 DEFAULT_PORT = 8080
 
@@ -127,8 +148,14 @@ REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
 TITLE_BIND = "bind"
 TITLE_PORT = "port"
 TITLE_TIMEOUT = "timeout"
+TITLE_MAX_CONNECTIONS = "max-connections"
+TITLE_WORKERS = "workers"
 TITLE_VERBOSE="verbose"
 
+TITLE_LOG_FILE = "log-file"
+TITLE_LOG_FORMAT = "log-format"
+TITLE_LOG_MAX_SIZE = "log-max-size"
+
 TITLE_AUTH_LIMIT = "attempt limit"
 TITLE_AUTH_PROMPT = "prompt"
 TITLE_AUTH_TIMEOUT = "attempt limit timeout"
@@ -145,6 +172,16 @@ TITLE_DENY_FILE = "deny address/range file"
 
 TITLE_USER_AGENT = "user-agent pattern"
 
+TITLE_CACHE_MAX_AGE = "max-age"
+TITLE_CACHE_NO_CACHE = "no-cache"
+
+TITLE_NO_COMPRESSION = "no-compression"
+
+LOG_FORMAT_COMBINED = "combined"
+LOG_FORMAT_JSON = "json"
+LOG_FORMAT_TEXT = "text"
+LOG_FORMATS = (LOG_FORMAT_TEXT, LOG_FORMAT_JSON, LOG_FORMAT_COMBINED)
+
 AUTH_BAD_NOT_FOUND = 0
 AUTH_BAD_PASSWORD = 1
 AUTH_GOOD_CREDS = 2
@@ -475,6 +512,14 @@ args.add_opt(OPT_TYPE_SHORT, "k", TITLE_SSL_KEY, "SSL key file path (PEM format)
 args.add_opt(OPT_TYPE_LONG, "user-agent", TITLE_USER_AGENT, "Regular expression to match user agents. When this option is in use, the client must match at least one provided pattern.", multiple = True)
 args.add_opt(OPT_TYPE_LONG, "auth-limit", TITLE_AUTH_LIMIT, "Number of attempts allowed within lockout period (0 for unlimited attempts).", converter = int, default = DEFAULT_AUTH_LIMIT, default_announce = True)
 args.add_opt(OPT_TYPE_LONG, "auth-timeout", TITLE_AUTH_TIMEOUT, "Login attempts timeout in seconds (0 for unlimited).", converter = int, default = DEFAULT_AUTH_TIMEOUT, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, TITLE_CACHE_MAX_AGE, TITLE_CACHE_MAX_AGE, "Seconds that clients may cache served files without checking back.", converter = int)
+args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_CACHE_NO_CACHE, TITLE_CACHE_NO_CACHE, "Have clients check back before re-using a cached file (unchanged files still get a short 304 response).")
+args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_NO_COMPRESSION, TITLE_NO_COMPRESSION, "Do not compress text responses, even if the client accepts it.")
+args.add_opt(OPT_TYPE_LONG, TITLE_MAX_CONNECTIONS, TITLE_MAX_CONNECTIONS, "Connections open at once. Past this, the longest-idle connection is closed to make room, or if none are idle further clients are turned away with a 503 response.", converter = int, default = DEFAULT_MAX_CONNECTIONS, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, TITLE_WORKERS, TITLE_WORKERS, "Number of worker threads serving connections (0 for a thread per connection).", converter = int, default = DEFAULT_WORKERS, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, TITLE_LOG_FORMAT, TITLE_LOG_FORMAT, "Access log format: %s." % ", ".join([colour_text(f) for f in LOG_FORMATS]), default = DEFAULT_LOG_FORMAT, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, TITLE_LOG_FILE, TITLE_LOG_FILE, "Write the access log to this file instead of standard output.")
+args.add_opt(OPT_TYPE_LONG, TITLE_LOG_MAX_SIZE, TITLE_LOG_MAX_SIZE, "Rotate the access log file once it reaches this many bytes (0 to never rotate).", converter = int, default = DEFAULT_LOG_MAX_SIZE, default_announce = True)
 for default, title in [(DEFAULT_AUTH_PROMPT, TITLE_AUTH_PROMPT), ("", TITLE_USER), ("", TITLE_PASSWORD)]:
     args.add_opt(OPT_TYPE_LONG, title, title, "Specify authentication %s." % title, default = default)
 
@@ -496,6 +541,17 @@ def validate_common_arguments(self):
     if TITLE_SSL_KEY in self.args and not TITLE_SSL_CERT in self.args:
         errors.append("%s path provided, but no %s path was provided." % (TITLE_SSL_KEY, TITLE_SSL_CERT))
 
+    if self[TITLE_MAX_CONNECTIONS] <= 0:
+        errors.append("Connection limit must be a positive value. Given: %s" % colour_text(self[TITLE_MAX_CONNECTIONS]))
+    if self[TITLE_WORKERS] < 0:
+        errors.append("Worker count must be greater than or equal to 0. Given: %s" % colour_text(self[TITLE_WORKERS]))
+
+    if TITLE_CACHE_MAX_AGE in self.args:
+        if self[TITLE_CACHE_MAX_AGE] < 0:
+            errors.append("Cache max age must be greater than or equal to 0. Given: %s" % colour_text(self[TITLE_CACHE_MAX_AGE]))
+        if self[TITLE_CACHE_NO_CACHE]:
+            errors.append("Cannot use both %s and %s." % (colour_text("--" + TITLE_CACHE_MAX_AGE), colour_text("--" + TITLE_CACHE_NO_CACHE)))
+
     if self[TITLE_AUTH_LIMIT] < 0:
         errors.append('Auth limit must be greater than or equal to 0.')
     if self[TITLE_AUTH_TIMEOUT] < 0:
@@ -521,11 +577,36 @@ def validate_blacklists(self):
     for i in self[TITLE_DENY]:
         access.add_blacklist(i)
     for i in self[TITLE_DENY_FILE]:
-        access.load_whitelist_file(i)
+        access.load_blacklist_file(i)
 
     return access.errors
 args.add_validator(validate_blacklists)
 
+def validate_log_arguments(self):
+    errors = []
+
+    if self[TITLE_LOG_FORMAT] not in LOG_FORMATS:
+        errors.append("Unknown log format: %s" % colour_text(self[TITLE_LOG_FORMAT]))
+    if self[TITLE_LOG_MAX_SIZE] < 0:
+        errors.append("Log size limit must be greater than or equal to 0. Given: %s" % colour_text(self[TITLE_LOG_MAX_SIZE]))
+
+    path = self[TITLE_LOG_FILE]
+    if path:
+        directory = os.path.dirname(os.path.realpath(path))
+        if os.path.isdir(path):
+            errors.append("Log file path is a directory: %s" % colour_text(path, COLOUR_GREEN))
+        elif not os.path.isdir(directory):
+            errors.append("Log file directory not found: %s" % colour_text(directory, COLOUR_GREEN))
+    elif TITLE_LOG_MAX_SIZE in self.args:
+        print_warning("Log size limit specified, but no log file was specified.")
+
+    access_log.format = self[TITLE_LOG_FORMAT]
+    access_log.path = path
+    access_log.max_size = self[TITLE_LOG_MAX_SIZE]
+
+    return errors
+args.add_validator(validate_log_arguments)
+
 def validate_common_directory(self):
     directory = get_target()
     if not os.path.isdir(directory):
@@ -547,6 +628,11 @@ def announce_common_arguments(verb = "Hosting content"):
     if TITLE_TIMEOUT in args:
         print_notice("Read socket timeout: %s" % colour_text(args[TITLE_TIMEOUT]))
 
+    if args[TITLE_WORKERS]:
+        print_notice("Serving with %s worker threads, up to %s connections" % (colour_text(min(args[TITLE_WORKERS], args[TITLE_MAX_CONNECTIONS])), colour_text(args[TITLE_MAX_CONNECTIONS])))
+    else:
+        print_notice("Serving with a thread per connection, up to %s connections" % colour_text(args[TITLE_MAX_CONNECTIONS]))
+
     for label, title in [("certificate", TITLE_SSL_CERT), ("key", TITLE_SSL_KEY)]:
         path = args[title]
         if path:
@@ -560,6 +646,21 @@ def announce_common_arguments(verb = "Hosting content"):
             timeout_wording = '%ss' % args[TITLE_AUTH_TIMEOUT]
         print_notice('Authentication timeout: %s' % colour_text(timeout_wording))
 
+    if not args[TITLE_NO_COMPRESSION]:
+        print_notice("Compressing text responses with: %s" % colour_text(", ".join(get_compressions())))
+
+    cache_control = get_cache_control()
+    if cache_control:
+        print_notice("File caching policy: %s" % colour_text(cache_control))
+
+    if args[TITLE_LOG_FILE]:
+        rotation = "never rotated"
+        if args[TITLE_LOG_MAX_SIZE]:
+            rotation = "rotated at %s bytes" % colour_text(args[TITLE_LOG_MAX_SIZE])
+        print_notice("Access log (%s): %s, %s" % (colour_text(args[TITLE_LOG_FORMAT]), colour_text(os.path.realpath(args[TITLE_LOG_FILE]), COLOUR_GREEN), rotation))
+    elif args[TITLE_LOG_FORMAT] != DEFAULT_LOG_FORMAT:
+        print_notice("Access log format: %s" % colour_text(args[TITLE_LOG_FORMAT]))
+
     access.announce_filter_actions()
 
     for ua in args[TITLE_USER_AGENT]:
@@ -590,6 +691,20 @@ def convert_str(data):
     return str(data)
 
 DEFAULT_TARGET = os.getcwd() # Most implementations consider the target to be the current directory. Override if this is not the case.
+def get_cache_control():
+    # Cache-Control header value for served files, if any.
+    if args[TITLE_CACHE_NO_CACHE]:
+        return "no-cache"
+    if TITLE_CACHE_MAX_AGE in args:
+        return "max-age=%d" % args[TITLE_CACHE_MAX_AGE]
+    return None
+
+def get_compressions():
+    # Encodings that responses can be compressed with on the fly, in order of preference.
+    if brotli:
+        return ["br", "gzip"]
+    return ["gzip"]
+
 def get_target():
     return args.last_operand(DEFAULT_TARGET)
 
@@ -601,7 +716,7 @@ def serve(handler, change_directory = False, data = None):
     server = None
     try:
 
-        server = ThreadedHTTPServer((bind_address, bind_port), handler)
+        server = ThreadedHTTPServer((bind_address, bind_port), handler, args[TITLE_WORKERS], args[TITLE_MAX_CONNECTIONS], args[TITLE_TIMEOUT])
         server.data = data
 
         if args[TITLE_SSL_CERT]:
@@ -612,6 +727,12 @@ def serve(handler, change_directory = False, data = None):
         if change_directory:
             os.chdir(directory)
 
+        if access.sources:
+            # Re-read access rules and files on SIGHUP.
+            access.reload_on_signal()
+
+        access_log.start()
+
         print_notice("Starting server, use <Ctrl-C> to stop")
         server.serve_forever()
     except KeyboardInterrupt:
@@ -619,6 +740,8 @@ def serve(handler, change_directory = False, data = None):
         if server:
             server.kill_requests()
         print("")
+        if server and server.shed:
+            print_warning("Turned away %s connections past the connection limit." % colour_text(server.shed))
     except ssl.SSLError as e:
         m = "Unexpected %s: " % colour_text(type(e).__name__, COLOUR_RED)
         if re.match("^\[SSL\] PEM lib", str(e)):
@@ -632,6 +755,9 @@ def serve(handler, change_directory = False, data = None):
     except Exception as e:
         print_exception(e)
         exit(1)
+    finally:
+        # Write out whatever is left of the access log.
+        access_log.close()
 
 # Default error message template
 DEFAULT_ERROR_MESSAGE = """<html>
@@ -660,15 +786,47 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
     server_version = "CoreHttpServer"
     alive = True
 
+    # Keep connections open between requests unless the client or the response says otherwise.
+    protocol_version = "HTTP/1.1"
+
+    # Error responses that leave the connection usable for another request.
+    error_keep_alive_codes = (401, 403, 404, 416)
+
+    # Compression of text content.
+    # Smaller responses are not worth the effort.
+    compress_min_length = 1024
+    compressible_types = ("application/javascript", "application/json", "application/xml", "image/svg+xml")
+    # Pre-compressed siblings of files (e.g. "style.css.gz"), by encoding.
+    compressed_suffixes = OrderedDict([("br", ".br"), ("gzip", ".gz")])
+
     # (Kludgy) responses to specific problems without overriding an entire method.
     log_on_send_error = False
 
+    # Headers and body are written separately. Send each as it comes instead of holding the body
+    #   back until the client acknowledges the headers, which a kept-alive client may delay.
+    disable_nagle_algorithm = True
+
+    # Most header lines accepted in a request, as with http.client.
+    max_headers = 100
+
+    # Names of parse_preauth_header_*/parse_header_* methods, by handler class and prefix.
+    # Found once per class rather than searched for on every request.
+    hooks = {}
+
+    # Bytes handed to sendfile() at a time, checking in between that the server is still alive.
+    sendfile_block = 8*1024*1024
+
     error_message_format = DEFAULT_ERROR_MESSAGE
 
-    def __init__(self, request, client_address, server):
+    def __init__(self, request, client_address, server, reader = None):
         self.request = request
         self.client_address = client_address
         self.server = server
+        # Applied to the socket by setup().
+        self.timeout = args[TITLE_TIMEOUT]
+        # Anything already read from the connection while the server waited on a complete request.
+        self.reader = reader
+        self.parked = False
         self.setup()
         self.request_sane = False
 
@@ -724,22 +882,71 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 self.server.attempts[client] = [time.time()]
         return success
 
+    def can_sendfile(self, src, dst):
+        # sendfile() only works from a regular file straight to a plaintext socket.
+        # TLS connections, generated content, and uploads are copied through Python.
+        if dst is not self.wfile or isinstance(self.connection, ssl.SSLSocket) or not hasattr(self.connection, 'sendfile'):
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(src.fileno()).st_mode)
+        except (AttributeError, IOError, OSError, ValueError):
+            # In-memory content has no file descriptor.
+            return False
+
+    def check_not_modified(self, fs, encoding = None):
+        # Conditional GET: the client's copy is still good if it names the current ETag,
+        #   or (lacking an If-None-Match header) if the file is no newer than the client's copy.
+        if_none_match = self.headers["If-None-Match"]
+        if if_none_match:
+            etag = self.file_etag(fs, encoding)
+            # Weak comparison, as If-None-Match calls for.
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return "*" in tags or etag in [re.sub("^W/", "", t) for t in tags]
+
+        if_modified_since = self.headers["If-Modified-Since"]
+        if if_modified_since:
+            try:
+                since = email.utils.mktime_tz(email.utils.parsedate_tz(if_modified_since))
+            except (IndexError, OverflowError, TypeError, ValueError):
+                # Unparseable date, serve the file.
+                return False
+            return int(fs.st_mtime) <= since
+
+        return False
+
     def copyobj(self, src, dst, outgoing = True):
         if not src:
             return
 
-        while self.alive:
-            buf = src.read(16*1024)
-            if not (buf and self.alive):
-                break
-            dst.write(convert_bytes(buf))
+        if self.can_sendfile(src, dst):
+            self.copyobj_sendfile(src)
+        else:
+            while self.alive:
+                buf = src.read(16*1024)
+                if not (buf and self.alive):
+                    break
+                dst.write(convert_bytes(buf))
 
         if not outgoing:
             return
 
-        self.alive = False
         src.close()
 
+    def copyobj_sendfile(self, src, offset = 0, count = None):
+        # Have the kernel copy count bytes (or to the end of the file) from offset to the client.
+        self.wfile.flush()
+        while self.alive and (count is None or count > 0):
+            block = self.sendfile_block
+            if count is not None:
+                block = min(block, count)
+            sent = self.connection.sendfile(src, offset, block)
+            self.wfile.sent += sent
+            offset += sent
+            if count is not None:
+                count -= sent
+            if sent < block:
+                break
+
     def invoke(self, method):
         """Serve a request."""
 
@@ -760,18 +967,98 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         '.h': 'text/plain',
         })
 
-    def get_command(self):
-        return getattr(self, ATTR_COMMAND, "GET")
+    def end_headers(self):
+        # Tell the client what will become of the connection if it would not otherwise assume it.
+        if not self.connection_header:
+            version = getattr(self, ATTR_REQUEST_VERSION, self.default_request_version)
+            if self.close_connection and version >= "HTTP/1.1":
+                self.send_header("Connection", "close")
+            elif not self.close_connection and version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+        super(CoreHttpServer, self).end_headers()
+        # Anything sent from here on is the body.
+        self.body_start = self.wfile.sent
+
+    def file_etag(self, fs, encoding = None):
+        # Strong validator, changes whenever the file is replaced, resized, or touched.
+        # Each encoding of a file is different content, and gets its own tag.
+        mtime = getattr(fs, 'st_mtime_ns', int(fs.st_mtime * 1000000000))
+        if encoding:
+            return '"%x-%x-%x-%s"' % (fs.st_ino, fs.st_size, mtime, encoding)
+        return '"%x-%x-%x"' % (fs.st_ino, fs.st_size, mtime)
+
+    def get_accepted_encodings(self):
+        # Compressions accepted by the client from those we could use, in our order of preference.
+        accepted = {}
+        for item in self.headers["Accept-Encoding"].split(","):
+            parts = item.split(";")
+            quality = 1.0
+            for param in parts[1:]:
+                param = param.strip()
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0
+            accepted[parts[0].strip().lower()] = quality
+
+        default = accepted.get("*", 0)
+        return [e for e in self.compressed_suffixes if accepted.get(e, default) > 0]
+
+    def get_content_encoding(self, mimetype, length):
+        # Encoding to compress generated content with, if any.
+        if length < self.compress_min_length or not self.is_compressible(mimetype):
+            return None
+        compressions = get_compressions()
+        for encoding in self.get_accepted_encodings():
+            if encoding in compressions:
+                return encoding
+        return None
+
+    def get_file_encoding(self, path, f, fs, mimetype):
+        """Decide how a file is to be encoded for the client.
+        A pre-compressed sibling of the file is preferred over compressing on the fly,
+        and is only used if it is at least as new as the file.
+        Returns the file to send, its size, the encoding, and whether it still needs compressing.
+        """
+
+        if not self.is_compressible(mimetype):
+            return f, fs.st_size, None, False
+
+        encodings = self.get_accepted_encodings()
+        for encoding in encodings:
+            sibling_path = path + self.compressed_suffixes[encoding]
+            try:
+                # The sibling is not checked against any rules for the requested path,
+                #   so it is held to the server's rules on symbolic links here.
+                if stat.S_ISLNK(os.lstat(sibling_path).st_mode) and not self.is_link_allowed(sibling_path):
+                    continue
+                sibling = open(sibling_path, 'rb')
+            except (IOError, OSError):
+                continue
+            sibling_fs = os.fstat(sibling.fileno())
+            if stat.S_ISREG(sibling_fs.st_mode) and sibling_fs.st_mtime >= fs.st_mtime:
+                f.close()
+                return sibling, sibling_fs.st_size, encoding, False
+            sibling.close()
 
-    def get_header_dict(self, src):
-        d = CaselessDict()
+        if fs.st_size >= self.compress_min_length:
+            compressions = get_compressions()
+            for encoding in encodings:
+                if encoding in compressions:
+                    return f, None, encoding, True
 
-        for l in [l for l in re.split("\r?\n", str(src)) if l]:
-            items = l.split(":")
-            if items[1:]:
-                d[items[0]] = ":".join(items[1:]).strip()
+        return f, fs.st_size, None, False
 
-        return d
+    def get_command(self):
+        return getattr(self, ATTR_COMMAND, "GET")
+
+    def get_hooks(self, prefix):
+        key = (type(self), prefix)
+        names = self.hooks.get(key)
+        if names is None:
+            names = self.hooks[key] = [m for m in dir(type(self)) if m.startswith(prefix)]
+        return names
 
     def guess_type(self, path):
         """Guess the type of a file.
@@ -789,6 +1076,42 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             return self.extensions_map[ext]
         return self.extensions_map.get(ext.lower(), '')
 
+    def is_compressible(self, mimetype):
+        if args[TITLE_NO_COMPRESSION]:
+            return False
+        mimetype = mimetype.split(";")[0].strip().lower()
+        return mimetype.startswith("text/") or mimetype in self.compressible_types
+
+    def is_link_allowed(self, path):
+        # Whether a symbolic link may be followed to serve a file.
+        #   Handlers that restrict symbolic links override this.
+        return True
+
+    def handle(self):
+        """Handle requests until the connection is closed or the server is stopped.
+        A kept-alive connection that has yet to send its next request in full is
+        left for the server to wait on, rather than holding up a worker.
+        """
+        self.close_connection = 1
+        self.handle_logged_request()
+        while self.alive and not self.close_connection:
+            if not self.rfile.has_request():
+                if not self.rfile.read_nowait():
+                    # Closed by the client.
+                    return
+                if not self.rfile.has_request() and self.server.parking:
+                    # Parked by the server once this handler is done with the connection.
+                    self.parked = True
+                    return
+            self.handle_logged_request()
+
+    def handle_logged_request(self):
+        try:
+            self.handle_one_request()
+        finally:
+            # Logged once the response is out, when its size and timing are known.
+            self.log_access()
+
     def handle_one_request(self):
         """Handle a single HTTP request.
         You normally don't need to override this method; see the class
@@ -799,8 +1122,11 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         nice upstream spot to put the whitelist/blacklist feature.
         """
 
+        self.reset_request()
+
         try:
             self.raw_requestline = self.rfile.readline(65537)
+            self.request_start = time.time()
             if len(self.raw_requestline) > 65536:
                 return self.send_error(414)
             if not self.raw_requestline:
@@ -814,16 +1140,21 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             # Implementation-specific header parsing
             # Check for high-priority information that is necessary before we
             #   potentially slam the door in the client's face.
-            for m in [getattr(self, m) for m in dir(self) if m.startswith('parse_preauth_header_')]:
-                if not m():
+            for name in self.get_hooks('parse_preauth_header_'):
+                if not getattr(self, name)():
                     return
 
+            if self.headers.get("Content-Length", "0") != "0" or self.headers["Transfer-Encoding"]:
+                # Handlers do not always read a request body in full (e.g. a rejected upload),
+                #   leaving no reliable start for a following request.
+                self.close_connection = 1
+
             if not self.check_authentication():
                 return self.send_error(401, args[TITLE_AUTH_PROMPT])
 
             # Implementation-specific header parsing
-            for m in [getattr(self, m) for m in dir(self) if m.startswith('parse_header_')]:
-                if not m():
+            for name in self.get_hooks('parse_header_'):
+                if not getattr(self, name)():
                     return
 
             command = self.get_command()
@@ -839,8 +1170,59 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         except socket.timeout:
             # a read or a write timed out.  Discard this connection
             self.close_connection = 1
+            if not self.raw_requestline:
+                # Idle connection between requests, nobody is waiting on a response.
+                return
             return self.send_error(408, "Data timeout (%s seconds)" % args[TITLE_TIMEOUT])
 
+    def log_access(self):
+        """Pass the request noted by log_message() on to the access log.
+        Only plain values are gathered here. Formatting and writing them out
+        are left to the access log's own thread.
+        """
+
+        values = self.log_values
+        if not values:
+            return
+        self.log_values = None
+
+        headers = getattr(self, ATTR_HEADERS, None)
+        if headers is None or not self.request_sane:
+            # Left over from an earlier request, or too mangled to trust.
+            headers = {}
+
+        try:
+            status = int(values[1])
+        except (TypeError, ValueError):
+            status = None
+
+        note = values[2]
+        if note in ("-", None):
+            note = None
+
+        sent = 0
+        if self.body_start is not None:
+            sent = self.wfile.sent - self.body_start
+
+        now = time.time()
+        start = self.request_start or now
+
+        access_log.log({
+            "time": start,
+            "duration": now - start,
+            "client": self.client_address[0],
+            "user": getattr(self, '_user', None),
+            "request": "%s" % values[0],
+            "sane": self.request_sane,
+            "status": status,
+            "bytes": sent,
+            "note": note,
+            "referer": headers.get("Referer") or None,
+            "user_agent": headers.get("User-Agent") or None,
+            "forwarded_for": headers.get("X-Forwarded-For") or None,
+            "forwarded": headers.get("Forwarded") or None
+        })
+
     def log_date_time_string(self):
         """Return the current time formatted for logging."""
         now = time.time()
@@ -857,121 +1239,17 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         any % escapes requiring parameters, they should be
         specified as subsequent arguments (it's just like
         printf!).
-        The client host and current date/time are prefixed to
-        every message.
 
-        Modified to have a bit more colour, as Apache-style logging was not deemed a requirement for this script.
+        Modified to hold on to the request and response code until the
+        response has been sent, at which point log_access() hands them
+        to the access log along with the size and timing of the response.
         """
 
         if type(values[0]) == int:
             # Errors may be presented as tuples starting with error code as int.
             # Do not bother printing extra information on error codes in a new line.
             return
-        else:
-            words = values[0].split()
-            if values[1] == '404' and len(words) > 1 and words[1].lower().endswith("favicon.ico"):
-                # Do not bother printing not-found information on favicon.ico.
-                return
-
-        http_code_colour = COLOUR_RED
-        extra_info = ''
-        try:
-            response_code = int(values[1])
-        except ValueError:
-            response_code = "???"
-
-        # Adjust colouring and/or add context in extra_info message.
-        if response_code >= 200 and response_code < 300:
-            http_code_colour = COLOUR_GREEN
-        elif response_code in (301, 307):
-            http_code_colour = COLOUR_PURPLE
-            extra_info = '[%s]' % colour_text("Redirect", COLOUR_PURPLE)
-        elif response_code == 404:
-            extra_info = '[%s]' % colour_text("File Not Found", COLOUR_RED)
-        elif response_code == 502:
-            extra_info = '[%s]' % colour_text("Bad Gateway", COLOUR_RED)
-
-        user = getattr(self, '_user', None)
-        if user:
-            extra_info = "[User: %s]%s" % (colour_text(user), extra_info)
-
-        # Does address string match the client address? If not, print both.
-        s = self.address_string()
-        footer = ""
-
-        # A 400 (bad request) error is more likely to contain corrupted information.
-        # A likely cause of a bad request is a non-HTTP protocol being used (e.g. HTTPS, SSH).
-        # We do not want to print this information, so we will be overwriting our values tuple.
-        if response_code == 400 and not self.request_sane:
-            values = (colour_text("BAD REQUEST", COLOUR_RED), response_code, values[2])
-        else:
-            # Non-400 response.
-            # ToDo: account for possible index error here...
-            request_items = values[0].split(" ")
-            original_values = values
-            values = (" ".join([request_items[0], colour_text(request_items[1], COLOUR_GREEN), request_items[2]]), values[1], values[2])
-
-            if args[TITLE_VERBOSE]:
-                user_agent = self.headers.get("User-Agent")
-                if user_agent:
-                    footer=" (User Agent: %s)" % colour_text(user_agent.strip())
-
-        trailer = "[%s][%s]%s: %s%s\n" % (colour_text(self.log_date_time_string(), COLOUR_BOLD), colour_text(values[1], http_code_colour), extra_info, values[0], footer)
-        src = "%s " % colour_text(self.client_address[0], COLOUR_GREEN)
-
-        if s != self.client_address[0]:
-            src += "(%s)" % colour_text(s, COLOUR_GREEN)
-
-        # When a a proxy such as Squid or Apache forwards information,
-        # (ProxyPass/ProxyPassReverse directives for Apache),
-        # the original client's IP is stored in the 'X-Forwarded-For' header.
-        # Trust this value as the true client address if it regexes to an IPv4 address.
-        proxy_src = None
-        proxy_steps = []
-        forward_spec = getattr(self, ATTR_HEADERS, CaselessDict()).get("X-Forwarded-For")
-
-        if forward_spec:
-            forward_components = [c.strip() for c in forward_spec.split(",")]
-            forward_addr = forward_components.pop(0)
-            if forward_addr and re.match(REGEX_INET4, forward_addr):
-                proxy_src = forward_addr
-                proxy_steps = forward_components
-        else:
-            # As a fallback, try the 'Forwarded' header put forward by RFC 7239.
-
-            try:
-                forward_spec = getattr(self, ATTR_HEADERS, CaselessDict()).get("Forwarded")
-                forward_addr = forward_spec.split(";")[2].split("=")[1]
-                if forward_addr and re.match(REGEX_INET4, forward_addr):
-                    proxy_src = forward_addr
-            except:
-                # Lazy approach. Skip validation of lists by encasing everything in a try-catch.
-                pass
-
-        if proxy_src:
-            old_src = src.strip()
-            src = "%s [proxy via " % colour_text(proxy_src, COLOUR_GREEN)
-
-            if proxy_steps:
-                first = True
-                for step in proxy_steps:
-                    if not first:
-                        first += "->"
-                    first = False
-                    if re.match(REGEX_INET4, step):
-                        src += colour_text(step, COLOUR_GREEN)
-                    else:
-                        # Wonky input. Maliciously formed?
-                        # For now, just say "???" and deal with any troubles as they come up.
-                        src += colour_text("???")
-                src += "->%s" % old_src
-            else:
-                # One proxy step, quick and simple.
-                src += old_src
-            src += "]"
-
-        sys.stdout.write("%s%s" % (src, trailer))
-        sys.stdout.flush()
+        self.log_values = values
 
     def quote_html(self, html):
         return html.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
@@ -1132,14 +1410,45 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         except FileNotFoundError:
             return self.send_error(404)
 
-        # Parsing into a case-insensitive dictionary for simplicity.
-        if sys.version_info[0] == 2:
-            self.headers = self.get_header_dict(self.MessageClass(self.rfile, 0))
-        else:
-            mc = http.client.parse_headers(self.rfile, _class=self.MessageClass).__str__()
-            self.headers = self.get_header_dict(mc)
+        return self.read_headers()
 
-        return True
+    def read_headers(self):
+        """Read request headers into a case-insensitive dictionary.
+        Lines are read straight off of the connection rather than through a mail
+        message parser, which spends more time re-formatting headers than reading them.
+        Return True for success, False for failure; on failure, an
+        error is sent back.
+        """
+
+        self.headers = CaselessDict()
+        name = None
+        for i in range(self.max_headers + 1):
+            line = self.rfile.readline(65537)
+            if len(line) > 65536:
+                return self.send_error(431, "Line too long")
+            if line in (b'\r\n', b'\n', b''):
+                return True
+            if sys.version_info[0] >= 3:
+                line = line.decode('iso-8859-1')
+
+            if line[0] in " \t":
+                # Obsolete line folding, continuing the previous header.
+                if name:
+                    self.headers[name] = "%s %s" % (self.headers[name], line.strip())
+                continue
+
+            name, colon, value = line.partition(":")
+            if not colon:
+                name = None
+                continue
+            value = value.strip()
+            if name in self.headers:
+                # Repeated headers are the same as a single comma-separated list,
+                #   except for cookies, which are separated by semicolons instead.
+                value = "%s%s%s" % (self.headers[name], "; " if name.lower() == "cookie" else ", ", value)
+            self.headers[name] = value
+
+        return self.send_error(431, "Too many headers")
 
     def render_breadcrumbs(self, path):
 
@@ -1178,6 +1487,18 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 content += "/%s" % text
         return content
 
+    def reset_request(self):
+        # Clear state left behind by a previous request on the same connection.
+        self.close_connection = 1
+        self.connection_header = None
+        self.raw_requestline = None
+        self.request_sane = False
+        self.request_start = None
+        self.body_start = None
+        self.log_values = None
+        self._user = None
+        self._password = None
+
     def run(self):
         """
         Separation of tasks in standard __init__
@@ -1187,10 +1508,42 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         finally:
             self.finish()
 
-    def send_common_headers(self, mimetype, length):
+    def send_cache_headers(self, fs, encoding = None):
+        # Validators and caching policy for a file response.
+        self.send_header("ETag", self.file_etag(fs, encoding))
+        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        cache_control = get_cache_control()
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+
+    def send_common_headers(self, mimetype, length = None):
         encoding = sys.getfilesystemencoding()
         self.send_header("Content-Type", "%s; charset=%s" % (mimetype, encoding))
-        self.send_header("Content-Length", str(length))
+        return self.send_content_framing(length)
+
+    def send_content_framing(self, length = None):
+        """Announce how the end of the response body will be found.
+        Content of unknown length is chunked for HTTP/1.1 clients,
+        and delimited by closing the connection for older clients.
+        Returns a ChunkedWriter to write the body through if chunked,
+        or self.wfile otherwise.
+        """
+        if length is not None:
+            self.send_header("Content-Length", str(length))
+            return self.wfile
+        if getattr(self, ATTR_REQUEST_VERSION, self.default_request_version) >= "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+            return ChunkedWriter(self.wfile)
+        self.close_connection = 1
+        return self.wfile
+
+    def send_encoding_headers(self, mimetype, encoding = None):
+        # Caches must tell apart responses that could have been compressed.
+        if not self.is_compressible(mimetype):
+            return
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
 
     def send_error(self, code, message=None):
         """Send and log an error reply.
@@ -1223,7 +1576,8 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 )):
 
                 self.send_response(code, message)
-                self.send_header('Connection', 'close')
+                if code not in self.error_keep_alive_codes:
+                    self.send_header('Connection', 'close')
                 if code == 401:
                     self.send_header('WWW-Authenticate', 'Basic realm="%s"' % message)
 
@@ -1246,18 +1600,33 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
 
         return False
 
+    def send_not_modified(self, fs, mimetype = None, encoding = None):
+        self.send_response(304)
+        if mimetype:
+            self.send_encoding_headers(mimetype)
+        self.send_cache_headers(fs, encoding)
+        self.end_headers()
+        return None
+
     def send_redirect(self, target):
         # redirect browser - doing basically what apache does
         self.send_response(307)
         self.send_header("Location", target)
+        self.send_header("Content-Length", "0")
         self.end_headers()
         return None
 
+    def send_header(self, keyword, value):
+        if keyword.lower() == "connection":
+            self.connection_header = value
+        super(CoreHttpServer, self).send_header(keyword, value)
+
     def serve_content(self, content = None, code = 200, mimetype = "text/html"):
 
-        f, length = self.serve_content_prepare(content)
+        f, length, encoding = self.serve_content_prepare_encoded(content, mimetype)
         self.send_response(code)
         self.send_common_headers(mimetype, length)
+        self.send_encoding_headers(mimetype, encoding)
         self.end_headers()
         return f
 
@@ -1273,6 +1642,26 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
 
         return f, length
 
+    def serve_content_prepare_encoded(self, content, mimetype):
+        # As serve_content_prepare(), but compressed if the client allows it.
+        # Repeat renders of the same page are served out of compression_cache.
+        encoding = content and self.get_content_encoding(mimetype, len(content))
+        if not encoding:
+            f, length = self.serve_content_prepare(content)
+            return f, length, None
+
+        data = convert_bytes(content)
+        key = (encoding, hashlib.sha1(data).digest())
+        compressed = compression_cache.get(key)
+        if compressed is None:
+            dst = CompressingWriter(BytesIO(), encoding)
+            dst.write(data)
+            dst.close()
+            compressed = dst.dst.getvalue()
+            compression_cache.put(key, compressed)
+
+        return BytesIO(compressed), len(compressed), encoding
+
     def serve_file(self, path):
 
         if not (os.path.exists(path) and os.path.isfile(path)):
@@ -1286,14 +1675,36 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             f = open(path, 'rb')
         except IOError:
             return self.send_error(404, 'Not Found')
+        fs = os.fstat(f.fileno())
+        f, length, encoding, compress = self.get_file_encoding(path, f, fs, ctype)
+        if self.check_not_modified(fs, encoding):
+            f.close()
+            return self.send_not_modified(fs, ctype, encoding)
+
         self.send_response(200)
         self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_encoding_headers(ctype, encoding)
+        self.send_cache_headers(fs, encoding)
+        if compress:
+            # Compressed size is not known up front.
+            dst = CompressingWriter(self.send_content_framing(), encoding)
+            self.end_headers()
+            self.copyobj(f, dst)
+            dst.close()
+            return None
+        self.send_header("Content-Length", str(length))
         self.end_headers()
         return f
 
+    def setup(self):
+        super(CoreHttpServer, self).setup()
+        # Requests are read through a ConnectionReader, which can carry over to the
+        #   server anything left unread when the connection goes back to waiting.
+        self.rfile.close()
+        self.rfile = self.reader or ConnectionReader(self.connection)
+        # Counts what is sent, for the access log.
+        self.wfile = CountingWriter(self.wfile)
+
     def translate_path(self, path, include_cwd = True):
         """Translate a /-separated PATH to the local filename syntax.
         Components that mean special things to the local file system
@@ -1324,79 +1735,640 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             path = os.path.join(path, word)
         return path
 
+class AccessLog:
+    """
+    Writes out access log lines from a thread of its own, so that requests are
+    never held up by a slow terminal or disk.
+    Lines are queued up by request threads and written out in batches, with
+    one flush per batch. Log files are rotated once they reach a set size.
+    """
+
+    # Lines waiting to be written before any more are dropped.
+    backlog = 10000
+    # Lines written at once, at most.
+    batch = 1000
+    # Rotated files kept alongside the current one (e.g. "access.log.1").
+    backups = 5
+
+    # Quotes, backslashes, and control characters are escaped in Combined Log Format fields.
+    escape_pattern = re.compile(r'[\x00-\x1f\x7f"\\]')
+
+    def __init__(self, fmt = DEFAULT_LOG_FORMAT, path = None, max_size = 0):
+        self.format = fmt
+        self.path = path
+        self.max_size = max_size
+        # Counted by request threads and reported by the writing thread.
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.dst = None
+        self.size = 0
+        self.queue = Queue(self.backlog)
+        self.thread = None
+
+    def close(self):
+        if self.thread:
+            try:
+                self.queue.put(None, timeout = 5)
+            except Full:
+                pass
+            # Do not hold up the exit forever on a stalled terminal.
+            self.thread.join(5)
+            if self.thread.is_alive():
+                return
+            self.thread = None
+        if self.dst:
+            self.dst.close()
+            self.dst = None
+
+    def escape(self, value):
+        if value is None:
+            return "-"
+        return self.escape_pattern.sub(self.escape_character, value)
+
+    def escape_character(self, match):
+        c = match.group(0)
+        if c in '"\\':
+            return "\\" + c
+        return "\\x%02x" % ord(c)
+
+    def format_combined(self, record):
+        # Apache's Combined Log Format, with the time taken in microseconds (%D) on the end.
+        t = time.localtime(record["time"])
+        return '%s - %s [%02d/%s/%04d:%02d:%02d:%02d %s] "%s" %s %s "%s" "%s" %d\n' % (
+            record["client"], self.escape(record["user"]),
+            t.tm_mday, BaseHTTPRequestHandler.monthname[t.tm_mon], t.tm_year, t.tm_hour, t.tm_min, t.tm_sec, self.get_utc_offset(t),
+            self.escape(record["request"]), record["status"] or "-", record["bytes"] or "-",
+            self.escape(record["referer"]), self.escape(record["user_agent"]), record["duration"] * 1000000)
+
+    def format_json(self, record):
+        # One JSON object per line.
+        t = time.localtime(record["time"])
+        method = path = protocol = None
+        words = record["request"].split(" ")
+        if record["sane"] and len(words) == 3:
+            method, path, protocol = words
+        return json.dumps(OrderedDict([
+            ("time", "%04d-%02d-%02dT%02d:%02d:%02d.%03d%s" % (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, record["time"] % 1 * 1000, self.get_utc_offset(t, ":"))),
+            ("client", record["client"]),
+            ("user", record["user"]),
+            ("request", record["request"]),
+            ("method", method),
+            ("path", path),
+            ("protocol", protocol),
+            ("status", record["status"]),
+            ("bytes", record["bytes"]),
+            ("duration_ms", round(record["duration"] * 1000, 3)),
+            ("referer", record["referer"]),
+            ("user_agent", record["user_agent"]),
+            ("forwarded_for", record["forwarded_for"]),
+            ("note", record["note"])
+        ])) + "\n"
+
+    def format_record(self, record):
+        if self.format == LOG_FORMAT_JSON:
+            return self.format_json(record)
+        if self.format == LOG_FORMAT_COMBINED:
+            return self.format_combined(record)
+        return self.format_text(record)
+
+    def format_text(self, record):
+        # A bit more colour, as Apache-style logging was not deemed a requirement for reading along.
+
+        response_code = record["status"]
+        request = record["request"]
+        words = request.split()
+        if response_code == 404 and len(words) > 1 and words[1].lower().endswith("favicon.ico"):
+            # Do not bother printing not-found information on favicon.ico.
+            return None
+
+        paint = colour_text
+        if self.dst:
+            # No terminal escape codes in files.
+            paint = lambda text, colour = None: "%s" % text
+
+        http_code_colour = COLOUR_RED
+        extra_info = ''
+
+        # Adjust colouring and/or add context in extra_info message.
+        if response_code and response_code >= 200 and response_code < 300:
+            http_code_colour = COLOUR_GREEN
+        elif response_code in (301, 307):
+            http_code_colour = COLOUR_PURPLE
+            extra_info = '[%s]' % paint("Redirect", COLOUR_PURPLE)
+        elif response_code == 404:
+            extra_info = '[%s]' % paint("File Not Found", COLOUR_RED)
+        elif response_code == 502:
+            extra_info = '[%s]' % paint("Bad Gateway", COLOUR_RED)
+
+        if record["user"]:
+            extra_info = "[User: %s]%s" % (paint(record["user"]), extra_info)
+
+        footer = ""
+
+        # A 400 (bad request) error is more likely to contain corrupted information.
+        # A likely cause of a bad request is a non-HTTP protocol being used (e.g. HTTPS, SSH).
+        # We do not want to print this information.
+        if response_code == 400 and not record["sane"]:
+            request = paint("BAD REQUEST", COLOUR_RED)
+        else:
+            if len(words) == 3:
+                request = " ".join([words[0], paint(words[1], COLOUR_GREEN), words[2]])
+
+            if args[TITLE_VERBOSE] and record["user_agent"]:
+                footer = " (User Agent: %s)" % paint(record["user_agent"].strip())
+
+        src = paint(record["client"], COLOUR_GREEN)
+
+        # When a a proxy such as Squid or Apache forwards information,
+        # (ProxyPass/ProxyPassReverse directives for Apache),
+        # the original client's IP is stored in the 'X-Forwarded-For' header.
+        # Trust this value as the true client address if it regexes to an IPv4 address.
+        proxy_src = None
+        proxy_steps = []
+        forward_spec = record["forwarded_for"]
+
+        if forward_spec:
+            forward_components = [c.strip() for c in forward_spec.split(",")]
+            forward_addr = forward_components.pop(0)
+            if forward_addr and re.match(REGEX_INET4, forward_addr):
+                proxy_src = forward_addr
+                proxy_steps = forward_components
+        elif record["forwarded"]:
+            # As a fallback, try the 'Forwarded' header put forward by RFC 7239.
+            try:
+                forward_addr = record["forwarded"].split(";")[2].split("=")[1]
+                if forward_addr and re.match(REGEX_INET4, forward_addr):
+                    proxy_src = forward_addr
+            except IndexError:
+                # Lazy approach. Skip validation of lists.
+                pass
+
+        if proxy_src:
+            # Wonky steps (maliciously formed?) are shown as "???".
+            steps = [paint(step, COLOUR_GREEN) if re.match(REGEX_INET4, step) else paint("???") for step in proxy_steps]
+            src = "%s [proxy via %s]" % (paint(proxy_src, COLOUR_GREEN), "->".join(steps + [src]))
+
+        t = time.localtime(record["time"])
+        stamp = "%04d-%02d-%02d %02d:%02d:%02d" % (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
+        return "%s [%s][%s]%s: %s%s\n" % (src, paint(stamp, COLOUR_BOLD), paint(response_code or "???", http_code_colour), extra_info, request, footer)
+
+    def get_utc_offset(self, t, separator = ""):
+        # Offset of a local time from UTC, e.g. "+0100" (or "+01:00" with a separator).
+        offset = getattr(t, 'tm_gmtoff', None)
+        if offset is None:
+            offset = -time.timezone
+            if t.tm_isdst > 0 and time.daylight:
+                offset = -time.altzone
+        sign = "+"
+        if offset < 0:
+            sign = "-"
+            offset = -offset
+        return "%s%02d%s%02d" % (sign, offset // 3600, separator, offset // 60 % 60)
+
+    def log(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            # Better to lose a line than to hold up a request behind a stalled terminal or disk.
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def open(self):
+        self.dst = open(self.path, "ab")
+        self.size = os.fstat(self.dst.fileno()).st_size
+
+    def rotate(self):
+        # access.log becomes access.log.1, access.log.1 becomes access.log.2, and so on.
+        self.dst.close()
+        self.dst = None
+        for i in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def run(self):
+        done = False
+        while not done:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            lines = []
+            for record in records:
+                if record is None:
+                    done = True
+                    continue
+                try:
+                    line = self.format_record(record)
+                except Exception as e:
+                    print_exception(e)
+                    continue
+                if line:
+                    lines.append(line)
+
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                print_warning("Dropped %s access log lines that could not be written out in time." % colour_text(dropped))
+
+            if lines:
+                self.write("".join(lines))
+
+    def start(self):
+        if self.thread:
+            return
+        if self.path:
+            self.open()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, text):
+        try:
+            if not self.dst:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                return
+
+            data = convert_bytes(text)
+            self.dst.write(data)
+            self.dst.flush()
+            self.size += len(data)
+            if self.max_size and self.size >= self.max_size:
+                self.rotate()
+        except (IOError, OSError) as e:
+            print_exception(e)
+
+class ChunkedWriter:
+    """
+    Writes to a stream using HTTP/1.1 chunked transfer coding.
+    Closing the writer sends the final chunk, but leaves the stream open.
+    """
+
+    def __init__(self, dst):
+        self.dst = dst
+
+    def close(self):
+        self.dst.write(convert_bytes("0\r\n\r\n"))
+
+    def flush(self):
+        self.dst.flush()
+
+    def write(self, data):
+        data = convert_bytes(data)
+        if data:
+            # An empty chunk would end the body early.
+            self.dst.write(convert_bytes("%x\r\n" % len(data)) + data + convert_bytes("\r\n"))
+
+class CompressingWriter:
+    """
+    Compresses everything written to it on the way to another writer,
+    optionally keeping a copy of the compressed output.
+    Closing the writer flushes out the remaining compressed data, and closes a
+    ChunkedWriter underneath it. Anything else underneath is left open.
+    """
+
+    def __init__(self, dst, encoding, keep = False):
+        self.dst = dst
+        self.kept = None
+        if keep:
+            self.kept = []
+        if encoding == "br":
+            compressor = brotli.Compressor(quality = 5)
+            self.compress = compressor.process
+            self.finish = compressor.finish
+        else:
+            # wbits of 31 makes for a gzip wrapper rather than zlib's.
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            self.compress = compressor.compress
+            self.finish = compressor.flush
+
+    def close(self):
+        self.emit(self.finish())
+        if isinstance(self.dst, ChunkedWriter):
+            self.dst.close()
+
+    def emit(self, data):
+        if not data:
+            return
+        if self.kept is not None:
+            self.kept.append(data)
+        self.dst.write(data)
+
+    def flush(self):
+        self.dst.flush()
+
+    def getvalue(self):
+        return convert_bytes("").join(self.kept or [])
+
+    def write(self, data):
+        self.emit(self.compress(convert_bytes(data)))
+
+class CompressionCache:
+    """
+    Compressed renders of generated content, dropping the least recently used
+    entries to keep within a total size.
+    """
+
+    def __init__(self, limit):
+        self.entries = OrderedDict()
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                # Re-insert as most recently used.
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.limit:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.limit:
+                key, old = self.entries.popitem(last = False)
+                self.size -= len(old)
+
+class ConnectionReader:
+    """
+    Reads requests from a client connection, in place of a file made from the socket.
+    What has been read but not yet used stays with the reader, so that a connection
+    can be passed between the server and its workers without losing anything.
+    """
+
+    # Bytes asked of the socket at a time.
+    read_size = 64*1024
+    # Most that is read in while waiting on a complete request line and headers.
+    #   A request head larger than this is left for the handler to turn away.
+    max_head = 256*1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+        # Start of what has not been used yet. Used data is only cleared out before reading more.
+        self.pos = 0
+        self.closed = False
+
+    def close(self):
+        # The connection outlives any one handler, so this leaves the buffer be.
+        self.closed = True
+
+    def fill(self):
+        # Read from the socket once, returning False at the end of the stream.
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        data = self.sock.recv(self.read_size)
+        if not data:
+            return False
+        self.buf += data
+        return True
+
+    def has_request(self):
+        # Whether a request line and its headers are buffered in full,
+        #   or at least as much of them as is worth waiting on.
+        if self.pending() >= self.max_head or self.buf.find(b'\r\n\r\n', self.pos) >= 0 or self.buf.find(b'\n\n', self.pos) >= 0:
+            return True
+        line_end = self.buf.find(b'\n', self.pos)
+        # An HTTP/0.9 request or garbage has no headers to wait on.
+        return line_end >= 0 and not self.buf[self.pos:line_end].rstrip().split(b' ')[-1].startswith(b'HTTP/')
+
+    def pending(self):
+        # Bytes read from the client that have not been used yet.
+        return len(self.buf) - self.pos
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            while self.fill():
+                pass
+            return self.take(self.pending())
+        while self.pending() < size and self.fill():
+            pass
+        return self.take(size)
+
+    def read_nowait(self):
+        """Take in whatever the client has sent so far, without waiting on more.
+        Returns False if the connection has been closed.
+        """
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(0)
+        try:
+            while self.pending() < self.max_head:
+                if not self.fill():
+                    return False
+        except ssl.SSLWantReadError:
+            pass
+        except (IOError, OSError, socket.error) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+        finally:
+            self.sock.settimeout(timeout)
+        return True
+
+    def readline(self, limit = -1):
+        end = self.buf.find(b'\n', self.pos) + 1
+        if end and (limit < 0 or end - self.pos <= limit):
+            # Usually the whole line is already buffered.
+            data = bytes(self.buf[self.pos:end])
+            self.pos = end
+            return data
+
+        searched = 0
+        while True:
+            end = self.buf.find(b'\n', self.pos + searched)
+            if end >= 0:
+                size = end + 1 - self.pos
+                break
+            size = self.pending()
+            if 0 <= limit <= size:
+                break
+            searched = size
+            if not self.fill():
+                break
+        if limit >= 0:
+            size = min(size, limit)
+        return self.take(size)
+
+    def take(self, size):
+        data = bytes(self.buf[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+class CountingWriter:
+    """
+    Counts the bytes written through it to another writer.
+    Anything sent around it (e.g. with sendfile()) is added to the count by hand.
+    """
+
+    def __init__(self, dst):
+        self.dst = dst
+        self.sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self.dst, name)
+
+    def write(self, data):
+        self.sent += len(data)
+        return self.dst.write(data)
+
 class CaselessDict(dict):
     # Case-insensitive dictionary.
     # Inspired by: https://stackoverflow.com/questions/2082152/case-insensitive-dictionary
-    # Made some extra adjustments to the original concept because I wanted to
-    #   have my cake and eat it too by not modifying any stored keys.
+    # Entries are stored under lower-case keys, so that a look-up is a single hash.
+    #   The name that each key was last stored under is kept to one side, so that
+    #   listing the keys (e.g. to pass headers along) gives them as they were given.
     # This particular version also makes the assumption all stored values will be strings.
     def __init__(s, src = None):
+        super(CaselessDict, s).__init__()
+        s.names = {}
         if src:
             for k in list(src.keys()):
                 s[k] = src[k]
-        super(CaselessDict, s).__init__()
 
     def __contains__(s, key):
-        return key.lower() in [k.lower() for k in list(s.keys())]
+        return super(CaselessDict, s).__contains__(key.lower())
+
+    def __delitem__(s, key):
+        super(CaselessDict, s).__delitem__(key.lower())
+        del s.names[key.lower()]
+
+    def __iter__(s):
+        return iter(list(s.names.values()))
 
-    # Credit for __getitem__/__setitem__:
     def __setitem__(s, key, val):
-        if s.__contains__(key):
-            for old in [k for k in list(s.keys()) if k.lower() == key.lower()]:
-                del s[old]
-        super(CaselessDict, s).__setitem__(key, val.strip())
+        s.names[key.lower()] = key
+        super(CaselessDict, s).__setitem__(key.lower(), val.strip())
 
     def get(s, key, default = ""):
-        # Get the first (and hopefully only) key match.
-        keys = [k for k in list(s.keys()) if k.lower() == key.lower()]
-        if not keys:
-            return default
-        return super(CaselessDict, s).get(keys[0])
+        return super(CaselessDict, s).get(key.lower(), default)
 
     __getitem__ = get
 
+    def items(s):
+        return [(name, s.get(name)) for name in s.names.values()]
+
+    def keys(s):
+        return list(s.names.values())
+
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
-    REGEX_INET4_CIDR='^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
+    # Rules are compiled into sorted, non-overlapping (start, end) ranges of integers and
+    #  checked with a binary search, so a check costs the same for 10 rules as for 100,000.
+    # Addresses live in IPv6 space, with IPv4 mapped into ::ffff:0:0/96, so that one set
+    #  of ranges covers both families (and IPv4-mapped clients on dual-stack sockets).
+
+    # Decisions are remembered per address string, up to this many addresses.
+    CACHE_SIZE = 65536
+    IPV4_MAPPED = 0xffff << 32
 
     def __init__(self):
         self.errors = []
-        self.allowed_addresses = []
-        self.allowed_networks = []
-        self.denied_addresses = []
-        self.denied_networks = []
-
-    def add_access(self, addr_list, net_list, candidate):
-        candidate = candidate.strip()
-        if re.match(self.REGEX_INET4_CIDR, candidate):
-            good, net, bits = self.ip_validate_cidr(candidate)
-            if good:
-                # No error
-                net_list.append((candidate, net, bits))
+        # Rules are (candidate, resolved address, start, end, source file) tuples.
+        self.allowed = []
+        self.denied = []
+        # Calls that built the rules, replayed by reload()
+        self.sources = []
+        self.compiled = None
+
+    def add_access(self, rules, candidate, path = None):
+        # Comments and blank lines are allowed, mostly for the benefit of access files.
+        candidate = candidate.split('#', 1)[0].strip()
+        if not candidate:
+            return True
+
+        address, slash, bits = candidate.partition('/')
+        try:
+            resolved = address
+            value, width = self.ip_ston(address)
+        except (OSError, ValueError):
+            try:
+                resolved = socket.gethostbyname(address)
+                value, width = self.ip_ston(resolved)
+            except (OSError, ValueError):
+                if slash:
+                    self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
+                else:
+                    self.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
+                return False
+
+        if slash:
+            if not bits.isdigit() or int(bits) > width:
+                self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
+                return False
+            host_bits = width - int(bits)
         else:
-            good, a, astr = self.ip_validate_address(candidate)
-            if good:
-                # No error
-                addr_list.append((a, candidate, astr))
-        return good
+            host_bits = 0
+
+        start = value >> host_bits << host_bits
+        rules.append((candidate, resolved, start, start | ((1 << host_bits) - 1), path))
+        self.compiled = None
+        return True
 
     def add_blacklist(self, candidate):
-        return self.add_access(self.denied_addresses, self.denied_networks, candidate)
+        self.sources.append(('add_blacklist', candidate))
+        return self.add_access(self.denied, candidate)
 
     def add_whitelist(self, candidate):
-        return self.add_access(self.allowed_addresses, self.allowed_networks, candidate)
+        self.sources.append(('add_whitelist', candidate))
+        return self.add_access(self.allowed, candidate)
 
     def announce_filter_actions(self):
-        for action, address_list, network_list in [("Allowing", self.allowed_addresses, self.allowed_networks), ("Denying", self.denied_addresses, self.denied_networks)]:
-            l = []
-            l.extend([("address", s, i) for n, s, i in address_list])
-            l.extend([("network", s, s) for n, s in network_list])
-
-            for title, ip, address in l:
-                if ip == address:
-                    print_notice("%s %s: %s" % (action, title, colour_text(address, COLOUR_GREEN)))
+        for action, rules in [("Allowing", self.allowed), ("Denying", self.denied)]:
+            files = []
+            for candidate, resolved, start, end, path in rules:
+                if path:
+                    # Access files can be very large, so they are summarized instead.
+                    if path not in files:
+                        files.append(path)
+                    continue
+
+                title = "address"
+                if '/' in candidate:
+                    title = "network"
+
+                if candidate.partition('/')[0] == resolved:
+                    print_notice("%s %s: %s" % (action, title, colour_text(candidate, COLOUR_GREEN)))
                 else:
-                    print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
+                    print_notice("%s %s: %s (%s)" % (action, title, colour_text(candidate, COLOUR_GREEN), colour_text(resolved, COLOUR_GREEN)))
+
+            for path in files:
+                count = len([r for r in rules if r[4] == path])
+                print_notice("%s %s addresses/ranges from file: %s" % (action, colour_text(count), colour_text(path, COLOUR_GREEN)))
+
+    def compile(self):
+        self.compiled = (self.compile_ranges(self.allowed), self.compile_ranges(self.denied), {})
+        return self.compiled
+
+    def compile_ranges(self, rules):
+        # Merge overlapping and adjacent ranges into parallel lists of starts and ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(r[2], r[3]) for r in rules]):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return (starts, ends)
+
+    def in_ranges(self, ranges, ip):
+        i = bisect.bisect_right(ranges[0], ip) - 1
+        return i >= 0 and ip <= ranges[1][i]
 
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
@@ -1405,74 +2377,85 @@ class NetAccess:
         a,b,c,d = struct.unpack('BBBB', socket.inet_aton(ip))
         return (a << 24) + (b << 16) + (c << 8) + d
 
-    def ip_validate_address(self, candidate):
-        try:
-            ip = socket.gethostbyname(candidate)
-            return (True, self.ip_strton(ip), ip)
-        except socket.gaierror:
-            self.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
-            return (False, None, None)
+    def ip_ston(self, address):
+        # Convert an IPv4 or IPv6 address string to an integer in IPv6 space,
+        #  along with the number of bits in the address family.
+        if ':' in address:
+            # Drop any zone index (e.g. fe80::1%eth0)
+            address = address.split('%', 1)[0]
+            return (int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, address)), 16), 128)
+        return (self.IPV4_MAPPED | int(binascii.hexlify(socket.inet_pton(socket.AF_INET, address)), 16), 32)
+
+    def is_allowed(self, address):
+        # Blacklist/Whitelist filtering
+        # A blacklist rule one-ups a whitelist rule in the event of a conflict.
+        allowed, denied, cache = self.compiled or self.compile()
+        if not allowed[0] and not denied[0]:
+            return True
 
-    def ip_validate_cidr(self, candidate):
-        a = candidate.split("/")[0]
-        m = int(candidate.split("/")[1])
+        result = cache.get(address)
+        if result is not None:
+            return result
 
         try:
-            # Will either succeed or throw an exception
-            ip = self.ip_strton(socket.gethostbyname(a))
-            if m <= 32:
-                return (True, ip, 32 - m)
-        except socket.gaierror:
-            pass
-        self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
-        return (False, None, None)
+            ip = self.ip_ston(address)[0]
+        except (OSError, ValueError):
+            # Not an address that any rule could match.
+            ip = -1
 
-    def is_allowed(self, address):
-        # Blacklist/Whitelist filtering
-        allowed = True
-
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
-            # Compare string-form against allowed addresses
-            if address in [a[2] for a in self.allowed_addresses]:
-                allowed = True
-            else:
-                # Try checking allowed networks
-                ip = self.ip_strton(address)
-                for net, bits in [(n[1], n[2]) for n in self.allowed_networks]:
-                    if (net >> bits) == (ip >> bits):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
-            # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
-
-            if address in [a[2] for a in self.denied_addresses]:
-                allowed = False
-            else:
-                # Try checking denied networks
-                ip = self.ip_strton(address)
-                for net, bits in [(n[1], n[2]) for n in self.denied_networks]:
-                    if (net >> bits) == (ip >> bits):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(self, fn, path, header):
+        # Whitelist processing, address is not allowed until it is cleared.
+        result = (not allowed[0] or self.in_ranges(allowed, ip)) and not self.in_ranges(denied, ip)
+
+        if len(cache) >= self.CACHE_SIZE:
+            cache.clear()
+        cache[address] = result
+        return result
+
+    def load_access_file(self, rules, path, header):
         if not os.path.isfile(path):
             self.errors.append("Path to %s file does not exist: %s" % (header, colour_text(path, COLOUR_GREEN)))
             return False
         with open(path) as f:
-            for l in f.readlines():
-                fn(l)
+            for l in f:
+                self.add_access(rules, l, path)
+        return True
 
     def load_blacklist_file(self, path):
-        return self.load_access_file(self.add_blacklist, path, "blacklist")
+        self.sources.append(('load_blacklist_file', path))
+        return self.load_access_file(self.denied, path, "blacklist")
 
     def load_whitelist_file(self, path):
-        return self.load_access_file(self.add_whitelist, path, "whitelist")
+        self.sources.append(('load_whitelist_file', path))
+        return self.load_access_file(self.allowed, path, "whitelist")
+
+    def reload(self):
+        # Rebuild the rules from the same addresses and files that they were first loaded from.
+        # The new rules replace the old ones in one step, and only if all of them loaded cleanly.
+        # Returns a list of errors, which is empty on success.
+        fresh = type(self)()
+        for method, value in self.sources:
+            getattr(fresh, method)(value)
+        if fresh.errors:
+            return fresh.errors
+
+        compiled = fresh.compile()
+        self.allowed = fresh.allowed
+        self.denied = fresh.denied
+        self.compiled = compiled
+        return []
+
+    def reload_on_signal(self, signum = signal.SIGHUP):
+        # Reload rules whenever the process receives a signal (SIGHUP by default).
+        # Signal handlers can only be set from the main thread.
+        def handler(signum, frame):
+            errors = self.reload()
+            for e in errors:
+                print_error(e)
+            if errors:
+                print_warning("Keeping the previous access rules.")
+            else:
+                print_notice("Reloaded access rules.")
+        signal.signal(signum, handler)
 
 class SimpleAuthStore:
     def __init__(self, user, password):
@@ -1486,31 +2469,248 @@ class SimpleAuthStore:
             return AUTH_BAD_PASSWORD
         return AUTH_BAD_NOT_FOUND
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+class ThreadedHTTPServer(HTTPServer):
+    """
+    Handle connections with a fixed pool of worker threads.
+
+    A connection only goes to a worker once it has sent a complete request line and
+    headers. Until then, new connections and kept-alive connections between requests
+    wait together on a single thread, so clients that are idle or slow to send a request
+    (e.g. slowloris) do not tie up the workers. A request that does not arrive in full
+    within the timeout is dropped.
+
+    At most max_connections connections are served, waiting on a request, or waiting in
+    the queue for a worker. Past that, the longest-idle connection is closed to make room;
+    if none are idle, the new client is sent a 503 response and disconnected, so a burst
+    of clients cannot pile up threads and memory.
+    If no workers are requested, every request is instead given its own thread, still within max_connections.
+    """
 
     attempts = {}
-    requests = {}
     alive = True
+    # Whether kept-alive connections can be handed back to wait on their next request.
+    parking = False
+    # Seconds between checks for connections that have waited too long on a request.
+    sweep_interval = 1
+
+    # Sent to clients that cannot be taken in.
+    overload_response = convert_bytes("HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    # Sent to clients that started on a request but did not finish it in time.
+    timeout_response = convert_bytes("HTTP/1.1 408 Request Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+
+    def __init__(self, server_address, handler, workers = DEFAULT_WORKERS, max_connections = DEFAULT_MAX_CONNECTIONS, timeout = DEFAULT_TIMEOUT):
+        HTTPServer.__init__(self, server_address, handler)
+        self.requests = {}
+        self.shed = 0
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.queue = Queue()
+        self.request_timeout = timeout
+
+        self.workers = []
+        for i in range(min(workers, max_connections)):
+            t = threading.Thread(target = self.process_request_worker)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+        # Connections waiting on a request, by file descriptor.
+        self.parked = {}
+        # Connections handed over by other threads, for the polling thread to take in.
+        self.arrivals = []
+        self.lock = threading.Lock()
+        self.selector = None
+        if selectors:
+            self.parking = True
+            self.selector = selectors.DefaultSelector()
+            self.wake_recv, self.wake_send = socket.socketpair()
+            self.wake_recv.setblocking(False)
+            self.selector.register(self.wake_recv, selectors.EVENT_READ)
+            t = threading.Thread(target = self.poll_connections)
+            t.daemon = True
+            t.start()
+
+    def dispatch(self, request, client_address, reader):
+        # Hand a connection with a complete request to a worker.
+        if self.workers:
+            return self.queue.put((request, client_address, reader))
+
+        t = threading.Thread(target = self.process_request_thread, args = (request, client_address, reader))
+        t.daemon = True
+        t.start()
+
+    def drop_connection(self, request):
+        self.shutdown_request(request)
+        self.slots.release()
+
+    def drop_idle_connection(self):
+        # Close the connection that has waited longest without starting on a request.
+        idle = [c for c in self.parked.values() if not c[2].pending()]
+        if not idle:
+            return False
+        conn = min(idle, key = lambda c: c[4])
+        self.unpark(conn)
+        self.drop_connection(conn[0])
+        return True
 
-    def finish_request(self, request, client_address):
-        """Finish one request by instantiating RequestHandlerClass."""
+    def expire_connections(self):
+        # Returns True if any connections were dropped.
+        now = time.time()
+        expired = [c for c in self.parked.values() if c[3] <= now]
+        for conn in expired:
+            request, client_address, reader = conn[:3]
+            self.unpark(conn)
+            if reader.pending():
+                # Partway through a request. An idle connection is closed without a word.
+                self.send_nowait(request, self.timeout_response)
+            self.drop_connection(request)
+        return bool(expired)
+
+    def finish_request(self, request, client_address, reader = None):
+        """Finish one request by instantiating RequestHandlerClass.
+        Returns the reader of the connection if it is to wait on another request, or None.
+        """
 
         if not self.alive:
-            return
+            return None
 
-        req = self.RequestHandlerClass(request, client_address, self)
-        if sys.version_info[0] == 2:
-            req.rfile._sock.settimeout(args[TITLE_TIMEOUT])
+        req = self.RequestHandlerClass(request, client_address, self, reader)
 
-        self.requests[client_address] = req
-        req.run()
-        del self.requests[client_address]
+        # Keyed by handler, a client address can have several connections,
+        #   and a connection can be picked up by another handler as soon as it is parked.
+        self.requests[req] = True
+        try:
+            req.run()
+        finally:
+            del self.requests[req]
+        if req.parked:
+            return req.rfile
+        return None
 
     def kill_requests(self):
         self.alive = False
-        for client_address in list(self.requests.keys()):
-            self.requests[client_address].alive = False
+        for req in list(self.requests.keys()):
+            req.alive = False
+
+    def park(self, request, client_address, reader):
+        """Have the polling thread wait on a connection's next request.
+        Returns False if there is no polling thread to do so.
+        """
+        if not self.selector:
+            return False
+        with self.lock:
+            self.arrivals.append((request, client_address, reader))
+        try:
+            self.wake_send.send(b'\0')
+        except (IOError, OSError, socket.error):
+            # Already due to wake up.
+            pass
+        return True
+
+    def poll_arrival(self, request, client_address, reader):
+        if reader is None:
+            # New connection while at the connection limit.
+            if not ((self.drop_idle_connection() or self.expire_connections()) and self.slots.acquire(False)):
+                return self.shed_request(request, client_address)
+            reader = ConnectionReader(request)
+
+        if reader.has_request():
+            # E.g. pipelined requests
+            return self.dispatch(request, client_address, reader)
+
+        now = time.time()
+        # [socket, address, reader, deadline, parked since]
+        conn = [request, client_address, reader, now + self.request_timeout, now]
+        try:
+            self.selector.register(request, selectors.EVENT_READ, conn)
+        except (IOError, OSError, ValueError):
+            # Closed in the meantime.
+            return self.drop_connection(request)
+        self.parked[request.fileno()] = conn
+
+    def poll_connection(self, conn):
+        request, client_address, reader = conn[:3]
+        started = reader.pending() > 0
+        if not reader.read_nowait():
+            self.unpark(conn)
+            return self.drop_connection(request)
+        if not started and reader.pending():
+            # The request has begun, and must arrive in full within the timeout.
+            conn[3] = time.time() + self.request_timeout
+        if reader.has_request():
+            self.unpark(conn)
+            self.dispatch(request, client_address, reader)
+
+    def poll_connections(self):
+        # Wait on connections without a complete request yet, passing each on once it has one.
+        next_sweep = time.time() + self.sweep_interval
+        while self.alive:
+            for key, mask in self.selector.select(1):
+                if key.fileobj is self.wake_recv:
+                    try:
+                        self.wake_recv.recv(4096)
+                    except (IOError, OSError, socket.error):
+                        pass
+                else:
+                    self.poll_connection(key.data)
+
+            with self.lock:
+                arrivals, self.arrivals = self.arrivals, []
+            for request, client_address, reader in arrivals:
+                self.poll_arrival(request, client_address, reader)
+
+            if time.time() >= next_sweep:
+                self.expire_connections()
+                next_sweep = time.time() + self.sweep_interval
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(False):
+            if self.park(request, client_address, None):
+                # The polling thread may be able to make room by closing an idle connection.
+                return
+            return self.shed_request(request, client_address)
+
+        reader = ConnectionReader(request)
+        if not self.park(request, client_address, reader):
+            self.dispatch(request, client_address, reader)
+
+    def process_request_thread(self, request, client_address, reader = None):
+        parked = None
+        try:
+            parked = self.finish_request(request, client_address, reader)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            # Only handed back once the handler is entirely done with it.
+            if not (parked and self.park(request, client_address, parked)):
+                self.drop_connection(request)
+
+    def process_request_worker(self):
+        while True:
+            request, client_address, reader = self.queue.get()
+            self.process_request_thread(request, client_address, reader)
+
+    def send_nowait(self, request, data):
+        try:
+            request.setblocking(False)
+            request.send(data)
+        except (IOError, OSError, socket.error):
+            pass
+
+    def shed_request(self, request, client_address):
+        # Answer without waiting on the client, the accepting thread cannot afford to block.
+        self.shed += 1
+        self.send_nowait(request, self.overload_response)
+        self.shutdown_request(request)
+
+    def unpark(self, conn):
+        del self.parked[conn[0].fileno()]
+        self.selector.unregister(conn[0])
+
+    def verify_request(self, request, client_address):
+        # Turn away clients that are not allowed by access rules before a thread is started for them.
+        return access.is_allowed(client_address[0])
 
 access = NetAccess()
+access_log = AccessLog()
+compression_cache = CompressionCache(DEFAULT_COMPRESSION_CACHE)
 authentication_stores = []
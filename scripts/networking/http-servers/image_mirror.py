@@ -4,27 +4,81 @@
 # This is a more independent version of a Django application that I kludged together for quickly browsing images from another machine.
 
 from __future__ import print_function
-import getopt, os, socket, sys, tempfile, urllib
+import getopt, os, socket, struct, sys, tempfile, threading, urllib
 import CoreHttpServer as common
 common.local_files.append(os.path.realpath(__file__))
 
 # Used specifically by the image mirror
-import getpass, posixpath, re
+import getpass, hashlib, multiprocessing, posixpath, re, signal
+from collections import OrderedDict
 from random import randint
 
 if sys.version_info[0] == 2:
+    from Queue import Queue
+    from urllib import quote
     from urlparse import unquote
 else:
-    from urllib.parse import unquote
+    from queue import Queue
+    from urllib.parse import quote, unquote
 
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow, originals are served in place of thumbnails.
+    Image = None
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2, without the scandir backport.
+    class _DirEntry:
+        def __init__(self, path, name):
+            self.name = name
+            self.path = os.path.join(path, name)
+
+        def is_dir(self):
+            return os.path.isdir(self.path)
+
+    def scandir(path):
+        return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+TITLE_THUMB_CACHE_SIZE = "thumb-cache-size"
+TITLE_THUMB_WORKERS = "thumb-workers"
+DEFAULT_THUMB_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_THUMB_WORKERS = multiprocessing.cpu_count()
+
+common.args.add_opt(common.OPT_TYPE_LONG, TITLE_THUMB_CACHE_SIZE, TITLE_THUMB_CACHE_SIZE, "Bytes of generated thumbnails to keep on disk.", converter = int, default = DEFAULT_THUMB_CACHE_SIZE, default_announce = True)
+common.args.add_opt(common.OPT_TYPE_LONG, TITLE_THUMB_WORKERS, TITLE_THUMB_WORKERS, "Processes generating thumbnails (0 to serve originals instead).", converter = int, default = DEFAULT_THUMB_WORKERS, default_announce = True)
 
 # Remove unused arguments
 common.args.add_validator(common.validate_common_directory) # Validate directory.
 
+def validate_thumbnails(self):
+    errors = []
+    if self[TITLE_THUMB_CACHE_SIZE] < 0:
+        errors.append("Thumbnail cache size must be greater than or equal to 0. Given: %s" % common.colour_text(self[TITLE_THUMB_CACHE_SIZE]))
+    if self[TITLE_THUMB_WORKERS] < 0:
+        errors.append("Thumbnail worker count must be greater than or equal to 0. Given: %s" % common.colour_text(self[TITLE_THUMB_WORKERS]))
+    return errors
+common.args.add_validator(validate_thumbnails)
+
 # Common fields
 
 image_extensions = ('.png','.jpg', '.jpeg', '.gif')
 
+# An index starts with a count of its pages, followed by a fixed-width record
+#   for each page: offset of the page's line in the index file, then the first
+#   and last pages of the page's directory.
+# A final record holds the offset of the end of the last line.
+index_header = struct.Struct('<Q')
+index_record = struct.Struct('<QII')
+
+# Thumbnails are made in a few fixed sizes (the longest side, in pixels),
+#   so that the cache is not filled with near-duplicates.
+thumb_sizes = (128, 256, 512, 1024)
+thumb_size_default = 256
+
 # Functions and Classes
 
 # Browser
@@ -38,17 +92,17 @@ class BrowseController:
 
     def getContents(self):
         l = [] # List of sub-directories.
-        c = 0 # Count of images.
+        images = [] # List of images, in the same order as they are indexed for viewing.
         try:
             for currentFile in sorted(os.listdir(self.realPath), key=lambda s: s.lower()):
                 candidate = [ "%s/%s" % tuple([self.realPath,currentFile]), re.sub(r'^\/*','',"%s/%s" % tuple([self.path,currentFile])),currentFile ]
                 if os.path.isdir(candidate[0]):
                     l.append(candidate)
                 elif os.path.isfile(candidate[0]) and candidate[0].lower().endswith(image_extensions):
-                    c = c + 1
+                    images.append(candidate)
         except Exception as e:
             pass
-        return l, c
+        return l, images
 
 # Viewer
 class ViewController:
@@ -68,12 +122,6 @@ class ViewController:
     def __get_indexFile(self):
         return os.path.join(self.indexDir, self.directoryId)
 
-    def __get_tallyDir(self):
-        return os.path.join(self.tempDir, 'indices')
-
-    def __get_tallyFile(self):
-        return os.path.join(self.tallyDir, self.directoryId)
-
     def __init__(self, baseDirectory, relativeDirectory, tempDir, forceRefresh = False, testState = False):
 
         self.baseDirectory = baseDirectory
@@ -81,6 +129,7 @@ class ViewController:
         self.forceRefresh = forceRefresh
         self.tempDir = tempDir
 
+        self.index = None
         self.tally = None
         self.makeStructure()
 
@@ -91,6 +140,7 @@ class ViewController:
 
         try:
             self.makeIndex()
+            self.openIndex()
             self.valid = True
         except Exception as e:
             self.valid = False
@@ -99,88 +149,80 @@ class ViewController:
     directoryId = property(__get_directoryId)
     indexDir = property(__get_indexDir)
     indexFile = property(__get_indexFile)
-    tallyDir = property(__get_tallyDir)
-    tallyFile = property(__get_tallyFile)
+
+    def close(self):
+        if self.index:
+            self.index.close()
+            self.index = None
 
     def getFilePath(self,targetIndex):
         # Get the file path stored at the 'targetIndex'-th line of the file (very first line is '1')
         line = ''
 
-        # The benefit of having a tally is that we don't need to read all the way through a file to know if we're requesting a valid index.
+        # The benefit of having a tally is that we don't need to read through a file to know if we're requesting a valid index.
         if targetIndex < 1 or targetIndex > self.getTally():
             return line
 
-        # confirm initialized values
-        previousDirIndex = 0 # Index of first indexed image in previous directory
-        currentDir = ""
-        currentDirIndex = 0 # Index of first indexed image in current directory
         # Reminder: An INDEX includes a zero value, but a PAGE does not
-
-        # TODO: There has to be a build-in method for getting an arbitrary line from a text file without this cycling.
-        # TODO: Directory cycling is still not working quite right. Need to take another look at how this is done at the beginning/end of each file.
-        with open(self.indexFile,'r') as fin:
-            currentIndex = 0
-            lastDir = ""
-            while currentIndex < targetIndex:
-                line = fin.readline()
-                currentIndex = currentIndex + 1
-
-                # Get directory
-                lineDir = os.path.dirname(line)
-
-                # If our current line's directory is different than
-                #   the previous directory, then throw out the
-                #   old previous and mark the current as the new previous.
-                if currentDir != lastDir:
-                    self.previousDirIndex = currentDirIndex
-                    # Note the index of the current directory.
-                    currentDir=lineDir
-                    currentDirIndex = currentIndex
-
-                lastDir = lineDir
-                continue
-
-            targetDir = lineDir
-
-            # We are also noting directories, so
-            #     continue until we reach a different directory or the last index
-            while currentIndex < self.getTally():
-                lineDir = os.path.dirname(fin.readline())
-                if lineDir != targetDir:
-                    self.nextDirIndex = currentIndex + 1
-                    break
-                currentIndex = currentIndex + 1
-                lastDir = lineDir
-            fin.close()
-            return line.strip()
-
-    def getImages(self, dir_path):
-        directories = [(dir_path,0)]
+        # Records are fixed-width, so the record for any page (and the directory
+        #   boundaries around it) can be read directly without going through the index.
+        size = index_record.size
+        self.index.seek(index_header.size + (targetIndex - 1) * size)
+        offset, dirStart, dirEnd = index_record.unpack(self.index.read(size))
+        # The next record's offset marks the end of this line.
+        nextOffset = index_record.unpack(self.index.read(size))[0]
+
+        if dirStart > 1:
+            # Start of the directory that ends just before this one.
+            self.index.seek(index_header.size + (dirStart - 2) * size)
+            self.previousDirIndex = index_record.unpack(self.index.read(size))[1]
+
+        if dirEnd < self.getTally():
+            self.nextDirIndex = dirEnd + 1
+
+        self.index.seek(offset)
+        line = common.convert_str(self.index.read(nextOffset - offset))
+        return line.strip()
+
+    def getImages(self, dir_path, listings):
+        # Returns a (directory, image names) pair for each directory with images in it.
+        # Listings of directories are kept between builds as (mtime, image names, sub-directories).
+        # Only directories that have changed since they were last listed are listed again,
+        #   and listings of directories that were not reached this time are dropped.
+        directories = [dir_path]
         # Track visited directories
         # We will be following symbolic links,
         #   but we do not want to revisit the same directory twice or more.
         # This also avoids loops.
-        visited_directories = []
+        visited_directories = set()
 
         # list of values to be returned
         images = []
+        listed = set()
 
-        for root, depth in directories:
-            if root in visited_directories:
+        for root in directories:
+            real_root = os.path.realpath(root)
+            if real_root in visited_directories:
                 # Skip visited directory
                 continue
-            visited_directories.append(os.path.realpath(root))
+            visited_directories.add(real_root)
             try:
-                for current_file in sorted(os.listdir(root), key= lambda d: d.lower()):
-                    candidate = "%s/%s" % (root, current_file)
-                    if os.path.isdir(candidate):
-                        directories.append((candidate,depth+1))
-                    elif self.isImage(candidate):
-                        images.append(candidate)
+                mtime = os.stat(root).st_mtime
+                listing = listings.get(root)
+                if not listing or listing[0] != mtime:
+                    listing = (mtime,) + self.listDirectory(root)
+                    listings[root] = listing
+                listed.add(root)
             except OSError as e:
                 # Ignore OS Errors for the moment.
                 common.print_exception(e)
-                pass
+                continue
+            if listing[1]:
+                images.append((root, listing[1]))
+            directories.extend(listing[2])
+
+        for root in [r for r in listings if r not in listed]:
+            del listings[root]
         return images
 
     def getRandomIndex(self):
@@ -193,21 +235,8 @@ class ViewController:
         return randint(1,tally)
 
     def getTally(self):
-        # Get our tally count right from the file.
-
-        # Use the stored tally if available.
-        if self.tally is not None:
-            return self.tally
-
-        try:
-            with open(self.tallyFile,'r') as fin:
-                tally = int(fin.readline())
-                fin.close()
-            self.tally = tally
-            return tally
-        except:
-            # If there's any sort of error, just return '0' for now.
-            return 0
+        # Get our tally count, read from the head of the index when it was opened.
+        return self.tally or 0
 
     def isImage(self,fileName):
         # Crude check to see if the given file name is an image (or some other type that can be immediately rendered in a browser).
@@ -215,6 +244,17 @@ class ViewController:
             return True
         return False
 
+    def listDirectory(self, root):
+        images = []
+        directories = []
+        for entry in sorted(scandir(root), key = lambda e: e.name.lower()):
+            candidate = "%s/%s" % (root, entry.name)
+            if entry.is_dir():
+                directories.append(candidate)
+            elif self.isImage(candidate):
+                images.append(entry.name)
+        return images, directories
+
     def makeIndex(self):
         if not self.directoryId:
             return False
@@ -224,33 +264,237 @@ class ViewController:
         # Do not generate an index unless there is an explicit need to do so,
         #     as this gets to be more than a bit time-consuming with deeper image directories.
         # This is the reason that we have the index in the first place, and why we store it in tmpfs: To try and make the monster move as quickly as possible.
-        if not self.forceRefresh and os.path.isfile(self.tallyFile) and os.path.isfile(self.indexFile):
+        exists = os.path.isfile(self.indexFile)
+        if exists and not self.forceRefresh:
             return True
 
-        # At this point, we know we have to make an index because a refresh has been requested, or one of the necessary files is missing.
-
-        tally = 0
-        with open(self.indexFile,'w') as fout:
-            print(self.indexFile)
-            for image in self.getImages(self.directory):
-                # Strip out double-/, add a newline to the end, and strip away the base directory from the beginning.
-                # Line example: /comics/dc/wallpaper-123.png
-                line = re.sub(r'/{2,}', "/", "%s\n" % re.sub(r"^"+self.baseDirectory, "", image))
-                fout.write(line)
-                tally = tally + 1
-        # Place our count of images in a convenient place.
-        with open(self.tallyFile,'w') as fout:
-            # Newline is only for the benefit of debugging.
-            fout.write(str(tally) + "\n")
-            self.tally = tally
-
+        # Indexes are built in the background. A refresh keeps being served
+        #   from the old index until the new one is swapped in.
+        done = indexer.request(self)
+        if not exists:
+            # Nothing to serve from until the first build is done.
+            done.wait()
         return True
 
+    def openIndex(self):
+        # The index is opened once, so this view keeps reading from the same
+        #   index even if a rebuild replaces it in the meantime.
+        self.index = open(self.indexFile, 'rb')
+        self.tally = index_header.unpack(self.index.read(index_header.size))[0]
+
+    def writeIndex(self, listings):
+        # Write a new index and swap it in. Called from the IndexWorker thread.
+        # Index layout: the tally, a record for each page, a final record, and then the lines.
+
+        lines = []
+        dirStarts = []
+        for root, names in self.getImages(self.directory, listings):
+            # Strip out double-/ and strip away the base directory from the beginning.
+            # Done once for each directory, as the names of its images have no '/' of their own.
+            # Line example: /comics/dc/wallpaper-123.png
+            prefix = re.sub(r'/{2,}', "/", "%s/" % re.sub(r"^"+self.baseDirectory, "", root))
+            dirStart = len(lines) + 1
+            for name in names:
+                lines.append(common.convert_bytes("%s%s\n" % (prefix, name)))
+                dirStarts.append(dirStart)
+        tally = len(lines)
+
+        dirEnd = tally
+        dirEnds = [0] * tally
+        for i in range(tally - 1, -1, -1):
+            if i < tally - 1 and dirStarts[i + 1] != dirStarts[i]:
+                dirEnd = i + 1
+            dirEnds[i] = dirEnd
+
+        records = []
+        offset = index_header.size + (tally + 1) * index_record.size
+        for i in range(tally):
+            records.append(index_record.pack(offset, dirStarts[i], dirEnds[i]))
+            offset += len(lines[i])
+        records.append(index_record.pack(offset, 0, 0))
+
+        # Build under a temporary name, then swap in with a rename so that
+        #   a request never sees a partly written index.
+        indexTemp = "%s.%d" % (self.indexFile, os.getpid())
+        with open(indexTemp,'wb') as fout:
+            fout.write(index_header.pack(tally))
+            fout.write(b''.join(records))
+            fout.write(b''.join(lines))
+        os.rename(indexTemp, self.indexFile)
+
     def makeStructure(self):
         # Make sure that we have the proper directory structure.
-        for d in [i for i in [self.tallyDir, self.indexDir] if not os.path.isdir(i)]:
+        for d in [i for i in [self.indexDir] if not os.path.isdir(i)]:
             os.makedirs(d)
 
+class IndexWorker:
+    """
+    Builds indexes on a background thread, one at a time.
+    Directory listings are kept between builds, so that a rebuild only
+    lists directories whose modification time has changed.
+    """
+
+    # Indexed directories that listings are kept for, dropping the least recently built.
+    listing_roots = 16
+
+    def __init__(self):
+        # Listings by indexed directory, then by listed directory.
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.queue = Queue()
+        self.thread = None
+
+    def request(self, vc):
+        """Queue a build of an index, unless one is already queued.
+        Returns an Event that is set once the build is done.
+        """
+        with self.lock:
+            done = self.pending.get(vc.indexFile)
+            if done:
+                return done
+            done = self.pending[vc.indexFile] = threading.Event()
+            self.queue.put((vc, done))
+            if not self.thread:
+                self.thread = threading.Thread(target = self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        return done
+
+    def run(self):
+        while True:
+            vc, done = self.queue.get()
+            # Only ever touched from this thread.
+            listings = self.listings.pop(vc.directory, {})
+            self.listings[vc.directory] = listings
+            while len(self.listings) > self.listing_roots:
+                self.listings.popitem(last = False)
+            try:
+                vc.writeIndex(listings)
+            except Exception as e:
+                common.print_exception(e)
+            with self.lock:
+                del self.pending[vc.indexFile]
+            done.set()
+
+indexer = IndexWorker()
+
+# Thumbnails
+
+def ignore_interrupts():
+    # Pool processes leave Ctrl-C to the server.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def make_thumbnail(src, dst, size):
+    """Shrink an image to fit within size x size pixels. Runs in a pool process.
+    Returns the path of the thumbnail, or None if the original should be served instead.
+    """
+    temp = None
+    try:
+        with Image.open(src) as im:
+            if max(im.size) <= size:
+                # Already small enough.
+                return None
+            # Have JPEG images decoded at a reduced scale, rather than in full and then shrunk.
+            im.draft("RGB", (size, size))
+            im.thumbnail((size, size))
+            if im.mode in ("RGBA", "LA", "P"):
+                # Keep any transparency.
+                fmt, path = "PNG", dst + ".png"
+            else:
+                fmt, path = "JPEG", dst + ".jpg"
+                im = im.convert("RGB")
+            temp = "%s.%d" % (path, os.getpid())
+            im.save(temp, fmt)
+        if os.path.getsize(temp) >= os.path.getsize(src):
+            os.remove(temp)
+            return None
+        os.rename(temp, path)
+        return path
+    except Exception:
+        # Anything that Pillow cannot read can still be handed to the browser as-is.
+        if temp and os.path.isfile(temp):
+            os.remove(temp)
+        return None
+
+class ThumbnailCache:
+    """
+    Thumbnails made by a pool of processes and kept on disk, dropping the least
+    recently used ones to keep within a total size.
+    Thumbnails are keyed by the path, size and modification time of the original,
+    so an image that changes gets a new thumbnail.
+    """
+
+    def __init__(self, directory, limit, workers):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Values are (thumbnail path or None to serve the original, size on disk).
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.size = 0
+        self.pool = None
+        if Image and workers:
+            self.pool = multiprocessing.Pool(workers, ignore_interrupts)
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+
+    def get(self, path, size):
+        """Returns the path of a thumbnail for an image, or None if the original should be served instead."""
+        if not self.pool:
+            return None
+
+        fs = os.stat(path)
+        key = hashlib.sha1(common.convert_bytes("%s\0%d\0%r" % (path, size, fs.st_mtime))).hexdigest()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # Re-insert as most recently used.
+                self.entries[key] = entry
+                return entry[0]
+            result = self.pending.get(key)
+            if result is None:
+                # Requests for the same thumbnail share one job.
+                result = self.pending[key] = self.pool.apply_async(make_thumbnail, (path, os.path.join(self.directory, key), size), callback = lambda thumb: self.put(key, thumb))
+
+        try:
+            return result.get(common.args[common.TITLE_TIMEOUT])
+        except multiprocessing.TimeoutError:
+            # The pool is backed up. The thumbnail is still stored once done.
+            return None
+
+    def put(self, key, thumb):
+        # Called from the pool's result thread as each thumbnail is done.
+        #   Nothing may be raised from here, or that thread dies and no further results are delivered.
+        # Count every entry as at least a disk block, which also bounds the number of entries.
+        cost = 4096
+        if thumb:
+            try:
+                cost = max(os.path.getsize(thumb), cost)
+            except OSError:
+                # Removed from under the cache, serve the original instead.
+                thumb = None
+        with self.lock:
+            self.pending.pop(key, None)
+            self.entries[key] = (thumb, cost)
+            self.size += cost
+            while self.size > self.limit:
+                old_thumb, old_cost = self.entries.popitem(last = False)[1]
+                self.size -= old_cost
+                if old_thumb:
+                    try:
+                        os.remove(old_thumb)
+                    except OSError:
+                        # Already gone.
+                        pass
+
+thumbnails = None
+
 class ImageMirrorRequestHandler(common.CoreHttpServer):
 
     server_version = "CoreHttpServer (Image Serving)"
@@ -275,6 +519,8 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
         if mode == "image":
             target_path = "%s/%s" % (common.get_target(), relativePath)
             return self.serve_file(target_path)
+        elif mode == "thumb":
+            return self.handle_thumb(realPath)
         elif mode == "random":
             # If nothing is specified, boot them back to root browsing...
             if 'path' not in self.get:
@@ -347,13 +593,16 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
         """
         try:
             bc = BrowseController(common.get_target(), relativePath)
-            sub_directories, imageCount = bc.getContents()
+            sub_directories, images = bc.getContents()
         except os.error:
             self.send_error(404, "No permission to list directory")
             return None
 
-        contents = "<p class='title'>%s (%d direct images)</p>" % (relativePath, imageCount)
+        contents = "<p class='title'>%s (%d direct images)</p>" % (relativePath, len(images))
         contents += "<ul>\n%s\n          </ul>" % "\n".join(["            <li><a href='/browse/%s/'>%s</a> (<a href='/view?path=%s/'>View</a>)" % (entry[1], entry[2], entry[1]) for entry in sub_directories])
+        # Direct images come first in the directory's view, so the n-th image is on the n-th page.
+        # Thumbnails are only loaded as they are scrolled to.
+        contents += "<div class='thumbGrid'>\n%s\n          </div>" % "\n".join(["            <a href='/view?path=%s/&page=%d'><img class='thumb' loading='lazy' src='/thumb/%s?size=%d' title='%s'/></a>" % (relativePath, i + 1, quote(entry[1]), thumb_size_default, entry[2]) for i, entry in enumerate(images)])
         title = relativePath
         if not title:
             title = "."
@@ -365,7 +614,9 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
         path = self.get["path"][0]
 
         vc = ViewController(realPath, path, self.server.data, forceRefresh=(next(iter(self.get.get('action', [])), None) == "refresh"))
-        return self.send_redirect("/view?path=%s&page=%d&source=random" % (path, vc.getRandomIndex()))
+        page = vc.getRandomIndex()
+        vc.close()
+        return self.send_redirect("/view?path=%s&page=%d&source=random" % (path, page))
 
     def handle_view(self, realPath):
 
@@ -390,24 +641,28 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
             # If KeyError, then page was not provided.
             page = 1
 
-        # Get the path to our image from the index.
-        page_path = vc.getFilePath(page)
-
         # Get a tally of how many pages have been indexed in total.
         tally = vc.getTally()
 
         # Get the path to our image from the index.
         page_path = vc.getFilePath(page)
+        previousDirIndex, nextDirIndex = vc.previousDirIndex, vc.nextDirIndex
+
+        # Have the browser fetch the next image while this one is being looked at.
+        extra_headers = self.get_navigation_javascript()
+        if page < tally:
+            extra_headers += "<link rel='prefetch' href='/image%s'/>" % vc.getFilePath(page + 1)
+        vc.close()
 
         # Navigation links will be at both the top and bottom, so build them in Python.
         nav_links = []
         if page > 1:
             nav_links.append(('prev_link', '/view?path=%s&page=%d' % (path, page - 1), "PREVIOUS"))
-        if vc.previousDirIndex > 0:
-            nav_links.append(('prev_dir', '/view?path=%s&page=%d' % (path, vc.previousDirIndex), "LAST DIR"))
+        if previousDirIndex > 0:
+            nav_links.append(('prev_dir', '/view?path=%s&page=%d' % (path, previousDirIndex), "LAST DIR"))
         nav_links.append(('random_link', '/random?path=%s&origin=%d' % (path, page), "RANDOM"))
-        if vc.nextDirIndex > 0:
-            nav_links.append(('next_dir', '/view?path=%s&page=%d' % (path, vc.nextDirIndex), "NEXT DIR"))
+        if nextDirIndex > 0:
+            nav_links.append(('next_dir', '/view?path=%s&page=%d' % (path, nextDirIndex), "NEXT DIR"))
         if page < tally:
             nav_links.append(('next_link', '/view?path=%s&page=%d' % (path, page + 1), "NEXT"))
 
@@ -433,7 +688,24 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
         image_html += "</div>"
 
         path_html = "<p>Viewing: <strong>.%s</strong></p><p>Path: <strong>%s</strong></p><p>Image Dirs:%s</p>" % (page_path, os.path.realpath(common.get_target() + page_path), self.render_breadcrumbs(os.path.dirname(page_path), False))
-        return self.serve_content(self.render_page("Image: %s (%s)" % (os.path.basename(page_path), os.path.realpath(os.path.dirname(common.get_target() + page_path))), self.render_breadcrumbs(path), nav_html + image_html + nav_html + path_html, self.get_navigation_javascript()))
+        return self.serve_content(self.render_page("Image: %s (%s)" % (os.path.basename(page_path), os.path.realpath(os.path.dirname(common.get_target() + page_path))), self.render_breadcrumbs(path), nav_html + image_html + nav_html + path_html, extra_headers))
+
+    def handle_thumb(self, realPath):
+        if not (os.path.isfile(realPath) and realPath.lower().endswith(image_extensions)):
+            return self.send_error(404, "File not found.")
+
+        try:
+            size = int(self.get["size"][0])
+        except (KeyError, TypeError, ValueError):
+            size = thumb_size_default
+        # Round up to the nearest size that thumbnails are made in.
+        size = ([s for s in thumb_sizes if s >= size] or [thumb_sizes[-1]])[0]
+
+        thumb = thumbnails.get(realPath, size)
+        if thumb and os.path.isfile(thumb):
+            return self.serve_file(thumb)
+        # No thumbnail to be had, so pass the original through.
+        return self.serve_file(realPath)
 
     def render_breadcrumbs(self, path, trailer=True):
         current = "/browse/"
@@ -488,6 +760,17 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
       margin: auto;
     }
 
+    .thumbGrid {
+      margin-top: 15px;
+    }
+
+    .thumb {
+      max-width: 256px;
+      max-height: 256px;
+      margin: 4px;
+      vertical-align: middle;
+    }
+
     .largeImageWrapper {
       width: 100%%;
       padding: 0px;
@@ -545,13 +828,24 @@ class ImageMirrorRequestHandler(common.CoreHttpServer):
         return word, path, dir_path
 
 def run(args):
+    global thumbnails
     common.args.process(args)
 
     common.announce_common_arguments("Sharing images")
 
+    if not Image:
+        common.print_warning("Pillow is not installed. Serving originals in place of thumbnails.")
+    elif common.args[TITLE_THUMB_WORKERS]:
+        common.print_notice("Making thumbnails with %s processes, keeping up to %s bytes of them" % (common.colour_text(common.args[TITLE_THUMB_WORKERS]), common.colour_text(common.args[TITLE_THUMB_CACHE_SIZE])))
+
     with tempfile.TemporaryDirectory(prefix='image-mirror-%d-' % os.getpid()) as tempFilePath:
         os.chmod(tempFilePath, 0o700)
-        common.serve(ImageMirrorRequestHandler, data=tempFilePath)
+        # Start the pool before any threads, so that its processes are not forked from a threaded server.
+        thumbnails = ThumbnailCache(os.path.join(tempFilePath, 'thumbs'), common.args[TITLE_THUMB_CACHE_SIZE], common.args[TITLE_THUMB_WORKERS])
+        try:
+            common.serve(ImageMirrorRequestHandler, data=tempFilePath)
+        finally:
+            thumbnails.close()
 
 if __name__ == '__main__':
     run(sys.argv)
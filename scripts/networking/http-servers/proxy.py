@@ -1,43 +1,302 @@
 #!/usr/bin/env python
 
 import CoreHttpServer as common
-import getopt, mmap, os, re, shutil, sys
-from socket import error as SocketError
+import atexit, email.utils, getopt, mmap, os, re, select, shutil, sys, tempfile, threading, time
+from collections import OrderedDict
+from io import BytesIO
+from socket import error as SocketError, timeout as SocketTimeout
 
 if sys.version_info[0] == 2:
-    from urllib2 import build_opener, HTTPErrorProcessor, quote, Request, URLError
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib2 import quote
     from urlparse import urlsplit
 else:
-    from urllib.request import build_opener, HTTPErrorProcessor, Request
-    from urllib.error import URLError
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
     from urllib.parse import quote, urlsplit
 
 TITLE_TARGET = "proxy target"
 TITLE_MAX_LENGTH = "max-length"
+TITLE_POOL_SIZE = "pool-size"
+TITLE_CACHE_SIZE = "cache-size"
+TITLE_CACHE_DIR = "cache-dir"
+DEFAULT_POOL_SIZE = 16
+# Response codes that may be cached without explicit permission from the target.
+CACHEABLE_CODES = (200, 203, 300, 301, 404, 410)
+# Request methods that do not change anything on the target, leaving cached responses valid.
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+HOP_BY_HOP_HEADERS = ("connection", "content-length", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade")
 common.local_files.append(os.path.realpath(__file__))
 
 common.args.add_opt(common.OPT_TYPE_LONG, TITLE_MAX_LENGTH, TITLE_MAX_LENGTH, converter = int, description="Maximum content length.")
+common.args.add_opt(common.OPT_TYPE_LONG, TITLE_POOL_SIZE, TITLE_POOL_SIZE, "Idle connections to the target to keep open for reuse (0 to disable).", converter = int, default = DEFAULT_POOL_SIZE, default_announce = True)
+common.args.add_opt(common.OPT_TYPE_LONG, TITLE_CACHE_SIZE, TITLE_CACHE_SIZE, "Cache responses from the target in up to this many bytes (0 to disable).", converter = int, default = 0)
+common.args.add_opt(common.OPT_TYPE_LONG, TITLE_CACHE_DIR, TITLE_CACHE_DIR, "Directory to keep larger cached responses in, instead of memory.")
+
+class BodyError(Exception):
+    """A request body could not be relayed because of the client."""
+
+    def __init__(self, code, message):
+        super(BodyError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+class CacheEntry:
+    """
+    A response stored by ProxyCache, with what is needed
+    to tell whether it can still be served without asking the target.
+    """
+
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = []
+        # Body is held in memory, or in a file at path.
+        self.body = None
+        self.path = None
+        self.size = 0
+        self.update(headers)
+
+    def get_age(self):
+        return self.initial_age + time.time() - self.response_time
+
+    def get_cost(self):
+        return self.size + sum([len(k) + len(v) for k, v in self.headers])
+
+    def is_fresh(self, request_cc):
+        if self.no_cache or "no-cache" in request_cc:
+            return False
+        age = self.get_age()
+        max_age = get_seconds(request_cc, "max-age")
+        if max_age is not None and age > max_age:
+            return False
+        return age < self.lifetime
+
+    def is_validatable(self):
+        return bool(self.etag or self.last_modified)
+
+    def update(self, headers):
+        # Headers from a 304 response replace stored headers of the same name.
+        names = [k.lower() for k, v in headers]
+        self.headers = [(k, v) for k, v in self.headers if k.lower() not in names] + headers
+        self.response_time = time.time()
+
+        d = common.CaselessDict(dict(self.headers))
+        cc = parse_cache_control(d["Cache-Control"])
+        self.etag = d["ETag"]
+        self.last_modified = d["Last-Modified"]
+        self.no_cache = "no-cache" in cc
+        date = parse_http_date(d["Date"]) or self.response_time
+        try:
+            age = int(d["Age"] or 0)
+        except ValueError:
+            age = 0
+        self.initial_age = max(age, self.response_time - date, 0)
+        self.lifetime = get_lifetime(cc, d, date)
+
+class CacheWriter:
+    """Collects a response body on its way to the client, storing it once complete."""
+
+    def __init__(self, cache, path, headers, entry):
+        self.cache = cache
+        self.path = path
+        self.headers = headers
+        self.entry = entry
+        self.buf = BytesIO()
+        self.f = None
+        self.file_path = None
+
+    def abandon(self):
+        if self.f:
+            self.f.close()
+            os.remove(self.file_path)
+        self.cache = None
+
+    def close(self):
+        if not self.cache:
+            return
+        if self.f:
+            self.f.close()
+            self.entry.path = self.file_path
+        else:
+            self.entry.body = self.buf.getvalue()
+        self.cache.put(self.path, self.headers, self.entry)
+
+    def write(self, data):
+        if not self.cache:
+            return
+        self.entry.size += len(data)
+        if self.entry.size > self.cache.entry_limit:
+            return self.abandon()
+        if not self.f and self.cache.directory and self.entry.size > self.cache.memory_limit:
+            fd, self.file_path = tempfile.mkstemp(dir = self.cache.directory)
+            self.f = os.fdopen(fd, "wb")
+            self.f.write(self.buf.getvalue())
+            self.buf = None
+        (self.f or self.buf).write(data)
+
+class ProxyCache:
+    """
+    Responses from the target, dropping the least recently used
+    entries to keep within a total size.
+    Bodies are held in memory unless a directory is given, in which case
+    all but small bodies are kept in files.
+    """
+
+    memory_limit = 64*1024
+
+    def __init__(self, limit, directory = None):
+        self.entries = OrderedDict()
+        # Request headers that responses for a path vary on, and a count of entries for the path.
+        self.vary = {}
+        self.limit = limit
+        # No one response may take more than a quarter of the cache.
+        self.entry_limit = limit // 4
+        self.lock = threading.Lock()
+        self.size = 0
+        self.directory = None
+        if directory:
+            self.directory = tempfile.mkdtemp(prefix = "proxy-cache-", dir = directory)
+            atexit.register(shutil.rmtree, self.directory, True)
+
+    def get(self, path, headers):
+        with self.lock:
+            names = self.vary.get(path, ((), 0))[0]
+            key = self.get_key(path, headers, names)
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # Re-insert as most recently used.
+                self.entries[key] = entry
+            return entry
+
+    def get_key(self, path, headers, names):
+        return (path,) + tuple([" ".join(headers.get(n).split()) for n in names])
+
+    def invalidate(self, path):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == path]:
+                self.remove(key)
+
+    def is_storable(self, headers, request_cc, resp):
+        if resp.status not in CACHEABLE_CODES or "no-store" in request_cc:
+            return False
+        cc = parse_cache_control(resp.getheader("Cache-Control", ""))
+        if "no-store" in cc or "private" in cc:
+            return False
+        if resp.getheader("Vary", "").strip() == "*" or resp.getheader("Set-Cookie"):
+            return False
+        if headers["Authorization"] and not [d for d in ("public", "s-maxage", "must-revalidate") if d in cc]:
+            # Responses to authenticated requests are for the requester's eyes only, unless the target says otherwise.
+            return False
+        length = resp.getheader("Content-Length", "")
+        return not (length.isdigit() and int(length) > self.entry_limit)
+
+    def open(self, entry):
+        if entry.path is None:
+            return BytesIO(entry.body)
+        try:
+            return open(entry.path, "rb")
+        except IOError:
+            # Evicted since it was looked up.
+            return None
+
+    def put(self, path, headers, entry):
+        d = common.CaselessDict(dict(entry.headers))
+        names = tuple([n.strip().lower() for n in d["Vary"].split(",") if n.strip()])
+        with self.lock:
+            key = self.get_key(path, headers, names)
+            self.remove(key)
+            self.vary[path] = (names, self.vary.get(path, ((), 0))[1] + 1)
+            self.entries[key] = entry
+            self.size += entry.get_cost()
+            while self.size > self.limit:
+                self.remove(next(iter(self.entries)))
+
+    def refresh(self, entry, headers):
+        with self.lock:
+            self.size -= entry.get_cost()
+            entry.update(headers)
+            self.size += entry.get_cost()
+
+    def remove(self, key):
+        # Lock must be held by the caller.
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.get_cost()
+        names, count = self.vary[key[0]]
+        if count > 1:
+            self.vary[key[0]] = (names, count - 1)
+        else:
+            del self.vary[key[0]]
+        if entry.path:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def writer(self, path, headers, entry):
+        return CacheWriter(self, path, headers, entry)
+
+class UpstreamPool:
+    """
+    Keeps idle keep-alive connections to the proxy target for reuse,
+    sparing each request a TCP (and possibly TLS) handshake.
+    """
+
+    def __init__(self, target, limit):
+        parsed = urlsplit(target)
+        self.connection_class = HTTPConnection
+        if parsed.scheme == "https":
+            self.connection_class = HTTPSConnection
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.path = parsed.path.rstrip("/")
+        self.limit = limit
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Returns a connection, and whether it has served a request before."""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if self.is_usable(conn):
+                return conn, True
+            conn.close()
+        return self.connection_class(self.host, self.port, timeout = common.args[common.TITLE_TIMEOUT]), False
+
+    def is_usable(self, conn):
+        # An idle connection has nothing to read. If it is readable, then
+        #   the target has closed it (or sent something it should not have).
+        if conn.sock is None:
+            return False
+        try:
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (SocketError, ValueError):
+            return False
 
-class NoRedirection(HTTPErrorProcessor):
-
-    def http_response(self, request, response):
-        # Immediately pass responses along. Let the client deal with
-        # sending a second request in the case of redirects and such.
-        return response
-
-    https_response = http_response
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.limit:
+                self.idle.append(conn)
+                return
+        conn.close()
 
 class Proxy(common.CoreHttpServer):
 
     server_version = "CoreHttpServer (Quick Proxy)"
 
-    opener = build_opener(NoRedirection)
-
     log_on_send_error = True
 
+    cache = None
+    pool = None
+
     def do_PROXY(self):
 
-        url = "%s%s" % (common.args[TITLE_TARGET], quote(self.path))
+        pool = self.pool
+        path = "%s%s" % (pool.path, quote(self.path))
         get_items = []
 
         for key in self.get:
@@ -45,12 +304,16 @@ class Proxy(common.CoreHttpServer):
                 get_items.append('%s=%s' % (quote(key), quote(i)))
 
         if get_items:
-            url += '?%s' % '&'.join(get_items)
+            path += '?%s' % '&'.join(get_items)
 
         # Set headers locally for convenient short-hand.
         headers = getattr(self, common.ATTR_HEADERS, common.CaselessDict())
-        # Copy request headers.
-        req_headers = common.CaselessDict(headers)
+        # Copy request headers, leaving out those that only describe the client's connection to us.
+        req_headers = common.CaselessDict()
+        hop_by_hop = get_hop_by_hop_headers(headers)
+        for key in headers:
+            if key.lower() not in hop_by_hop and key.lower() != "expect":
+                req_headers[key] = headers[key]
 
         # The X-Forwarded-Host (XFH) header is a de-facto standard header for identifying the
         #   original host requested by the client in the Host HTTP request header.
@@ -67,88 +330,375 @@ class Proxy(common.CoreHttpServer):
         forward_chain += self.client_address[0]
         req_headers["X-Forwarded-For"] = forward_chain
 
-        # Todo: Do this just once in some initialization instead.
-        parsed = urlsplit(common.args[TITLE_TARGET])
-        port = parsed.port
-        if port is None:
-            port = 80
-            if parsed.scheme == "https":
-                port = 443
+        req_headers["Host"] = "%s:%s" % (pool.host, pool.port)
 
-        req_headers["Host"] = "%s:%s" % (parsed.hostname, port)
-
-        data = None
-
-        # Read from data to relay.
-        # This requires trusting user data more than I'm comfortable with,
-        #  but I think that I've taken enough precautions for a script
-        #  that should only be used as a quick, dirty, and above all TEMPORARY solution
+        # The request body is streamed to the target as it arrives rather than read into memory.
+        # Only bother to look for a body on POST or PUT commands.
+        # Revise this if we discover an exception to the rule, of course.
+        length = 0
+        chunked = False
         if self.command.lower() in ("post", "put"):
-            # For an extra layer of safety, only bother to try reading further data from
-            # POST or PUT commands. Revise this if we discover an exception to the rule, of course.
-
+            chunked = "chunked" in headers["Transfer-Encoding"].lower()
             # Use the content-length header, though being user-defined input it's not really trustworthy.
-            # Someone fudging this data is the main reason for my worrying over a timeout value.
+            # A client that sends less than it claims is caught by the timeout while streaming.
             try:
-                l = int(self.headers.get('content-length', 0))
-                if l < 0:
+                length = int(headers.get('content-length', 0) or 0)
+                if length < 0:
                     # Parsed properly, but some joker put in a negative number.
                     raise ValueError()
             except ValueError:
-                return self.send_error(400, "Illegal content-length header value: %s" % self.headers.get('content-length', 0))
+                return self.send_error(400, "Illegal content-length header value: %s" % headers.get('content-length', 0))
 
-            m = args[TITLE_MAX_LENGTH]
-            if m and l > m:
+            m = common.args[TITLE_MAX_LENGTH]
+            if m and length > m:
                 return self.send_error(413, 'Content-Length is too large. Max: %d' % m)
 
-            elif l:
-                # Read from rfile into variable.
-                # urllib is SUPPOSED to be able to adapt to being
-                # directly fed something with a read() method,
-                # but in my testing this has resulted in infinite hangups and
-                # trouble reading things on the target's side.
-                # Will have to fix later, but for now this creates potential problems if large files are being uploaded.
-                # This is a good part of the reason why the --max-length flag exists.
-                data = self.rfile.read(l)
-                # Intentionally not bothering to catch socket.timeout exception. Let it bubble up.
+            if chunked:
+                req_headers["Transfer-Encoding"] = "chunked"
+            else:
+                req_headers["Content-Length"] = str(length)
+
+            if (chunked or length) and headers["Expect"].lower() == "100-continue":
+                # The target is not told about the expectation, so answer it here.
+                self.wfile.write(common.convert_bytes("%s 100 Continue\r\n\r\n" % self.protocol_version))
+
+        has_request_body = chunked or length > 0
+        command = getattr(self, common.ATTR_COMMAND, "GET")
+
+        cache = self.cache
+        cached = None
+        request_cc = {}
+        if cache and command in ("GET", "HEAD"):
+            request_cc = parse_cache_control(headers["Cache-Control"])
+            if "no-cache" in headers["Pragma"].lower():
+                request_cc["no-cache"] = ""
+            if "no-store" not in request_cc:
+                cached = cache.get(path, headers)
+            if cached and cached.is_fresh(request_cc):
+                if self.serve_cached(cached, "HIT"):
+                    return
+                cached = None
+            elif cached and cached.is_validatable() and not (headers["If-None-Match"] or headers["If-Modified-Since"]):
+                # Ask the target whether our copy is still good, sparing the body if it is.
+                # If the client has validators of its own, leave it to the target to answer those instead.
+                if cached.etag:
+                    req_headers["If-None-Match"] = cached.etag
+                if cached.last_modified:
+                    req_headers["If-Modified-Since"] = cached.last_modified
+            else:
+                cached = None
+
+        while True:
+            conn, reused = pool.get()
+            sending_body = False
+            try:
+                conn.putrequest(command, path, skip_host = True, skip_accept_encoding = True)
+                for key in req_headers:
+                    conn.putheader(key, req_headers[key])
+                conn.endheaders()
+                sending_body = True
+                if chunked:
+                    self.relay_chunked_body(conn)
+                elif length:
+                    self.relay_body(conn, length)
+                sending_body = False
+                resp = conn.getresponse()
+                break
+            except BodyError as e:
+                conn.close()
+                return self.send_error(e.code, e.message)
+            except (SocketError, HTTPException) as e:
+                if sending_body and self.relay_early_response(conn):
+                    return
+                conn.close()
+                if reused and not has_request_body:
+                    # The target closed an idle connection before we noticed. A request without
+                    #   a body can simply be repeated on a new connection.
+                    continue
+                self.close_connection = 1
+                return self.send_error(502, "Error relaying request")
+
+        if cached and resp.status == 304:
+            resp.read()
+            if resp.will_close:
+                conn.close()
+            else:
+                pool.put(conn)
+            cache.refresh(cached, get_end_to_end_headers(resp))
+            if not self.serve_cached(cached, "REVALIDATED"):
+                # Evicted in the meantime. Start over without it.
+                return self.do_PROXY()
+            return
+
+        store = None
+        cache_status = None
+        if cache and command == "GET":
+            cache_status = "MISS"
+            if cache.is_storable(headers, request_cc, resp):
+                entry = CacheEntry(resp.status, resp.reason, [(k, v) for k, v in get_end_to_end_headers(resp) if k.lower() != "age"])
+                # Only worth keeping if it can be served without asking, or cheaply revalidated.
+                if entry.lifetime > 0 or entry.is_validatable():
+                    store = cache.writer(path, headers, entry)
+        elif cache and command not in SAFE_METHODS and resp.status < 400:
+            # Whatever was cached for this path is likely out of date now.
+            cache.invalidate(path)
+
+        if not self.relay_response(resp, store, cache_status):
+            # The response was not read to its end, or the target is closing the connection.
+            return conn.close()
+        pool.put(conn)
+
+    def is_not_modified(self, entry):
+        # Check the client's own validators against a cached response.
+        if entry.status != 200:
+            return False
+        headers = getattr(self, common.ATTR_HEADERS, common.CaselessDict())
+        if headers["If-None-Match"]:
+            tags = [t.strip() for t in headers["If-None-Match"].split(",")]
+            return "*" in tags or bool(entry.etag and strip_weak(entry.etag) in [strip_weak(t) for t in tags])
+        since = parse_http_date(headers["If-Modified-Since"])
+        modified = parse_http_date(entry.last_modified)
+        return bool(since and modified and modified <= since)
+
+    def read_body(self, size):
+        try:
+            buf = self.rfile.read(size)
+        except SocketTimeout:
+            raise BodyError(408, "Data timeout (%s seconds)" % common.args[common.TITLE_TIMEOUT])
+        if not buf:
+            raise BodyError(400, "Request body ended early")
+        return buf
+
+    def read_body_line(self):
+        try:
+            return self.rfile.readline(1024)
+        except SocketTimeout:
+            raise BodyError(408, "Data timeout (%s seconds)" % common.args[common.TITLE_TIMEOUT])
+
+    def relay_body(self, conn, length):
+        while length > 0:
+            buf = self.read_body(min(length, 64*1024))
+            conn.send(buf)
+            length -= len(buf)
+
+    def relay_chunked_body(self, conn):
+        # Chunk boundaries are passed along as they arrive, so the target sees data as
+        #   soon as we do. Trailers are dropped.
+        m = common.args[TITLE_MAX_LENGTH]
+        total = 0
+        while True:
+            try:
+                size = int(self.read_body_line().split(common.convert_bytes(";"))[0].strip(), 16)
+            except ValueError:
+                raise BodyError(400, "Bad chunk size in request body")
+            if size <= 0:
+                break
+            total += size
+            if m and total > m:
+                raise BodyError(413, 'Request body is too large. Max: %d' % m)
+            conn.send(common.convert_bytes("%x\r\n" % size))
+            while size > 0:
+                buf = self.read_body(min(size, 64*1024))
+                conn.send(buf)
+                size -= len(buf)
+            if self.read_body_line().strip():
+                raise BodyError(400, "Bad chunk in request body")
+            conn.send(common.convert_bytes("\r\n"))
+        while self.read_body_line().strip():
+            pass
+        conn.send(common.convert_bytes("0\r\n\r\n"))
+
+    def relay_early_response(self, conn):
+        """Relay a response that the target sent before taking in the whole request body,
+        e.g. to refuse it, and stopped reading.
+        Returns False if there is no such response to relay.
+        """
+        try:
+            resp = conn.getresponse()
+        except (SocketError, HTTPException):
+            return False
+        # The rest of the client's body is left unread.
+        self.close_connection = 1
+        self.relay_response(resp)
+        conn.close()
+        return True
+
+    def relay_response(self, resp, store = None, cache_status = None):
+        """Relay a response from the target to the client.
+        If a store is given, the body is also written to it.
+        Returns True if the connection to the target can be reused.
+        """
 
+        code = str(resp.status)
+
+        self.send_status(code, resp.reason)
+        for key, value in get_end_to_end_headers(resp):
+            self.send_header(key, value)
+        if cache_status:
+            self.send_header("X-Cache", cache_status)
+
+        length = resp.getheader("Content-Length") or None
+        has_body = getattr(self, common.ATTR_COMMAND, "GET") != "HEAD" and code not in ("204", "304")
+        dst = self.wfile
+        if has_body:
+            dst = self.send_content_framing(length)
+        elif length:
+            self.send_header("Content-Length", length)
+        self.end_headers()
 
-        # Construct request
-        req = Request(url, data, headers=req_headers)
-        req.get_method = lambda: getattr(self, common.ATTR_COMMAND, "GET")
+        self.log_message('"%s" %s %s', getattr(self, common.ATTR_REQUEST_LINE, ""), code, cache_status)
 
+        # Pass data along as soon as any arrives instead of waiting to fill a buffer,
+        #   so that streamed responses (e.g. server-sent events) are not held up.
+        read = getattr(resp, "read1", resp.read)
+        complete = False
         try:
-            resp = self.opener.open(req)
-
-            # Get response headers to pass along from target server to client.
-            resp_headers = self.get_header_dict(resp.info())
-            code = str(resp.getcode())
-        except (SocketError, URLError) as e:
-            return self.send_error(502, "Error relaying request")
+            while self.alive:
+                buf = read(64*1024)
+                if not buf:
+                    # read1() can run dry without marking the response as done, which
+                    #   would leave the connection unusable for the next request.
+                    resp.read()
+                    complete = True
+                    break
+                dst.write(buf)
+                if store:
+                    store.write(buf)
+            if complete and dst is not self.wfile:
+                # Final chunk
+                dst.close()
+        except (SocketError, HTTPException):
+            # Either side dropped the connection partway through. The headers
+            #   are already out, so all that is left is to give up on both.
+            complete = False
+        if not complete:
+            self.close_connection = 1
+            resp.close()
+        if store:
+            if complete:
+                store.close()
+            else:
+                store.abandon()
+
+        return complete and not resp.will_close
 
-        # TODO: This is the place to modify response headers in the resp_headers dictionary before
-        #       they're written back to the client.
-        #       At this time, I can't think of any that need re-writing, though.
+    def get_command(self):
+        return "PROXY"
 
+    def send_status(self, code, reason):
+        # Written directly rather than through send_response(), which would add our own Server and Date headers.
         if getattr(self, common.ATTR_REQUEST_VERSION, self.default_request_version) != 'HTTP/0.9':
-            self.wfile.write(common.convert_bytes("%s %s %s\r\n" % (self.protocol_version, code, getattr(self,common.ATTR_PATH, "/"))))
-        for key in resp_headers:
-            # Write response headers
-            if resp_headers[key]:
-                self.send_header(key, resp_headers[key])
-        self.end_headers()
+            self.wfile.write(common.convert_bytes("%s %s %s\r\n" % (self.protocol_version, code, reason)))
 
-        self.log_message('"%s" %s %s', getattr(self, common.ATTR_REQUEST_LINE, ""), code, None)
-        self.copyobj(resp, self.wfile)
+    def serve_cached(self, entry, cache_status):
+        """Answer from a cached response.
+        Returns False if its body has been dropped from the cache since it was looked up.
+        """
 
-    def get_command(self):
-        return "PROXY"
+        src = None
+        code, reason = entry.status, entry.reason
+        if self.is_not_modified(entry):
+            code, reason = 304, "Not Modified"
+        else:
+            src = self.cache.open(entry)
+            if src is None:
+                return False
+
+        self.send_status(code, reason)
+        for key, value in entry.headers:
+            self.send_header(key, value)
+        self.send_header("Age", "%d" % entry.get_age())
+        self.send_header("X-Cache", cache_status)
+        if src:
+            self.send_header("Content-Length", str(entry.size))
+        self.end_headers()
+
+        self.log_message('"%s" %s %s', getattr(self, common.ATTR_REQUEST_LINE, ""), code, cache_status)
+        if src and getattr(self, common.ATTR_COMMAND, "GET") == "HEAD":
+            src.close()
+        else:
+            self.copyobj(src, self.wfile)
+        return True
 
     def log_request(self, code='-', size='-'):
         """Log an accepted request.
         This is called by send_response().
         """
 
+def get_end_to_end_headers(resp):
+    # Hop-by-hop headers describe our own connection to the target, and http.client
+    #   undoes any chunking. Framing to the client is decided separately.
+    # Work from the header list rather than a dictionary so that repeated
+    #   headers (e.g. Set-Cookie) all make it through.
+    hop_by_hop = get_hop_by_hop_headers(common.CaselessDict({"Connection": resp.getheader("Connection", "")}))
+    return [(key, value) for key, value in resp.getheaders() if value and key.lower() not in hop_by_hop]
+
+def get_hop_by_hop_headers(headers):
+    # Besides the standard hop-by-hop headers, a Connection header
+    #   may name further headers that apply only to this hop.
+    tokens = [t.strip().lower() for t in headers.get("Connection", "").split(",")]
+    return HOP_BY_HOP_HEADERS + tuple([t for t in tokens if t])
+
+def get_lifetime(cc, headers, date):
+    # Seconds that a response is fresh for after its date, going by what the target said.
+    for name in ("s-maxage", "max-age"):
+        seconds = get_seconds(cc, name)
+        if seconds is not None:
+            return seconds
+    if headers["Expires"]:
+        # An invalid date (commonly "0") means already expired.
+        expires = parse_http_date(headers["Expires"])
+        if expires:
+            return expires - date
+    return 0
+
+def get_seconds(cc, name):
+    try:
+        return int(cc[name])
+    except (KeyError, ValueError):
+        return None
+
+def parse_cache_control(value):
+    directives = {}
+    for item in value.split(","):
+        name, _, arg = item.partition("=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"')
+    return directives
+
+def parse_http_date(value):
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if not parsed:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+def strip_weak(tag):
+    # Weak comparison, as used for If-None-Match.
+    if tag.startswith("W/"):
+        return tag[2:]
+    return tag
+
+def validate_cache(self):
+    errors = []
+    if self[TITLE_CACHE_SIZE] < 0:
+        errors.append("Cache size must be greater than or equal to 0. Given: %s" % common.colour_text(self[TITLE_CACHE_SIZE]))
+    directory = self[TITLE_CACHE_DIR]
+    if directory:
+        if not os.path.isdir(directory):
+            errors.append("Cache directory not found: %s" % common.colour_text(directory, common.COLOUR_GREEN))
+        if not self[TITLE_CACHE_SIZE]:
+            errors.append("A %s must be set to use a %s." % (common.colour_text(TITLE_CACHE_SIZE), common.colour_text(TITLE_CACHE_DIR)))
+    return errors
+common.args.add_validator(validate_cache)
+
+def validate_pool_size(self):
+    if self[TITLE_POOL_SIZE] < 0:
+        return "Pool size must be greater than or equal to 0. Given: %s" % common.colour_text(self[TITLE_POOL_SIZE])
+common.args.add_validator(validate_pool_size)
+
 def validate_target(self):
     target = self.last_operand()
     if not target:
@@ -169,4 +719,12 @@ if __name__ == '__main__':
     common.print_notice("Forwarding requests on %s to target: %s" % (common.colour_text("%s:%d" % (bind_address, bind_port), common.COLOUR_GREEN), common.colour_text(target, common.COLOUR_GREEN)))
     common.announce_common_arguments(None)
 
+    Proxy.pool = UpstreamPool(target, common.args[TITLE_POOL_SIZE])
+    if common.args[TITLE_CACHE_SIZE]:
+        Proxy.cache = ProxyCache(common.args[TITLE_CACHE_SIZE], common.args[TITLE_CACHE_DIR])
+        where = "memory"
+        if Proxy.cache.directory:
+            where = Proxy.cache.directory
+        common.print_notice("Caching responses in up to %s bytes (in %s)" % (common.colour_text(common.args[TITLE_CACHE_SIZE]), common.colour_text(where, common.COLOUR_GREEN)))
+
     common.serve(Proxy, False)
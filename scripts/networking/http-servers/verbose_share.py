@@ -4,7 +4,8 @@
 #   * https://pymotw.com/2/BaseHTTPServer/index.html#module-BaseHTTPServer
 #   * https://docs.python.org/2/library/simplehttpserver.html
 
-import cgi, datetime, getopt, os, re, socket, sys, urllib
+import binascii, datetime, getopt, os, re, socket, sys, urllib
+from io import BytesIO
 import CoreHttpServer as common
 from CoreHttpServer import args, print_notice
 common.local_files.append(os.path.realpath(__file__))
@@ -19,6 +20,27 @@ else:
     from html import escape
     from urllib.parse import quote, unquote
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 2, without the scandir backport.
+    class _DirEntry:
+        def __init__(self, path, name):
+            self.name = name
+            self.path = os.path.join(path, name)
+
+        def is_dir(self):
+            return os.path.isdir(self.path)
+
+        def is_symlink(self):
+            return os.path.islink(self.path)
+
+        def stat(self):
+            return os.stat(self.path)
+
+    def scandir(path):
+        return [_DirEntry(path, name) for name in os.listdir(path)]
+
 # Script Content
 
 DEFAULT_REVERSE = False
@@ -41,6 +63,10 @@ LABEL_CATEGORY_MTIME = 'M'
 LABEL_CATEGORY_SIZE = 'S'
 LABEL_CATEGORY_TYPE = 'T'
 
+# Uploads are received into a hidden file next to their destination, e.g. ".name.upload"
+UPLOAD_PARTIAL_PREFIX = '.'
+UPLOAD_PARTIAL_SUFFIX = '.upload'
+
 # Define arguments
 
 # Flags
@@ -52,113 +78,383 @@ args.add_opt(common.OPT_TYPE_LONG, TITLE_MAX_LENGTH, TITLE_MAX_LENGTH, "Maximum
 
 args.add_validator(common.validate_common_directory)
 
+class UploadError(Exception):
+    """
+    A problem with an upload, to be reported to the client with the given response code.
+    """
+
+    def __init__(self, code, message):
+        super(UploadError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+class BodyReader:
+    """
+    Reads a request body of a declared length, failing if the client sends less than it claimed.
+    Nothing past the declared length is ever read.
+    """
+
+    read_size = 64*1024
+
+    def __init__(self, src, length):
+        self.src = src
+        self.remaining = length
+
+    def pieces(self):
+        while self.remaining > 0:
+            yield self.read()
+
+    def read(self, size = None):
+        if self.remaining <= 0:
+            return common.convert_bytes('')
+        try:
+            data = self.src.read(min(size or self.read_size, self.remaining))
+        except socket.timeout:
+            raise UploadError(408, 'Upload timed out.')
+        if not data:
+            raise UploadError(400, 'Upload ended %d bytes short of its Content-Length.' % self.remaining)
+        self.remaining -= len(data)
+        return data
+
+class MultipartReader:
+    """
+    Incremental multipart/form-data parser.
+    Part bodies are handed out in pieces as they arrive, so that an upload
+    can be written straight to its destination without spooling it first.
+    """
+
+    header_limit = 16*1024
+
+    def __init__(self, src, boundary):
+        self.src = src
+        self.delimiter = common.convert_bytes('\r\n--') + boundary
+        # The first delimiter is not required to follow a line break.
+        self.buf = bytearray(common.convert_bytes('\r\n'))
+        self.done = False
+        self.in_part = False
+
+    def fill(self):
+        data = self.src.read()
+        if not data:
+            raise UploadError(400, 'Incomplete multipart body.')
+        self.buf += data
+
+    def next_part(self):
+        """Move on to the next part, skipping anything left of the current one.
+        Returns the headers of the part, or None if there are no more parts.
+        """
+
+        if self.in_part:
+            for piece in self.read_part():
+                pass
+
+        if self.done:
+            return None
+
+        # Find the delimiter, skipping the preamble if this is the first part.
+        while True:
+            i = self.buf.find(self.delimiter)
+            if i >= 0:
+                del self.buf[:i + len(self.delimiter)]
+                break
+            del self.buf[:max(0, len(self.buf) - len(self.delimiter))]
+            self.fill()
+
+        while len(self.buf) < 2:
+            self.fill()
+        if self.buf[:2] == common.convert_bytes('--'):
+            # Closing delimiter, anything past it is epilogue.
+            self.done = True
+            return None
+
+        while True:
+            i = self.buf.find(common.convert_bytes('\r\n\r\n'))
+            if i > self.header_limit or (i < 0 and len(self.buf) > self.header_limit):
+                # Whether or not the end of the headers came in along with the rest of them.
+                raise UploadError(400, 'Multipart headers too long.')
+            if i >= 0:
+                break
+            self.fill()
+
+        # The remainder of the delimiter line (including any padding) is discarded along with the headers.
+        headers = common.CaselessDict()
+        for line in common.convert_str(bytes(self.buf[:i])).split('\r\n')[1:]:
+            key, sep, value = line.partition(':')
+            if sep:
+                headers[key.strip()] = value
+        del self.buf[:i + 4]
+
+        self.in_part = True
+        return headers
+
+    def read_part(self):
+        # Yield the body of the current part in pieces, up to the next delimiter.
+        keep = len(self.delimiter) - 1
+        while True:
+            i = self.buf.find(self.delimiter)
+            if i >= 0:
+                if i:
+                    yield bytes(self.buf[:i])
+                del self.buf[:i]
+                break
+            # Hold back enough to catch a delimiter split across reads.
+            if len(self.buf) > keep:
+                yield bytes(self.buf[:-keep])
+                del self.buf[:-keep]
+            self.fill()
+        self.in_part = False
+
+class DirectoryListing:
+    """
+    Rendered table rows for one directory, along with the order of the rows
+    when sorted by each category (ascending; descending is read backwards).
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.orders = {}
+        self.rows = []
+
 class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
     server_version = "CoreHttpServer (Content Serving)"
 
     suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
 
-    def __init__(self, request, client_address, server):
+    # Directory listings, by real path. Shared between all handlers.
+    listing_cache = {}
+    listing_cache_size = 64
+    # Rows written to the client at a time while streaming a listing.
+    listing_chunk_rows = 500
+
+    # Range requests with more ranges than this are answered with the whole content.
+    max_ranges = 64
+
+    def __init__(self, request, client_address, server, reader = None):
         if sys.version_info.major < 3:
-            super(SimpleHTTPVerboseReqeustHandler, self).__init__(request, client_address, server)
+            super(SimpleHTTPVerboseReqeustHandler, self).__init__(request, client_address, server, reader)
         else:
-            super().__init__(request, client_address, server)
+            super().__init__(request, client_address, server, reader)
         self.ranges_enabled = True
         if args[TITLE_UPLOAD]:
             self.do_POST = self.action_POST
+            self.do_PUT = self.action_PUT
 
     def action_POST(self):
         """
-        Accept an uploaded file.
+        Accept one or more uploaded files from a multipart/form-data form.
 
         This method is not named do_POST because it is only enabled if the upload flag (-u) is used.
 
-        Original source is baot of StackOverflow: https://stackoverflow.com/questions/28217869/python-basehttpserver-file-upload-with-maxfile-size
+        Files are parsed out of the request body as it arrives, and written directly to their destination.
         """
 
-        # Use the content-length header, though being user-defined input it's not really trustworthy.
         try:
-            l = int(self.headers.get('content-length', 0))
-            if l < 0:
-                # Parsed properly, but some joker put in a negative number.
-                raise ValueError()
-        except ValueError:
-            return self.serve_content("Illegal Content-Length header value: %s" % self.headers.get('content-length', 0), 400)
+            l = self.get_upload_length()
 
-        m = args[TITLE_MAX_LENGTH]
-        if m and l > m:
-            return self.serve_content('Maximum length: %d' % m, code = 413)
-
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={
-                'REQUEST_METHOD':'POST',
-                'CONTENT_TYPE':self.headers['Content-Type'],
-            }
-        )
+            match = re.match(r'^multipart/form-data;.*boundary=(?:"([^"]+)"|([^;\s]+))', self.headers['Content-Type'], re.I)
+            if not match:
+                raise UploadError(400, 'Expected a multipart/form-data upload.')
 
-        if 'file' not in form:
+            if not os.path.isdir(self.file_path):
+                return self.send_error(404)
+
+            reader = MultipartReader(BodyReader(self.rfile, l), common.convert_bytes(match.group(1) or match.group(2)))
+            saved = 0
+            unnamed = False
+            while True:
+                headers = reader.next_part()
+                if headers is None:
+                    break
+
+                match = re.search(r';\s*filename="([^"]*)"', headers['Content-Disposition'])
+                if not match:
+                    # Not a file, skip over it.
+                    continue
+                filename = match.group(1)
+                if not filename:
+                    # File input left empty.
+                    unnamed = True
+                    continue
+
+                path_save = self.check_upload_destination(self.file_path, filename)
+                self.save_upload(path_save, reader.read_part())
+                saved += 1
+        except UploadError as e:
+            return self.serve_content(e.message, code = e.code)
+
+        if not saved:
+            if unnamed:
+                # No FileName provided
+                return self.serve_content('No file name.', 400)
             return self.serve_content('No file provided.', 400)
 
-        filename = form['file'].filename
+        return self.serve_content(self.render_file_table(self.file_path), code = 200)
+
+    def action_PUT(self):
+        """
+        Accept a file, or a piece of one, uploaded to its destination path.
+
+        This method is not named do_PUT because it is only enabled if the upload flag (-u) is used.
+
+        A Content-Range header (e.g. 'bytes 0-8388607/20000000') marks a piece of a resumable upload.
+        Pieces are collected in order into a hidden partial file, which is moved into place once complete.
+        Every piece is answered with a Range header covering what has been received so far:
+          * 202 if more is expected.
+          * 409 if the piece does not carry on from there, in which case the client should resume from the given offset.
+          * 200 (with the file table) once the file is complete.
+        'bytes */20000000' with an empty body asks how much has been received, e.g. to resume after a dropped connection.
+        """
+
+        try:
+            l = self.get_upload_length()
+
+            directory, filename = os.path.split(self.file_path)
+            path_save = self.check_upload_destination(directory, filename)
+
+            content_range = self.headers['Content-Range']
+            if not content_range:
+                # Whole file in one go.
+                self.save_upload(path_save, BodyReader(self.rfile, l).pieces())
+                return self.serve_content(self.render_file_table(directory), code = 200)
+
+            match = re.match(r'^bytes (?:(\d+)-(\d+)|\*)/(\d+)$', content_range)
+            if not match:
+                raise UploadError(400, 'Bad Content-Range header.')
+
+            total = int(match.group(3))
+            m = args[TITLE_MAX_LENGTH]
+            if m and total > m:
+                raise UploadError(413, 'Maximum length: %d' % m)
+
+            partial = self.get_upload_partial_path(path_save)
+            received = 0
+            if os.path.isfile(partial):
+                received = os.path.getsize(partial)
+
+            if match.group(1) is None:
+                # Progress query
+                return self.send_upload_progress(202, received)
+
+            start = int(match.group(1))
+            end = int(match.group(2))
+            if end < start or end >= total or l != end - start + 1:
+                raise UploadError(400, 'Content-Range does not match the upload.')
+            if start != received:
+                return self.send_upload_progress(409, received)
+
+            # Keep what does arrive of a piece if the connection drops, the client can resume from there.
+            with open(partial, 'ab') as output_file:
+                for piece in BodyReader(self.rfile, l).pieces():
+                    output_file.write(piece)
+
+            if end + 1 < total:
+                return self.send_upload_progress(202, end + 1)
+            os.rename(partial, path_save)
+        except UploadError as e:
+            return self.serve_content(e.message, code = e.code)
+        except (IOError, OSError):
+            return self.serve_content('Failed to save file.', code = 500)
+
+        return self.serve_content(self.render_file_table(directory), code = 200)
+
+    def check_upload_destination(self, directory, filename):
+        # Confirm that an uploaded file may be saved, returning the path to save it to.
+
         if not filename:
             # No FileName provided
-            return self.serve_content('No file name.', 400)
+            raise UploadError(400, 'No file name.')
         elif not re.match(r'^[^/\\]+$', filename) or filename in ['.', '..']:
             # Validate filename
-            return self.serve_content('Invalid file name.', 400)
+            raise UploadError(400, 'Invalid file name.')
 
-        if not os.path.isdir(self.file_path):
-            return self.send_error(404)
+        if not os.path.isdir(directory):
+            raise UploadError(404, 'Directory not found.')
 
-        path_save = os.path.join(self.file_path, filename)
+        path_save = os.path.join(directory, filename)
 
         if os.path.exists(path_save) and not os.path.isfile(path_save):
-            return self.serve_content('Destination exists as a non-file', code = 406)
+            raise UploadError(406, 'Destination exists as a non-file')
 
         if args[TITLE_UPLOAD_NO_CLOBBER] and os.path.isfile(path_save):
-            return self.serve_content('File already exists.', code = 302)
+            raise UploadError(302, 'File already exists.')
+
+        return path_save
 
+    def get_upload_length(self):
+
+        # Use the content-length header, though being user-defined input it's not really trustworthy.
+        # BodyReader makes sure that a client that sends less than it claims is noticed.
+        value = self.headers.get('content-length')
+        if not value:
+            raise UploadError(411, 'Content-Length is required.')
         try:
-            with open(path_save, 'wb') as output_file:
-                # TODO: How to handle a user lying in their Content-Length header?
-                self.copyobj(form['file'].file, output_file, False)
-        except IOError:
-            if os.path.isfile(path_save):
-                os.remove(path_save)
-            return self.serve_content('Failed to save file.', code = 500)
+            l = int(value)
+            if l < 0:
+                # Parsed properly, but some joker put in a negative number.
+                raise ValueError()
+        except ValueError:
+            raise UploadError(400, "Illegal Content-Length header value: %s" % value)
 
-        return self.serve_content(self.render_file_table(self.file_path), code = 200)
+        m = args[TITLE_MAX_LENGTH]
+        if m and l > m:
+            raise UploadError(413, 'Maximum length: %d' % m)
+
+        return l
+
+    def get_upload_partial_path(self, path_save):
+        directory, filename = os.path.split(path_save)
+        return os.path.join(directory, UPLOAD_PARTIAL_PREFIX + filename + UPLOAD_PARTIAL_SUFFIX)
+
+    def save_upload(self, path_save, pieces):
+        # Write to a partial file, only replacing the destination once the whole upload is in.
+        partial = self.get_upload_partial_path(path_save)
+        try:
+            with open(partial, 'wb') as output_file:
+                for piece in pieces:
+                    output_file.write(piece)
+            os.rename(partial, path_save)
+        except IOError:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            raise UploadError(500, 'Failed to save file.')
+        except UploadError:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            raise
 
     def copyobj(self, src, dst, outgoing = True):
         if not src:
             return
 
-        start, end, remaining = (0, 0, -1)
-        if getattr(self, 'clip', False):
-            start, end = self.ranges[0]
-            remaining = end - start + 1 # Account for zero-indexing
-        if start:
-            src.seek(start)
+        if not self.clip:
+            return super(SimpleHTTPVerboseReqeustHandler, self).copyobj(src, dst, outgoing)
 
-        while self.alive and remaining:
-            buflen = 16*1024
-            if remaining > 0:
-                buflen = min(remaining, buflen)
-
-            buf = src.read(buflen)
-            if not (buf and self.alive):
-                break
-            remaining -= len(buf)
-            dst.write(common.convert_bytes(buf))
+        # Ranges prepared by send_ranges(), each part preceded by its multipart header (if any).
+        for header, start, end in self.parts:
+            if header:
+                dst.write(header)
+            self.copyobj_range(src, dst, start, end - start + 1) # Account for zero-indexing
+        if self.parts_trailer:
+            dst.write(self.parts_trailer)
 
         if not outgoing:
             return
 
-        self.alive = False
         src.close()
 
+    def copyobj_range(self, src, dst, start, remaining):
+        if self.can_sendfile(src, dst):
+            return self.copyobj_sendfile(src, start, remaining)
+
+        src.seek(start)
+        while self.alive and remaining > 0:
+            buf = src.read(min(remaining, 16*1024))
+            if not (buf and self.alive):
+                break
+            remaining -= len(buf)
+            dst.write(common.convert_bytes(buf))
+
     def do_GET(self):
         """Common code for GET and HEAD commands.
         This sends the response code and MIME headers.
@@ -211,6 +507,11 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
         f = ('%.2f' % nbytes).rstrip('0').rstrip('.')
         return '%s%s' % (f, self.suffixes[i])
 
+    def is_link_allowed(self, path):
+        if args[TITLE_NO_LINKS]:
+            return False
+        return not args[TITLE_LOCAL_LINKS] or ("%s/" % os.path.realpath(path)).startswith(os.getcwd() + "/")
+
     def list_directory(self, path):
         """Helper to produce a directory listing (absent index.html).
         Return value is either a file object, or None (indicating an
@@ -218,8 +519,8 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
         interface the same as for send_head().
         """
 
-        table_content = self.render_file_table(path)
-        if not table_content:
+        listing = self.get_listing(path)
+        if listing is None:
             # Intentionally keeping the reason for this vague.
             # Could be due to a not-found file or a permissions problem.
             self.send_error(404, "Unable to list directory")
@@ -237,30 +538,72 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
       return document.getElementById(el);
     }
 
+    // Files are sent one at a time, in pieces that are retried if the connection drops.
+    var chunkSize = 8 * 1024 * 1024;
+    var retryLimit = 5;
+    var uploadQueue = [];
+
     function uploadFile() {
-      var file = _("file").files[0];
-      var formdata = new FormData();
-      formdata.append("file", file);
+      uploadQueue = Array.prototype.slice.call(_("file").files);
+      uploadNext();
+    }
+
+    function uploadNext() {
+      var file = uploadQueue.shift();
+      if(!file) {
+        return;
+      }
+      sendChunk({file: file, offset: 0, retries: 0});
+      setProgress();
+    }
+
+    function uploadUrl(file) {
+      var url = window.location.pathname;
+      if(!url.endsWith("/")) {
+        url += "/";
+      }
+      url += encodeURIComponent(file.name);
+
+      var urlParams = new URLSearchParams(window.location.search).toString();
+      if(urlParams != "") {
+        url += "?" + urlParams;
+      }
+      return url;
+    }
+
+    function sendChunk(upload, query = false) {
+      var file = upload.file;
+      var end = Math.min(upload.offset + chunkSize, file.size);
       var ajax = new XMLHttpRequest();
 
       ajax.size = file.size; // Used by 413 error response
       ajax.filename = file.name; // Used by 406 error response
       ajax.percent = 0; // Used by handleProgress
+      ajax.state = upload; // Used to carry on with the next piece
       ajax.upload.addEventListener("progress", handleProgress, false);
       ajax.addEventListener("load", handleComplete, false);
       ajax.addEventListener("error", handleError, false);
       ajax.addEventListener("abort", handleAbort, false);
 
-      var url = window.location.pathname;
-      var urlParams = new URLSearchParams(window.location.search).toString();
-      if(urlParams != "") {
-        url += "?" + urlParams;
+      ajax.open("PUT", uploadUrl(file));
+      if(query) {
+        // Ask how much of the file made it before the connection dropped.
+        ajax.setRequestHeader("Content-Range", "bytes */" + file.size);
+        ajax.send();
+      } else if(file.size) {
+        ajax.setRequestHeader("Content-Range", "bytes " + upload.offset + "-" + (end - 1) + "/" + file.size);
+        ajax.send(file.slice(upload.offset, end));
+      } else {
+        ajax.send(file);
       }
+    }
 
-      ajax.open("POST", url);
-      ajax.send(formdata);
-
-      setProgress();
+    function resumeChunk(event) {
+      // Carry on from what the server reports having received.
+      var upload = event.target.state;
+      var range = event.target.getResponseHeader("Range");
+      upload.offset = range ? parseInt(range.split("-")[1]) + 1 : 0;
+      sendChunk(upload);
     }
 
     function handleAbort(event) {
@@ -291,11 +634,17 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
         setStatus("BAD REQUEST: " + event.target.responseText);
       } else if(code == 302) {
         setStatus("File already exists.")
+      } else if(code == 202 || code == 409) {
+        // Piece received (or out of step with the server), send the next one.
+        event.target.state.retries = 0;
+        resumeChunk(event);
+        reset = false;
       } else if(code == 200) {
         setStatus("Upload Complete");
         _("table").innerHTML = event.target.responseText;
         setPercent(100);
         reset = false;
+        uploadNext();
       } else {
         setStatus("Unexpected Response Code: " + code.toString());
       }
@@ -307,12 +656,20 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
     }
 
     function handleError(event) {
+      var upload = event.target.state;
+      if(upload.retries < retryLimit) {
+        upload.retries++;
+        setStatus("Connection lost, retrying (" + upload.retries + "/" + retryLimit + ")...");
+        setTimeout(function() { sendChunk(upload, true); }, 2000 * upload.retries);
+        return;
+      }
       _("status").innerHTML = "Upload Failed";
       setPercent();
     }
 
     function handleProgress(event) {
-      var p = Math.round((event.loaded / event.total) * 100);
+      var upload = event.target.state;
+      var p = Math.round(((upload.offset + event.loaded) / (upload.file.size || 1)) * 100);
       if(p == event.target.percent) {
         return; // No new information, don't bother updating
       }
@@ -336,7 +693,7 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
     }
     </script>
       <form id="upload_form" enctype="multipart/form-data" method="post">
-      <input type="file" name="file" id="file" onchange="uploadFile()"><br>
+      <input type="file" name="file" id="file" multiple onchange="uploadFile()"><br>
       <progress id="progressBar" value="0" max="100" style="width:350px;"></progress>
       <p id="status">&nbsp;</p>
     </form>
@@ -366,118 +723,108 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
   <body>
     <h2>Directory: %s</h2>%s
     <div id="table">
-        %s
-    </div>
-  </body>
-</html>
-""" % (displaypath, self.base_directory, # Title
+        """ % (displaypath, self.base_directory, # Title
         self.render_breadcrumbs(displaypath),
-        uploadContent,
-        table_content
+        uploadContent
     )
 
-        return self.serve_content(htmlContent)
+        # A compressed page is kept for as long as the listing it was rendered from.
+        encoding = self.get_content_encoding("text/html", len(htmlContent))
+        cache_key = None
+        if encoding:
+            cache_key = (encoding, os.path.realpath(path), listing.key, getattr(self, common.ATTR_PATH, "/"),
+                tuple(self.get.get(LABEL_GET_CATEGORY, [])), tuple(self.get.get(LABEL_GET_ORDER, [])))
+            compressed = common.compression_cache.get(cache_key)
+            if compressed is not None:
+                self.send_response(200)
+                self.send_common_headers("text/html", len(compressed))
+                self.send_encoding_headers("text/html", encoding)
+                self.end_headers()
+                self.wfile.write(compressed)
+                return None
+
+        # Stream the page, so that the top of a large listing shows up
+        #   without waiting on the rest of the table.
+        self.send_response(200)
+        dst = self.send_common_headers("text/html")
+        self.send_encoding_headers("text/html", encoding)
+        self.end_headers()
+        if encoding:
+            dst = common.CompressingWriter(dst, encoding, keep = True)
 
-    def render_file_table(self, path):
+        dst.write(common.convert_bytes(htmlContent))
+        for part in self.render_file_table_parts(listing, path):
+            dst.write(common.convert_bytes(part))
+        dst.write(common.convert_bytes("""
+    </div>
+  </body>
+</html>
+"""))
+        if dst is not self.wfile:
+            # Final chunk
+            dst.close()
+        if encoding:
+            common.compression_cache.put(cache_key, dst.getvalue())
+        return None
+
+    def get_listing(self, path):
+        """Get the listing for a directory, scanning it only if it has changed since last time.
+        Returns None if the directory cannot be read.
+        """
 
         try:
-            fileNames = os.listdir(path)
+            st = os.stat(path)
         except os.error:
             return None
 
-        items = []
-        for name in fileNames:
+        # Adding, removing, or renaming an entry updates the directory's mtime.
+        # Changes to the contents of files already listed are not picked up until then.
+        key = (st.st_dev, st.st_ino, getattr(st, 'st_mtime_ns', st.st_mtime))
+        realpath = os.path.realpath(path)
+        listing = self.listing_cache.get(realpath)
+        if listing is not None and listing.key == key:
+            return listing
 
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            extrainfo = ''
-            reachable = True
-            size = 0
-            size_display = '-'
-            obj_type = 'File'
-            mtime = 0.0
-            is_file = False
+        listing = self.scan_directory(path, key)
+        if listing is None:
+            return None
 
-            if os.path.islink(fullname):
+        cache = self.listing_cache
+        if realpath not in cache and len(cache) >= self.listing_cache_size:
+            # Make room by dropping the oldest-cached directory.
+            try:
+                del cache[next(iter(cache))]
+            except (KeyError, RuntimeError, StopIteration):
+                # Lost a race with another thread doing the same.
+                pass
+        cache[realpath] = listing
+        return listing
 
-                # Note: a link to a directory displays with @ and links with /
-                displayname = name + "@"
-                reachable = not (args[TITLE_NO_LINKS] or (args[TITLE_LOCAL_LINKS] and not os.path.realpath(fullname).startswith(os.getcwd() + "/")))
-                obj_type = 'Sym'
+    def render_file_table(self, path):
 
-                if not reachable:
-                    # Symbolic link is inaccessible. Override extra info to plainly say 'symlink'.
-                    if args[TITLE_NO_LINKS]:
-                        extrainfo = "(Symlink)"
-                    else:
-                        # Implies local links only, meaning an unreachable link is external.
-                        extrainfo = "(External Symlink)"
-                elif os.path.isdir(os.path.realpath(fullname)):
-                    # Directory via Symlink
-                    # Append / for directories or @ for symbolic links
-                    displayname = name + "/@"
-                    linkname = name + "/"
+        listing = self.get_listing(path)
+        if listing is None:
+            return None
+        return "".join(self.render_file_table_parts(listing, path))
 
-                    extrainfo = "Symlink to directory <span class='path'>%s</span>" % escape(os.path.realpath(fullname))
-                elif os.path.isfile(os.path.realpath(fullname)):
-                    # File via Symlink
-                    extrainfo = "Symlink to %s file <span class='path'>%s</span>" % (self.humansize(os.stat(fullname).st_size), escape(os.path.realpath(fullname)))
-                    is_file = True
-                else:
-                    # Dead symlink
-                    linkname = None
-                    extrainfo = "Dead symlink to <span class='path'>%s</span>" % os.readlink(fullname)
-
-            elif os.path.isdir(fullname):
-                # Directory
-                displayname = name + "/"
-                linkname = name + "/"
-                obj_type += 'Dir'
-            else:
-                # File
-                is_file = True
-
-            if reachable and is_file:
-                size = os.stat(fullname).st_size
-                size_display = self.humansize(size)
-                mtime = os.path.getmtime(os.path.join(path, name))
-
-            obj = {}
-            obj['rawname'] = name
-            obj['mtime'] = mtime
-            obj['linkname'] = linkname
-            obj['displayname'] = displayname
-            obj['extrainfo'] = extrainfo
-            obj['reachable'] = reachable
-            obj['type'] = obj_type
-            obj['size'] = size
-            obj['size_display'] = size_display
-
-            items.append(obj)
+    def render_file_table_parts(self, listing, path):
 
         default_category_label = LABEL_CATEGORY_NAME
         default_order_label = LABEL_ORDER_ASCENDING
 
         category_label = next(iter(reversed(self.get.get(LABEL_GET_CATEGORY, []))), default_category_label).upper()
-        if category_label not in (LABEL_CATEGORY_NAME, LABEL_CATEGORY_MTIME, LABEL_CATEGORY_SIZE, LABEL_CATEGORY_TYPE):
-            category = default_category_label
+        if category_label not in listing.orders:
+            category_label = default_category_label
 
         order_label = next(iter(reversed(self.get.get(LABEL_GET_ORDER, []))), default_order_label).upper()
         if order_label not in (LABEL_ORDER_ASCENDING, LABEL_ORDER_DESCENDING):
-            order = default_order_label
+            order_label = default_order_label
 
         reverse = False
+        order = listing.orders[category_label]
         if order_label == LABEL_ORDER_DESCENDING:
             reverse = True
-
-        if category_label == LABEL_CATEGORY_MTIME:
-            items.sort(key=lambda a: (a['mtime'], a['rawname'].lower()), reverse = reverse)
-        elif category_label == LABEL_CATEGORY_SIZE:
-            items.sort(key=lambda a: (a['size'], a['rawname'].lower()), reverse = reverse)
-        elif category_label == LABEL_CATEGORY_TYPE:
-            items.sort(key=lambda a: (a['type'], a['rawname'].lower()), reverse = reverse)
-        else:
-            items.sort(key=lambda a: a['rawname'].lower(), reverse = reverse)
+            order = reversed(order)
 
         content = """<table>
         <tr><th class="c_name">%s</th><th class="c_size">%s</th><th class="c_mod">%s</th><th class="c_info">%s</th></tr>
@@ -490,26 +837,129 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
         if getattr(self, common.ATTR_PATH, "/") != "/":
             content += '      <tr class="hover-row"><td class="c_name"><a href="..">%s</a></td><td class="c_size">-</td><td class="c_mod">&nbsp;</td><td class="c_info">&nbsp;</td></tr>\n' % escape("<UP ONE LEVEL>")
+        yield content
+
+        rows = listing.rows
+        chunk = []
+        for i in order:
+            chunk.append(rows[i])
+            if len(chunk) >= self.listing_chunk_rows:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+        yield """
+        <tr><td colspan="5"></td></table>
+        """
+
+    def scan_directory(self, path, key):
+        """Build a listing of a directory in a single scandir() pass.
+        Returns None if the directory cannot be read.
+        """
+
+        try:
+            entries = list(scandir(path))
+        except os.error:
+            return None
+
+        listing = DirectoryListing(key)
+        names = []
+        mtimes = []
+        sizes = []
+        types = []
+
+        for entry in entries:
+
+            name = entry.name
+            if name.startswith(UPLOAD_PARTIAL_PREFIX) and name.endswith(UPLOAD_PARTIAL_SUFFIX):
+                # Upload in progress
+                continue
+
+            fullname = entry.path
+            displayname = linkname = name
+            extrainfo = ''
+            reachable = True
+            size = 0
+            size_display = '-'
+            obj_type = 'File'
+            mtime = 0.0
+            is_file = False
+
+            try:
+                if entry.is_symlink():
+
+                    # Note: a link to a directory displays with @ and links with /
+                    displayname = name + "@"
+                    reachable = not (args[TITLE_NO_LINKS] or (args[TITLE_LOCAL_LINKS] and not os.path.realpath(fullname).startswith(os.getcwd() + "/")))
+                    obj_type = 'Sym'
+
+                    if not reachable:
+                        # Symbolic link is inaccessible. Override extra info to plainly say 'symlink'.
+                        if args[TITLE_NO_LINKS]:
+                            extrainfo = "(Symlink)"
+                        else:
+                            # Implies local links only, meaning an unreachable link is external.
+                            extrainfo = "(External Symlink)"
+                    elif os.path.isdir(os.path.realpath(fullname)):
+                        # Directory via Symlink
+                        # Append / for directories or @ for symbolic links
+                        displayname = name + "/@"
+                        linkname = name + "/"
+
+                        extrainfo = "Symlink to directory <span class='path'>%s</span>" % escape(os.path.realpath(fullname))
+                    elif os.path.isfile(os.path.realpath(fullname)):
+                        # File via Symlink
+                        extrainfo = "Symlink to %s file <span class='path'>%s</span>" % (self.humansize(entry.stat().st_size), escape(os.path.realpath(fullname)))
+                        is_file = True
+                    else:
+                        # Dead symlink
+                        linkname = None
+                        extrainfo = "Dead symlink to <span class='path'>%s</span>" % os.readlink(fullname)
 
-        for item in items:
+                elif entry.is_dir():
+                    # Directory
+                    displayname = name + "/"
+                    linkname = name + "/"
+                    obj_type += 'Dir'
+                else:
+                    # File
+                    is_file = True
+
+                if reachable and is_file:
+                    st = entry.stat()
+                    size = st.st_size
+                    size_display = self.humansize(size)
+                    mtime = st.st_mtime
+            except os.error:
+                # Removed while being listed.
+                continue
 
             mtime_display = '&nbsp;'
-            if item.get('mtime'):
-                mtime_display = datetime.datetime.fromtimestamp(item.get('mtime')).strftime('%Y-%m-%d %H:%M:%S')
+            if mtime:
+                mtime_display = datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
 
-            if item.get('linkname') and item.get('reachable', False):
-                parts = (quote(item.get('linkname')), escape(item.get('displayname')), item.get('size_display'), mtime_display, item.get('extrainfo'))
-                content += '      <tr class="hover-row"><td class="c_name"><a href="%s">%s</a></td><td class="c_size">%s</td><td class="c_mod">%s</td><td class="c_info">%s</td></tr>\n' % parts
+            if linkname and reachable:
+                parts = (quote(linkname), escape(displayname), size_display, mtime_display, extrainfo)
+                row = '      <tr class="hover-row"><td class="c_name"><a href="%s">%s</a></td><td class="c_size">%s</td><td class="c_mod">%s</td><td class="c_info">%s</td></tr>\n' % parts
             else:
                 # Not reachable - dead symlink
-                parts = (escape(item.get('displayname')), item.get('size_display'), mtime_display, item.get('extrainfo'))
-                content += '      <tr class="hover-row"><td class="c_name s_dead">%s</td><td class="c_size">%s</td><td class="c_mod">%s</td><td class="c_info">%s</td></tr>\n' % parts
+                parts = (escape(displayname), size_display, mtime_display, extrainfo)
+                row = '      <tr class="hover-row"><td class="c_name s_dead">%s</td><td class="c_size">%s</td><td class="c_mod">%s</td><td class="c_info">%s</td></tr>\n' % parts
 
-        content += """
-        <tr><td colspan="5"></td></table>
-        """
+            listing.rows.append(row)
+            names.append(name.lower())
+            mtimes.append(mtime)
+            sizes.append(size)
+            types.append(obj_type)
 
-        return content
+        indices = range(len(listing.rows))
+        listing.orders[LABEL_CATEGORY_NAME] = sorted(indices, key=lambda i: names[i])
+        listing.orders[LABEL_CATEGORY_MTIME] = sorted(indices, key=lambda i: (mtimes[i], names[i]))
+        listing.orders[LABEL_CATEGORY_SIZE] = sorted(indices, key=lambda i: (sizes[i], names[i]))
+        listing.orders[LABEL_CATEGORY_TYPE] = sorted(indices, key=lambda i: (types[i], names[i]))
+
+        return listing
 
     def parse_header_range(self):
 
@@ -523,60 +973,43 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
         # Store bad-range response in a central place
         response_bad = lambda : self.send_error(400, 'Bad Request Range Header')
 
-        p1 = r'^bytes=(\d+\-\d*|\d*-\d+)(, (\d+\-\d*|\d*-\d+))?$'
-        p2 = r'^(\d+\-\d*|\d*-\d+)$'
-
-        match = re.match(p1, header_range)
-        if not match:
-            return response_bad()
-
-        groupings = [g for g in match.groups() if re.match(p2, str(g))]
-
-        conv = lambda v, i: int(v.split('-')[i] or 0)
-        ranges = sorted([[conv(g, 0), conv(g, 1)] for g in groupings], key=lambda a: a[0])
-
-        for r in ranges:
-            start = r[0]
-            end = r[1]
+        unit, _, specs = header_range.partition('=')
+        if unit.strip().lower() != 'bytes':
+            # Range units other than bytes are to be ignored.
+            return True
 
-            if not end and not start:
-                # Request for '0-0' (that is to say, the entire thing)
-                # Chrome does this for video files, for instance
+        # Ranges are kept as requested, they can only be made sense of
+        #   once the length of the content is known (see resolve_ranges).
+        ranges = []
+        for spec in specs.split(','):
+            spec = spec.strip()
+            if not spec:
+                # Empty list elements are allowed
                 continue
 
-            if end == start or end and end < start:
-                return response_bad()
-
-        ranges_b = [ranges[0]]
-
-        for r in ranges[1:]:
-            start = r[0]
-            end = r[1]
-
-            if not start:
-                # No non-first range may start at 0.
-                return response_bad()
-
-            if not ranges_b[-1][1]:
-                # No non-last ranges may end at 0.
+            match = re.match(r'^(\d*)-(\d*)$', spec)
+            if not match or not (match.group(1) or match.group(2)):
                 return response_bad()
 
-            if start - 1 == ranges_b[-1][1]:
-                # If multiple neighboring ranges are given, then merge them together
-                ranges_b[-1][1] = end
+            first, last = match.groups()
+            if not first:
+                # Suffix range ('-500'), the last 500 bytes
+                ranges.append((None, int(last)))
                 continue
 
-            if start <= ranges_b[-1][1]:
-                # Ranges may not overlap
-                return response_bad()
-
-            ranges_b.append([start, end])
+            start = int(first)
+            end = None # Open-ended ('100-'), runs to the end of the content
+            if last:
+                end = int(last)
+                if end < start:
+                    return response_bad()
+            ranges.append((start, end))
 
-        self.ranges = [(r[0], r[1]) for r in ranges_b]
+        if not ranges:
+            return response_bad()
 
-        if len(self.ranges) >= 2:
-            # The script currently does not support handling multiple ranges
-            return self.send_error(501, "Multiple ranges not supported" % self.command)
+        if len(ranges) <= self.max_ranges:
+            self.ranges = ranges
 
         return True
 
@@ -592,38 +1025,101 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
         return '<a href="%s%s">%s</a>' % (quote(self.path), get, label)
 
-    def serve_content(self, content = None, code = 200, mimetype = "text/html"):
+    def reset_request(self):
+        super(SimpleHTTPVerboseReqeustHandler, self).reset_request()
+        self.clip = False
+        self.parts = []
+        self.parts_trailer = None
+        self.ranges = []
 
-        f, length = self.serve_content_prepare(content)
+    def resolve_ranges(self, length):
+        """Turn requested ranges into inclusive (start, end) offsets within content of the given length.
+        Unsatisfiable ranges are dropped, and overlapping or adjacent ranges are merged.
+        """
 
-        if self.ranges:
+        resolved = []
+        for start, end in self.ranges:
+            if start is None:
+                if not end or not length:
+                    # Nothing to take the last bytes of.
+                    continue
+                start = max(0, length - end)
+                end = length - 1
+            elif start >= length:
+                continue
+            elif end is None or end >= length:
+                end = length - 1
+            resolved.append([start, end])
+
+        merged = []
+        for r in sorted(resolved):
+            if merged and r[0] <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], r[1])
+            else:
+                merged.append(r)
+        return [(r[0], r[1]) for r in merged]
 
-            start, end = self.ranges[0]
-            if end >= length:
-                return self.send_error(416)
+    def send_upload_progress(self, code, received):
+        self.send_response(code)
+        if received:
+            self.send_header('Range', 'bytes=0-%d' % (received - 1))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
 
-            if code == 200:
-                # Clip 200 content, not error content
-                code = 206
-                self.clip = True
-                length_total = length
-                length = end - start + 1 # Account for zero-indexing
+    def send_ranges(self, length, ctype):
+        """Send the status and framing headers for the requested ranges of content, readying copyobj() to send them.
+        A single range is sent as-is, several as a multipart/byteranges body.
+        Returns False if no range could be satisfied, in which case a 416 response has been sent in full.
+        """
 
-        self.send_response(code)
-        self.send_common_headers(mimetype, length)
+        ranges = self.resolve_ranges(length)
+        if not ranges:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % length)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+
+        self.clip = True
+        self.send_response(206)
         self.send_header('Accept-Ranges', 'bytes')
-        if getattr(self, 'clip', False):
 
-            display_values = {
-                'start': start,
-                'end': length-1,
-                'total': length_total
-            }
-            if end:
-                display_values['end'] = end
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.parts = [(None, start, end)]
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, length))
+            self.send_header('Content-Length', str(end - start + 1))
+            return True
+
+        boundary = common.convert_str(binascii.hexlify(os.urandom(16)))
+        self.parts = [(common.convert_bytes('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, ctype, start, end, length)), start, end) for start, end in ranges]
+        self.parts_trailer = common.convert_bytes('\r\n--%s--\r\n' % boundary)
+
+        body_length = len(self.parts_trailer)
+        for header, start, end in self.parts:
+            body_length += len(header) + end - start + 1
+        self.send_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+        self.send_header('Content-Length', str(body_length))
+        return True
+
+    def serve_content(self, content = None, code = 200, mimetype = "text/html"):
+
+        if self.ranges and content and code == 200:
+            # Clip 200 content, not error content
+            data = common.convert_bytes(content)
+            if not self.send_ranges(len(data), "%s; charset=%s" % (mimetype, sys.getfilesystemencoding())):
+                return None
+            self.end_headers()
+            return BytesIO(data)
 
-            self.send_header('Content-Range', 'bytes %(start)d-%(end)d/%(total)d' % display_values)
+        f, length, encoding = self.serve_content_prepare_encoded(content, mimetype)
 
+        self.send_response(code)
+        self.send_common_headers(mimetype, length)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_encoding_headers(mimetype, encoding)
         self.end_headers()
         return f
 
@@ -639,35 +1135,49 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
             # transmitted *less* than the content-length!
             f = open(path, 'rb')
             fs = os.fstat(f.fileno())
-            length = fs[6]
-            if self.ranges:
-                start, end = self.ranges[0]
 
-                if end >= length:
-                    return self.send_error(416)
+            if_range = self.headers["If-Range"]
+            if if_range and if_range not in (self.file_etag(fs), self.date_time_string(fs.st_mtime)):
+                # The client's partial copy is out of date, send the whole file instead.
+                self.ranges = []
 
-                self.clip = True
-                length_total = length
-                length = end - start + 1 # Account for zero-indexing
+            length = fs[6]
+            encoding = None
+            compress = False
+            if not self.ranges:
+                # Ranges are always served out of the file as-is.
+                f, length, encoding, compress = self.get_file_encoding(path, f, fs, ctype)
+
+            if self.check_not_modified(fs, encoding):
+                f.close()
+                return self.send_not_modified(fs, ctype, encoding)
         except IOError:
             return self.send_error(404, 'Not Found')
 
+        if self.ranges:
+            if not self.send_ranges(fs.st_size, ctype):
+                f.close()
+                return None
+            self.send_encoding_headers(ctype)
+            self.send_cache_headers(fs)
+            self.end_headers()
+            return f
+
         self.send_response(200)
         self.send_header("Content-Type", ctype)
-        self.send_header("Content-Length", str(length))
-
-        if getattr(self, 'clip', False):
-
-            display_values = {
-                'start': start,
-                'end': length-1,
-                'total': length_total
-            }
-            if end:
-                display_values['end'] = end
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_encoding_headers(ctype, encoding)
+        self.send_cache_headers(fs, encoding)
+
+        if compress:
+            # Compressed size is not known up front.
+            dst = common.CompressingWriter(self.send_content_framing(), encoding)
+            self.end_headers()
+            self.copyobj(f, dst)
+            dst.close()
+            return None
 
-            self.send_header('Content-Range', 'bytes %(start)d-%(end)d/%(total)d' % display_values)
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_header("Content-Length", str(length))
         self.end_headers()
         return f
 
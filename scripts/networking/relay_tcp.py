@@ -3,7 +3,7 @@
 from __future__ import print_function
 
 # General
-import getopt, os, random, re, sys
+import binascii, bisect, getopt, json, os, random, re, signal, sys
 
 # Networking
 import errno, fcntl, select, socket, ssl, struct, time
@@ -29,6 +29,10 @@ else:
     # May as well set the proper EPOLLRDHUP value
     EPOLLRDHUP = 0x2000
 
+# os.splice() was added in Python 3.10, and is only present on Linux.
+# Without it, plaintext sessions fall back to recv_into() with a large buffer.
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
 #
 # Common Colours and Message Functions
 ###
@@ -505,50 +509,91 @@ class OptArg:
 
 
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
-    REGEX_INET4_CIDR = '^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
+    # Rules are compiled into sorted, non-overlapping (start, end) ranges of integers and
+    #  checked with a binary search, so a check costs the same for 10 rules as for 100,000.
+    # Addresses live in IPv6 space, with IPv4 mapped into ::ffff:0:0/96, so that one set
+    #  of ranges covers both families (and IPv4-mapped clients on dual-stack sockets).
+
+    # Decisions are remembered per address string, up to this many addresses.
+    CACHE_SIZE = 65536
+    IPV4_MAPPED = 0xFFFF << 32
 
     def __init__(self):
         self.errors = []
-        self.allowed_addresses = []
-        self.allowed_networks = []
-        self.denied_addresses = []
-        self.denied_networks = []
-
-    def add_access(self, addr_list, net_list, candidate):
-        candidate = candidate.strip()
-        if re.match(self.REGEX_INET4_CIDR, candidate):
-            good, net, bits = self.ip_validate_cidr(candidate)
-            if good:
-                # No error
-                net_list.append((candidate, net, bits))
+        # Rules are (candidate, resolved address, start, end, source file) tuples.
+        self.allowed = []
+        self.denied = []
+        # Calls that built the rules, replayed by reload()
+        self.sources = []
+        self.compiled = None
+
+    def add_access(self, rules, candidate, path=None):
+        # Comments and blank lines are allowed, mostly for the benefit of access files.
+        candidate = candidate.split('#', 1)[0].strip()
+        if not candidate:
+            return True
+
+        address, slash, bits = candidate.partition('/')
+        try:
+            resolved = address
+            value, width = self.ip_ston(address)
+        except (OSError, ValueError):
+            try:
+                resolved = socket.gethostbyname(address)
+                value, width = self.ip_ston(resolved)
+            except (OSError, ValueError):
+                if slash:
+                    self.errors.append(
+                        "Invalid CIDR address: %s"
+                        % colour_text(candidate, COLOUR_GREEN)
+                    )
+                else:
+                    self.errors.append(
+                        "Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN)
+                    )
+                return False
+
+        if slash:
+            if not bits.isdigit() or int(bits) > width:
+                self.errors.append(
+                    "Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN)
+                )
+                return False
+            host_bits = width - int(bits)
         else:
-            good, a, astr = self.ip_validate_address(candidate)
-            if good:
-                # No error
-                addr_list.append((a, candidate, astr))
-        return good
+            host_bits = 0
+
+        start = value >> host_bits << host_bits
+        rules.append((candidate, resolved, start, start | ((1 << host_bits) - 1), path))
+        self.compiled = None
+        return True
 
     def add_blacklist(self, candidate):
-        return self.add_access(self.denied_addresses, self.denied_networks, candidate)
+        self.sources.append(('add_blacklist', candidate))
+        return self.add_access(self.denied, candidate)
 
     def add_whitelist(self, candidate):
-        return self.add_access(self.allowed_addresses, self.allowed_networks, candidate)
+        self.sources.append(('add_whitelist', candidate))
+        return self.add_access(self.allowed, candidate)
 
     def announce_filter_actions(self):
-        for action, address_list, network_list in [
-            ("Allowing", self.allowed_addresses, self.allowed_networks),
-            ("Denying", self.denied_addresses, self.denied_networks),
-        ]:
-            l = []
-            l.extend([("address", s, i) for n, s, i in address_list])
-            l.extend([("network", s, s) for n, s in network_list])
-
-            for title, ip, address in l:
-                if ip == address:
+        for action, rules in [("Allowing", self.allowed), ("Denying", self.denied)]:
+            files = []
+            for candidate, resolved, start, end, path in rules:
+                if path:
+                    # Access files can be very large, so they are summarized instead.
+                    if path not in files:
+                        files.append(path)
+                    continue
+
+                title = "address"
+                if '/' in candidate:
+                    title = "network"
+
+                if candidate.partition('/')[0] == resolved:
                     print_notice(
                         "%s %s: %s"
-                        % (action, title, colour_text(address, COLOUR_GREEN))
+                        % (action, title, colour_text(candidate, COLOUR_GREEN))
                     )
                 else:
                     print_notice(
@@ -556,11 +601,42 @@ class NetAccess:
                         % (
                             action,
                             title,
-                            colour_text(address, COLOUR_GREEN),
-                            colour_text(ip, COLOUR_GREEN),
+                            colour_text(candidate, COLOUR_GREEN),
+                            colour_text(resolved, COLOUR_GREEN),
                         )
                     )
 
+            for path in files:
+                count = len([r for r in rules if r[4] == path])
+                print_notice(
+                    "%s %s addresses/ranges from file: %s"
+                    % (action, colour_text(count), colour_text(path, COLOUR_GREEN))
+                )
+
+    def compile(self):
+        self.compiled = (
+            self.compile_ranges(self.allowed),
+            self.compile_ranges(self.denied),
+            {},
+        )
+        return self.compiled
+
+    def compile_ranges(self, rules):
+        # Merge overlapping and adjacent ranges into parallel lists of starts and ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(r[2], r[3]) for r in rules]):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return (starts, ends)
+
+    def in_ranges(self, ranges, ip):
+        i = bisect.bisect_right(ranges[0], ip) - 1
+        return i >= 0 and ip <= ranges[1][i]
+
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
     def ip_strton(self, ip):
@@ -568,66 +644,50 @@ class NetAccess:
         a, b, c, d = struct.unpack('BBBB', socket.inet_aton(ip))
         return (a << 24) + (b << 16) + (c << 8) + d
 
-    def ip_validate_address(self, candidate):
-        try:
-            ip = socket.gethostbyname(candidate)
-            return (True, self.ip_strton(ip), ip)
-        except socket.gaierror:
-            self.errors.append(
-                "Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN)
+    def ip_ston(self, address):
+        # Convert an IPv4 or IPv6 address string to an integer in IPv6 space,
+        #  along with the number of bits in the address family.
+        if ':' in address:
+            # Drop any zone index (e.g. fe80::1%eth0)
+            address = address.split('%', 1)[0]
+            return (
+                int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, address)), 16),
+                128,
             )
-            return (False, None, None)
+        return (
+            self.IPV4_MAPPED
+            | int(binascii.hexlify(socket.inet_pton(socket.AF_INET, address)), 16),
+            32,
+        )
+
+    def is_allowed(self, address):
+        # Blacklist/Whitelist filtering
+        # A blacklist rule one-ups a whitelist rule in the event of a conflict.
+        allowed, denied, cache = self.compiled or self.compile()
+        if not allowed[0] and not denied[0]:
+            return True
 
-    def ip_validate_cidr(self, candidate):
-        a = candidate.split("/")[0]
-        m = int(candidate.split("/")[1])
+        result = cache.get(address)
+        if result is not None:
+            return result
 
         try:
-            # Will either succeed or throw an exception
-            ip = self.ip_strton(socket.gethostbyname(a))
-            if m <= 32:
-                return (True, ip, 32 - m)
-        except socket.gaierror:
-            pass
-        self.errors.append(
-            "Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN)
+            ip = self.ip_ston(address)[0]
+        except (OSError, ValueError):
+            # Not an address that any rule could match.
+            ip = -1
+
+        # Whitelist processing, address is not allowed until it is cleared.
+        result = (not allowed[0] or self.in_ranges(allowed, ip)) and not self.in_ranges(
+            denied, ip
         )
-        return (False, None, None)
 
-    def is_allowed(self, address):
-        # Blacklist/Whitelist filtering
-        allowed = True
-
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
-            # Compare string-form against allowed addresses
-            if address in [a[2] for a in self.allowed_addresses]:
-                allowed = True
-            else:
-                # Try checking allowed networks
-                ip = self.ip_strton(address)
-                for net, bits in [(n[1], n[2]) for n in self.allowed_networks]:
-                    if (net >> bits) == (ip >> bits):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
-            # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
-
-            if address in [a[2] for a in self.denied_addresses]:
-                allowed = False
-            else:
-                # Try checking denied networks
-                ip = self.ip_strton(address)
-                for net, bits in [(n[1], n[2]) for n in self.denied_networks]:
-                    if (net >> bits) == (ip >> bits):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(self, fn, path, header):
+        if len(cache) >= self.CACHE_SIZE:
+            cache.clear()
+        cache[address] = result
+        return result
+
+    def load_access_file(self, rules, path, header):
         if not os.path.isfile(path):
             self.errors.append(
                 "Path to %s file does not exist: %s"
@@ -635,24 +695,64 @@ class NetAccess:
             )
             return False
         with open(path) as f:
-            for l in f.readlines():
-                fn(l)
+            for l in f:
+                self.add_access(rules, l, path)
+        return True
 
     def load_blacklist_file(self, path):
-        return self.load_access_file(self.add_blacklist, path, "blacklist")
+        self.sources.append(('load_blacklist_file', path))
+        return self.load_access_file(self.denied, path, "blacklist")
 
     def load_whitelist_file(self, path):
-        return self.load_access_file(self.add_whitelist, path, "whitelist")
+        self.sources.append(('load_whitelist_file', path))
+        return self.load_access_file(self.allowed, path, "whitelist")
+
+    def reload(self):
+        # Rebuild the rules from the same addresses and files that they were first loaded from.
+        # The new rules replace the old ones in one step, and only if all of them loaded cleanly.
+        # Returns a list of errors, which is empty on success.
+        fresh = type(self)()
+        for method, value in self.sources:
+            getattr(fresh, method)(value)
+        if fresh.errors:
+            return fresh.errors
+
+        compiled = fresh.compile()
+        self.allowed = fresh.allowed
+        self.denied = fresh.denied
+        self.compiled = compiled
+        return []
+
+    def reload_on_signal(self, signum=signal.SIGHUP):
+        # Reload rules whenever the process receives a signal (SIGHUP by default).
+        # Signal handlers can only be set from the main thread.
+        def handler(signum, frame):
+            errors = self.reload()
+            for e in errors:
+                print_error(e)
+            if errors:
+                print_warning("Keeping the previous access rules.")
+            else:
+                print_notice("Reloaded access rules.")
+
+        signal.signal(signum, handler)
 
 
 # Script Classes
 
 TITLE_BIND = "bind"
+TITLE_BUFFER_SIZE = "buffer-size"
 TITLE_PORT = "port"
 TITLE_VERBOSE = "verbose"
+TITLE_WORKERS = "workers"
 
+TITLE_BALANCE_LEAST_CONNECTIONS = "least-connections"
+TITLE_BALANCE_LEAST_LATENCY = "least-latency"
 TITLE_BALANCE_RANDOM = "random-target"
 TITLE_BALANCE_ROUND_ROBIN = "round-robin"
+TITLE_HEALTH_INTERVAL = "health-interval"
+TITLE_METRICS_BIND = "metrics-bind"
+TITLE_METRICS_PORT = "metrics-port"
 
 TITLE_TARGET_PORT = "target-port"
 TITLE_TARGET_SSL = "target-ssl"
@@ -672,6 +772,9 @@ class TcpRelayServer:
     DEFAULT_BIND = "0.0.0.0"
     DEFAULT_PORT = 4444
     DEFAULT_TARGET_PORT = 4444
+    DEFAULT_BUFFER_SIZE = 65536
+    DEFAULT_HEALTH_INTERVAL = 5.0
+    DEFAULT_METRICS_BIND = "127.0.0.1"
 
     def __init__(self):
 
@@ -713,6 +816,40 @@ class TcpRelayServer:
             default=self.DEFAULT_TARGET_PORT,
             default_announce=True,
         )
+        args.add_opt(
+            OPT_TYPE_LONG,
+            TITLE_WORKERS,
+            TITLE_WORKERS,
+            'Number of worker processes to relay connections with. Each worker listens on the bind port with SO_REUSEPORT.',
+            converter=int,
+            default=1,
+            default_announce=True,
+        )
+        args.add_opt(
+            OPT_TYPE_LONG,
+            TITLE_METRICS_PORT,
+            TITLE_METRICS_PORT,
+            'Serve Prometheus metrics over HTTP at /metrics on this port. With multiple workers, worker N listens on this port + N - 1.',
+            converter=int,
+        )
+        args.add_opt(
+            OPT_TYPE_LONG,
+            TITLE_METRICS_BIND,
+            TITLE_METRICS_BIND,
+            'Address to serve metrics on.',
+            default=self.DEFAULT_METRICS_BIND,
+            default_announce=True,
+            default_colour=COLOUR_GREEN,
+        )
+        args.add_opt(
+            OPT_TYPE_LONG,
+            TITLE_BUFFER_SIZE,
+            TITLE_BUFFER_SIZE,
+            'Bytes to buffer in each direction of a session before reading from the sender is paused.',
+            converter=int,
+            default=self.DEFAULT_BUFFER_SIZE,
+            default_announce=True,
+        )
         args.add_opt(
             OPT_TYPE_LONG_FLAG,
             TITLE_TARGET_SSL,
@@ -738,6 +875,27 @@ class TcpRelayServer:
             TITLE_BALANCE_ROUND_ROBIN,
             'Rotate between targets (default).',
         )
+        args.add_opt(
+            OPT_TYPE_LONG_FLAG,
+            TITLE_BALANCE_LEAST_CONNECTIONS,
+            TITLE_BALANCE_LEAST_CONNECTIONS,
+            'Select the target with the fewest active sessions.',
+        )
+        args.add_opt(
+            OPT_TYPE_LONG_FLAG,
+            TITLE_BALANCE_LEAST_LATENCY,
+            TITLE_BALANCE_LEAST_LATENCY,
+            'Select the target with the lowest average connect time.',
+        )
+        args.add_opt(
+            OPT_TYPE_LONG,
+            TITLE_HEALTH_INTERVAL,
+            TITLE_HEALTH_INTERVAL,
+            'Seconds between connection checks on multiple targets. Unresponsive targets are taken out of rotation. Set to 0 to disable.',
+            converter=float,
+            default=self.DEFAULT_HEALTH_INTERVAL,
+            default_announce=True,
+        )
 
         args.add_opt(
             OPT_TYPE_SHORT,
@@ -785,34 +943,58 @@ class TcpRelayServer:
         self.args = args
 
         self.active_fds = set()
+        self.health_checks = {}
+        self.health_check_next = 0
+        self.pending_reads = set()
         self.sessions = {}
+        self.stats = TcpRelayStats()
         self.targets = []
+        self.worker = None
+
+    def can_splice(s):
+        # Data can only be moved kernel-to-kernel when neither side is SSL-wrapped.
+        return (
+            SPLICE_AVAILABLE
+            and not s.args[TITLE_SSL_CERT]
+            and not s.args[TITLE_TARGET_SSL]
+            and not s.args[TITLE_TARGET_SSL_INSECURE]
+        )
+
+    def get_metrics_port(s):
+        return s.metrics_port + max(s.worker or 1, 1) - 1
+
+    def get_healthy_targets(s):
+        # If every target is failing its checks, keep trying all of them rather than refusing clients.
+        return [t for t in s.targets if t.healthy] or s.targets
+
+    def get_target_least_connections(s):
+        return min(s.get_healthy_targets(), key=lambda t: t.active)
+
+    def get_target_least_latency(s):
+        # Targets without a measurement yet sort first so that they get one.
+        return min(s.get_healthy_targets(), key=lambda t: (t.latency or 0, t.active))
+
+    def get_target_random(s):
+        return random.choice(s.get_healthy_targets())
 
     def get_target_round_robin(s):
-        s._round_robin_index = (getattr(s, '_round_robin_index', -1) + 1) % len(
-            s.targets
-        )
-        return s.targets[s._round_robin_index]
+        targets = s.get_healthy_targets()
+        s._round_robin_index = (getattr(s, '_round_robin_index', -1) + 1) % len(targets)
+        return targets[s._round_robin_index]
 
     def init_server(self):
         self.server_socket = self.new_socket()
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        if self.args[TITLE_SSL_CERT]:
-            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            ctx.load_cert_chain(
-                self.args[TITLE_SSL_CERT], keyfile=self.args[TITLE_SSL_KEY]
-            )
+        if self.worker is not None:
+            # Every worker binds its own listener, and the kernel spreads connections between them.
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.server_ctx:
             self.init_socket(self.server_socket)
-            self.server_socket = ctx.wrap_socket(
+            self.server_socket = self.server_ctx.wrap_socket(
                 self.server_socket, server_side=True, do_handshake_on_connect=False
             )
 
-        self.client_ctx = None
-        if self.args[TITLE_TARGET_SSL] or self.args[TITLE_TARGET_SSL_INSECURE]:
-            self.client_ctx = ssl.create_default_context()
-            if self.args[TITLE_TARGET_SSL_INSECURE]:
-                self.client_ctx.check_hostname = False
-                self.client_ctx.verify_mode = ssl.CERT_NONE
+        self.splice = self.can_splice()
 
         self.server_socket.bind((self.args[TITLE_BIND], self.port))
         self.server_socket.listen(50)
@@ -820,8 +1002,39 @@ class TcpRelayServer:
         self.epoll_socket = select.epoll()
         self.register_socket(self.server_socket, EPOLLIN | EPOLLET)
 
+        self.metrics = None
+        if self.metrics_port:
+            addr = (self.args[TITLE_METRICS_BIND], self.get_metrics_port())
+            try:
+                self.metrics = MetricsListener(self, addr)
+            except OSError as e:
+                print_error(
+                    'Unable to serve metrics on %s: %s' % (colour_addr(*addr), e)
+                )
+                return False
+
         return True
 
+    def init_ssl(self):
+        # SSL contexts are created before any worker processes are forked. OpenSSL generates
+        #   session ticket keys when a context is created, so every worker can resume
+        #   sessions that were started on another worker.
+        self.server_ctx = None
+        if self.args[TITLE_SSL_CERT]:
+            self.server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.server_ctx.load_cert_chain(
+                self.args[TITLE_SSL_CERT], keyfile=self.args[TITLE_SSL_KEY]
+            )
+            # Let returning clients skip the full handshake with session tickets.
+            self.server_ctx.options &= ~ssl.OP_NO_TICKET
+
+        self.client_ctx = None
+        if self.args[TITLE_TARGET_SSL] or self.args[TITLE_TARGET_SSL_INSECURE]:
+            self.client_ctx = ssl.create_default_context()
+            if self.args[TITLE_TARGET_SSL_INSECURE]:
+                self.client_ctx.check_hostname = False
+                self.client_ctx.verify_mode = ssl.CERT_NONE
+
     def init_socket(s, so):
         os.set_blocking(so.fileno(), False)
         so.setblocking(False)
@@ -884,10 +1097,19 @@ class TcpRelayServer:
                 print_notice('  * %s' % t)
 
             if s.args[TITLE_BALANCE_RANDOM]:
-                s.get_target = lambda: s.targets[random.randint(0, len(s.targets) - 1)]
+                s.get_target = s.get_target_random
+            elif s.args[TITLE_BALANCE_LEAST_CONNECTIONS]:
+                s.get_target = s.get_target_least_connections
+            elif s.args[TITLE_BALANCE_LEAST_LATENCY]:
+                s.get_target = s.get_target_least_latency
             else:
                 s.get_target = s.get_target_round_robin
 
+            if s.health_interval:
+                print_notice(
+                    'Checking targets every %s seconds' % colour_text(s.health_interval)
+                )
+
         if s.args[TITLE_SSL_CERT]:
             print_notice(
                 'SSL-encrypting incoming data with certificate: %s'
@@ -901,6 +1123,34 @@ class TcpRelayServer:
             if s.args[TITLE_TARGET_SSL_INSECURE]:
                 print_notice('SSL certificate verification is disabled.')
 
+        if s.verbose and s.can_splice():
+            print_notice(
+                'Relaying data between sockets with %s' % colour_text('splice()')
+            )
+
+        if s.args[TITLE_WORKERS] > 1:
+            print_notice(
+                'Relaying with %s worker processes' % colour_text(s.args[TITLE_WORKERS])
+            )
+
+        if s.metrics_port:
+            print_notice(
+                'Serving metrics at http://%s/metrics'
+                % colour_addr(s.args[TITLE_METRICS_BIND], s.metrics_port)
+            )
+
+    def print_stats_summary(s, stats):
+        # stats: List of (worker, pid, TcpRelayStats) tuples.
+        total = TcpRelayStats()
+        for worker, pid, worker_stats in stats:
+            total.add(worker_stats)
+            if len(stats) > 1:
+                print_notice(
+                    'Worker #%s (PID %s): %s'
+                    % (colour_text(worker), colour_text(pid), worker_stats)
+                )
+        print_notice('Total: %s' % total)
+
     def register_session(s, session):
         if session.src not in s.sessions:
             s.sessions[session.src.fileno()] = session
@@ -942,21 +1192,55 @@ class TcpRelayServer:
     def run(self):
         self.args.process(sys.argv)
         self.print_summary()
+        self.init_ssl()
+
+        if self.access.sources:
+            # Re-read access rules and files on SIGHUP. Workers inherit this handler.
+            self.access.reload_on_signal()
+
+        if self.args[TITLE_WORKERS] > 1:
+            return self.run_workers()
 
+        try:
+            return self.run_server()
+        finally:
+            if self.verbose:
+                self.print_stats_summary([(0, os.getpid(), self.stats)])
+
+    def run_server(self):
         if not self.init_server():
             return 1
 
         try:
             while True:
-                events = self.epoll_socket.poll(1)
+                if self.health_interval:
+                    self.run_health_checks()
+
+                if self.metrics:
+                    self.metrics.expire()
+
+                if self.pending_reads:
+                    # Some sockets already have data waiting that epoll will not report.
+                    events = self.epoll_socket.poll(0)
+                    events.extend([(fd, EPOLLIN) for fd in self.pending_reads])
+                    self.pending_reads.clear()
+                else:
+                    events = self.epoll_socket.poll(1)
+
+                loop_started = time.time()
                 for fd, event in events:
-                    if fd == self.server_socket.fileno():
+                    if self.metrics and fd in self.metrics:
+                        self.metrics.handle(fd, event)
+                    elif fd in self.health_checks:
+                        self.health_checks[fd].handle(event)
+                    elif fd == self.server_socket.fileno():
                         try:
                             while True:
                                 sock, addr = self.server_socket.accept()
                                 self.init_socket(sock)
 
                                 if not self.access.is_allowed(addr[0]):
+                                    self.stats.denied += 1
                                     sock.shutdown(socket.SHUT_RDWR)
                                     sock.close()
                                     continue
@@ -968,12 +1252,188 @@ class TcpRelayServer:
                         continue
                     else:
                         session = self.sessions.get(fd)
-                        session.handle_data(fd, event)
+                        if session:
+                            # Session may have been closed earlier in this batch of events.
+                            session.handle_data(fd, event)
+
+                if events:
+                    self.stats.loops += 1
+                    self.stats.loop_seconds += time.time() - loop_started
 
         finally:
             self.shutdown()
         return 0
 
+    def render_metrics(s):
+        labels = {}
+        if s.worker:
+            labels['worker'] = s.worker
+        st = s.stats
+
+        def target_samples(fn, suffix=''):
+            return [
+                (suffix, dict(labels, target='%s:%s' % t.get_addr()), fn(t))
+                for t in s.targets
+            ]
+
+        return ''.join(
+            [
+                render_metric(
+                    'relay_tcp_sessions_opened_total',
+                    'counter',
+                    'Sessions accepted.',
+                    [('', labels, st.sessions)],
+                ),
+                render_metric(
+                    'relay_tcp_sessions_active',
+                    'gauge',
+                    'Sessions currently open.',
+                    [('', labels, sum([t.active for t in s.targets]))],
+                ),
+                render_metric(
+                    'relay_tcp_sessions_failed_total',
+                    'counter',
+                    'Sessions that failed to connect or complete an SSL handshake.',
+                    [('', labels, st.failed)],
+                ),
+                render_metric(
+                    'relay_tcp_connections_denied_total',
+                    'counter',
+                    'Connections refused by access rules.',
+                    [('', labels, st.denied)],
+                ),
+                render_metric(
+                    'relay_tcp_ssl_resumed_total',
+                    'counter',
+                    'SSL handshakes that resumed a previous session.',
+                    [('', labels, st.resumed)],
+                ),
+                render_metric(
+                    'relay_tcp_bytes_total',
+                    'counter',
+                    'Bytes relayed.',
+                    [
+                        ('', dict(labels, direction='to_target'), st.bytes_up),
+                        ('', dict(labels, direction='to_client'), st.bytes_down),
+                    ],
+                ),
+                render_metric(
+                    'relay_tcp_loop_seconds',
+                    'summary',
+                    'Time spent handling each batch of epoll events.',
+                    [('_sum', labels, st.loop_seconds), ('_count', labels, st.loops)],
+                ),
+                render_metric(
+                    'relay_tcp_target_connect_seconds',
+                    'summary',
+                    'Time taken to connect to each target.',
+                    target_samples(lambda t: t.connect_seconds, '_sum')
+                    + target_samples(lambda t: t.connects, '_count'),
+                ),
+                render_metric(
+                    'relay_tcp_target_sessions_active',
+                    'gauge',
+                    'Sessions currently open to each target.',
+                    target_samples(lambda t: t.active),
+                ),
+                render_metric(
+                    'relay_tcp_target_healthy',
+                    'gauge',
+                    'Whether each target is in rotation.',
+                    target_samples(lambda t: int(t.healthy)),
+                ),
+            ]
+        )
+
+    def run_health_checks(self):
+        now = time.time()
+        for check in list(self.health_checks.values()):
+            if now - check.started > check.TIMEOUT:
+                check.finish(False)
+
+        if now < self.health_check_next:
+            return
+        self.health_check_next = now + self.health_interval
+
+        pending = [c.target for c in self.health_checks.values()]
+        for target in self.targets:
+            if target not in pending:
+                TargetHealthCheck(self, target)
+
+    def run_worker(self, worker, pipe):
+        # Runs in a forked child. Never returns to the caller.
+        self.worker = worker
+        # Undo the parent's SIGTERM forwarding so that the session cleanup in run_server() still happens.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        code = 1
+        try:
+            code = self.run_server()
+        except (KeyboardInterrupt, SystemExit):
+            code = 0
+        except Exception as e:
+            print_exception(e, 'worker #%d' % worker)
+        finally:
+            os.write(pipe, json.dumps(self.stats.to_dict()).encode())
+            os.close(pipe)
+            sys.stdout.flush()
+            os._exit(code)
+
+    def run_workers(self):
+        workers = {}
+        for worker in range(1, self.args[TITLE_WORKERS] + 1):
+            pipe_read, pipe_write = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(pipe_read)
+                self.run_worker(worker, pipe_write)
+            os.close(pipe_write)
+            workers[pid] = (worker, pipe_read)
+
+        def forward(signum, frame):
+            for pid in workers:
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, forward)
+        if self.access.sources:
+            signal.signal(signal.SIGHUP, forward)
+
+        code = 0
+        stats = []
+        while workers:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                # Workers are in the same process group, and received the same SIGINT.
+                print('')
+                code = 130
+                continue
+            except ChildProcessError:
+                break
+
+            worker, pipe = workers.pop(pid)
+            data = b''
+            chunk = os.read(pipe, 4096)
+            while chunk:
+                data += chunk
+                chunk = os.read(pipe, 4096)
+            os.close(pipe)
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status):
+                code = code or os.WEXITSTATUS(status)
+            if data:
+                stats.append((worker, pid, TcpRelayStats(**json.loads(data.decode()))))
+            else:
+                print_error(
+                    'Worker #%s (PID %s) exited without reporting statistics.'
+                    % (colour_text(worker), colour_text(pid))
+                )
+
+        self.print_stats_summary(sorted(stats, key=lambda i: i[0]))
+        return code
+
     def shutdown(s):
         for i in list(s.active_fds):
             s.unregister_descriptor(i)
@@ -996,7 +1456,7 @@ class TcpRelayServer:
         for i in args[TITLE_DENY]:
             a.add_blacklist(i)
         for i in args[TITLE_DENY_FILE]:
-            a.load_whitelist_file(i)
+            a.load_blacklist_file(i)
         return a.errors
 
     def validate_common_arguments(self, args):
@@ -1007,6 +1467,41 @@ class TcpRelayServer:
         if port_error:
             errors.append(port_error)
 
+        if args[TITLE_WORKERS] < 1:
+            errors.append(
+                'Worker count must be at least 1. Given: %s'
+                % colour_text(args[TITLE_WORKERS])
+            )
+        elif args[TITLE_WORKERS] > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            errors.append('Multiple workers require SO_REUSEPORT support.')
+
+        self.health_interval = args[TITLE_HEALTH_INTERVAL]
+        if self.health_interval < 0:
+            errors.append(
+                'Health check interval cannot be negative. Given: %s'
+                % colour_text(self.health_interval)
+            )
+        elif len(self.args.operands) < 2:
+            # Nowhere else to send clients, so there is no point in checking.
+            self.health_interval = 0
+
+        self.metrics_port = args[TITLE_METRICS_PORT]
+        if self.metrics_port is not None:
+            # Each worker takes its own port.
+            highest = 65536 - max(args[TITLE_WORKERS], 1)
+            if not 0 < self.metrics_port <= highest:
+                errors.append(
+                    'Metrics port must be 1-%s. Given: %s'
+                    % (highest, colour_text(self.metrics_port))
+                )
+
+        self.buffer_size = args[TITLE_BUFFER_SIZE]
+        if self.buffer_size < 4096:
+            errors.append(
+                'Buffer size must be at least 4096 bytes. Given: %s'
+                % colour_text(self.buffer_size)
+            )
+
         for target_items in [t.split(':') for t in self.args.operands]:
 
             target_ip, target_addr, target_err = self.resolve_target_address(
@@ -1050,7 +1545,12 @@ class TcpRelayServer:
             num_rotation_options = len(
                 [
                     i
-                    for i in [TITLE_BALANCE_RANDOM, TITLE_BALANCE_ROUND_ROBIN]
+                    for i in [
+                        TITLE_BALANCE_LEAST_CONNECTIONS,
+                        TITLE_BALANCE_LEAST_LATENCY,
+                        TITLE_BALANCE_RANDOM,
+                        TITLE_BALANCE_ROUND_ROBIN,
+                    ]
                     if args[i]
                 ]
             )
@@ -1125,9 +1625,15 @@ class TcpRelaySession:
     def __init__(s, srv, src_sock, addr):
         s.server = srv
         s.verbose = srv.verbose
+        srv.stats.sessions += 1
         s.target = srv.get_target()
+        s.target.active += 1
 
         s.running = True
+        s.started = time.time()
+        s.bytes_up = 0
+        s.bytes_down = 0
+        s.connect_started = None
         s.src = src_sock
         s.addr = addr
 
@@ -1140,6 +1646,11 @@ class TcpRelaySession:
         s.dst = srv.new_socket()
         srv.register_session(s)
 
+        # Data read from a socket waits in its buffer until the other socket can take it.
+        s.eof = False
+        s.buffers = {}
+        s.new_buffers()
+
         s.handle_connection()
 
     __str__ = lambda s: '%s->%s' % (colour_addr(s.addr[0], s.addr[1]), s.target)
@@ -1151,13 +1662,21 @@ class TcpRelaySession:
             try:
                 self.src.do_handshake()
                 self.state_client = STATE_CONNECTED
+                if self.src.session_reused:
+                    self.server.stats.resumed += 1
 
                 if self.verbose:
-                    print_notice('Client SSL initialized for %s' % str(self))
+                    print_notice(
+                        'Client SSL initialized for %s%s'
+                        % (str(self), self.describe_resumed(self.src))
+                    )
             except (SSLWantReadError, SSLWantWriteError, BlockingIOError) as e:
-                self.re_arm(self.src, EPOLLIN | EPOLLET | EPOLLRDHUP | EPOLLONESHOT)
+                # The client socket is not registered yet on its first handshake attempt.
+                self.server.register_socket(
+                    self.src, EPOLLIN | EPOLLET | EPOLLRDHUP | EPOLLONESHOT
+                )
             except (SSLError, OSError) as e:
-                self.shutdown()
+                self.shutdown(failed=True)
 
         rearm_server = False
         if self.running and self.state_server == STATE_UNCONNECTED:
@@ -1165,6 +1684,8 @@ class TcpRelaySession:
             target_addr = (self.target.ip, self.target.port)
             if self.verbose:
                 log_notice('Attempting: %s' % str(self))
+            if not self.connect_started:
+                self.connect_started = time.time()
 
             try:
                 try:
@@ -1177,15 +1698,18 @@ class TcpRelaySession:
                     if e.errno != errno.EISCONN:
                         raise
                 rearm_server = True
+                self.target.mark_success(time.time() - self.connect_started)
 
                 if self.verbose:
                     print_notice('Completed TCP connection: %s' % str(self))
 
                 if self.server.client_ctx:
+                    # Offer the last session from this target so that the handshake can be resumed.
                     self.dst = self.server.client_ctx.wrap_socket(
                         self.dst,
                         server_hostname=self.target.hostname,
                         do_handshake_on_connect=False,
+                        session=self.target.ssl_session,
                     )
 
                     self.state_server = STATE_UNINITIALIZED
@@ -1201,7 +1725,8 @@ class TcpRelaySession:
                 # OSError: Possibly a timeout, or no route to host.
                 if self.verbose:
                     log_error('Connection %s: %s' % (str(self), e))
-                self.shutdown()
+                self.target.mark_failure()
+                self.shutdown(failed=True)
 
         if self.running and self.state_server == STATE_UNINITIALIZED:
 
@@ -1212,44 +1737,61 @@ class TcpRelaySession:
                 rearm_server = True
 
                 self.state_server = STATE_CONNECTED
-                self.register_socket(self.src, TcpRelaySession.CLIENT_FLAGS)
+                self.server.register_socket(self.src, TcpRelaySession.CLIENT_FLAGS)
+                if self.dst.session_reused:
+                    self.server.stats.resumed += 1
+                self.save_session()
 
                 if self.verbose:
-                    print_notice('Server SSL initialized for %s' % str(self))
+                    print_notice(
+                        'Server SSL initialized for %s%s'
+                        % (str(self), self.describe_resumed(self.dst))
+                    )
             except (SSLWantReadError, SSLWantWriteError, BlockingIOError) as e:
                 self.re_arm(self.dst, TcpRelaySession.CLIENT_FLAGS)
             except ssl.SSLCertVerificationError as e:
+                self.target.ssl_session = None
                 if self.verbose:
                     print_error(
                         'Failed to verify SSL certificate for %s in %s: %s'
                         % (colour_blue(self.target.hostname), str(self), e)
                     )
-                self.shutdown()
+                self.shutdown(failed=True)
             except (SSLError, OSError) as e:
                 if self.verbose:
                     print_error('SSL handshake error error for %s: %s' % (str(self), e))
-                self.shutdown()
+                self.shutdown(failed=True)
 
         if rearm_server:
             self.re_arm(self.dst)
 
-    def handle_data(self, fd, event):
+    def describe_resumed(s, sock):
+        if sock.session_reused:
+            return ' (resumed session)'
+        return ''
 
-        if fd == self.src.fileno():
-            sock_in = self.src
-            sock_out = self.dst
+    def handle_data(self, fd, event):
 
+        from_client = fd == self.src.fileno()
+        if from_client:
             if event & EPOLLIN and self.state_client == STATE_UNINITIALIZED:
                 self.handle_connection()
         else:
-            sock_in = self.dst
-            sock_out = self.src
-
             if (event & EPOLLOUT and self.state_server == STATE_UNCONNECTED) or (
                 event & EPOLLIN and self.state_server == STATE_UNINITIALIZED
             ):
                 self.handle_connection()  # Update on pending connection. Try again.
 
+        if not self.running:
+            # Connection attempt failed and the session was closed.
+            return
+
+        # Pick sockets after handle_connection(), which replaces dst when it is SSL-wrapped.
+        if from_client:
+            sock_in, sock_out = self.src, self.dst
+        else:
+            sock_in, sock_out = self.dst, self.src
+
         if not (
             self.state_client == STATE_CONNECTED
             and self.state_server == STATE_CONNECTED
@@ -1257,44 +1799,129 @@ class TcpRelaySession:
             self.re_arm(sock_in)
             return
 
-        # Check for closing messages
-        closing = event & (EPOLLHUP | EPOLLRDHUP)
-        data = None
-        force_rearm = False
+        buffer_in = self.buffers[sock_in.fileno()]
+        buffer_out = self.buffers[sock_out.fileno()]
+        length = 0
 
-        if event & EPOLLPRI:
-            sock_out.send(sock_in.read(1, socket.MSG_OOB), socket.MSG_OOB)
+        try:
+            if event & EPOLLPRI:
+                sock_out.send(sock_in.recv(1, socket.MSG_OOB), socket.MSG_OOB)
 
-        if event & EPOLLIN:
-            try:
+            if event & EPOLLOUT:
+                # Room opened up on this socket. Flush anything from the other side that was waiting on it.
+                buffer_out.drain(sock_in)
+
+            if event & EPOLLIN and not self.eof and buffer_in.space():
                 # Note: Originally, I had a 'while True' loop inside of this try/catch
                 #        that broke when no data was read. This worked fine for vanilla
                 #        connections, but it did not play nice with calling SSLSocket.recv()
                 #        with a client->relay connection using SSL.
                 #       The solution seems to be to only read data once per invocation of epoll.poll()/handle_data()
+                try:
+                    length = buffer_in.fill(sock_in)
+                    if not length:
+                        self.eof = True
+                    elif sock_in is self.src:
+                        self.bytes_up += length
+                        self.server.stats.bytes_up += length
+                    else:
+                        self.bytes_down += length
+                        self.server.stats.bytes_down += length
+                except (SSLWantReadError, SSLWantWriteError, BlockingIOError):
+                    length = None
+
+            if buffer_in.pending:
+                buffer_in.drain(sock_out)
+        except (ConnectionError, OSError) as e:
+            if self.verbose:
+                log_error('Connection %s: %s' % (str(self), e))
+            self.shutdown()
+            return
 
-                data = sock_in.recv(1024)
-                if data:
-                    sock_out.send(data)
-            except (SSLWantReadError, SSLWantWriteError):
-                force_rearm = True
-            except socket.error as e:
-                print_exception(e, self)
+        if event & (EPOLLHUP | EPOLLERR) or (event & EPOLLRDHUP and length == 0):
+            # Double-check that no data was read before giving up on the socket.
+            self.eof = True
 
-        if closing and not (data or force_rearm):
-            self.shutdown()  # Double-check that no data was read
-        else:
-            self.re_arm(sock_in)  # Re-arm socket
+        if self.eof and (
+            event & EPOLLERR or not (buffer_in.pending or buffer_out.pending)
+        ):
+            # Only close once everything that was read has been delivered.
+            self.shutdown()
+            return
+
+        self.arm(sock_in)
+        self.arm(sock_out)
+
+    def arm(s, sock):
+        # Listen for reads while there is room to buffer them, and for writes while
+        #   there is data waiting to go out. A socket with neither is left idle until
+        #   its peer changes that.
+        flags = EPOLLET | EPOLLONESHOT
+        buffer_in = s.buffers[sock.fileno()]
+        if not s.eof and buffer_in.space():
+            flags |= EPOLLIN | EPOLLPRI | EPOLLRDHUP
+            if buffer_in.readable(sock):
+                # Decrypted data is already waiting in the SSL layer, so epoll will not report it.
+                s.server.pending_reads.add(sock.fileno())
+        if s.buffers[s.peer(sock).fileno()].pending:
+            flags |= EPOLLOUT
+        s.re_arm(sock, flags)
+
+    def close_buffers(s):
+        for buf in s.buffers.values():
+            buf.close()
+        s.buffers = {}
+
+    def new_buffers(s):
+        # Plaintext sessions move data through a kernel pipe for each direction.
+        # Everything else reads into a reusable buffer.
+        size = s.server.buffer_size
+        if s.server.splice:
+            try:
+                s.buffers[s.src.fileno()] = RelayPipe(size)
+                s.buffers[s.dst.fileno()] = RelayPipe(size)
+                return
+            except OSError as e:
+                # Most likely out of file descriptors.
+                if s.verbose:
+                    log_error('Unable to create splice pipes for %s: %s' % (str(s), e))
+                s.close_buffers()
+        s.buffers[s.src.fileno()] = RelayBuffer(size)
+        s.buffers[s.dst.fileno()] = RelayBuffer(size)
+
+    def peer(s, sock):
+        if sock.fileno() == s.src.fileno():
+            return s.dst
+        return s.src
 
     def re_arm(s, sock, flags=0):
         if s.running and sock.fileno() > 0:
             s.server.epoll_socket.modify(sock.fileno(), flags or s.CLIENT_FLAGS)
 
-    def shutdown(s):
+    def save_session(s):
+        # With TLS 1.3, session tickets arrive after the handshake, so this is also checked on shutdown.
+        if isinstance(s.dst, ssl.SSLSocket) and s.state_server == STATE_CONNECTED:
+            session = s.dst.session
+            if session and (session.has_ticket or session.id):
+                s.target.ssl_session = session
+
+    def shutdown(s, failed=False):
         if not s.running:
             return
+        if not failed:
+            s.save_session()
         if s.verbose:
-            log_notice('Closing: %s' % str(s))
+            log_notice(
+                'Closing: %s (%s bytes to target, %s bytes to client in %.1fs)'
+                % (
+                    str(s),
+                    colour_text(s.bytes_up),
+                    colour_text(s.bytes_down),
+                    time.time() - s.started,
+                )
+            )
+        if failed:
+            s.server.stats.failed += 1
 
         subjects = [
             (s.state_server, s.dst, True),
@@ -1303,6 +1930,7 @@ class TcpRelaySession:
         for state, sock, do_deregister in subjects:
             fd = sock.fileno()
             del s.server.sessions[fd]
+            s.server.pending_reads.discard(fd)
 
             if do_deregister:
                 s.server.unregister_socket(sock)
@@ -1313,18 +1941,324 @@ class TcpRelaySession:
                 pass
             sock.close()
 
+        s.close_buffers()
+        s.target.active -= 1
         s.running = False
 
 
+class RelayBuffer(object):
+    # Bounded buffer for data read from one socket that is waiting to be written to the other.
+
+    def __init__(s, size):
+        s.buffer = bytearray(size)
+        s.view = memoryview(s.buffer)
+        s.size = size
+        s.start = 0
+        s.end = 0
+        # SSL sockets must retry a failed write with the same length.
+        s.retry = 0
+
+    pending = property(lambda s: s.end - s.start)
+
+    def close(s):
+        s.view.release()
+
+    def drain(s, sock):
+        while s.pending:
+            length = s.retry or s.pending
+            try:
+                sent = sock.send(s.view[s.start : s.start + length])
+            except (SSLWantReadError, SSLWantWriteError):
+                s.retry = length
+                return
+            except BlockingIOError:
+                return
+            s.retry = 0
+            s.start += sent
+        s.start = s.end = 0
+
+    def fill(s, sock):
+        if s.end == s.size:
+            # Shift unsent data to the front to make room at the end.
+            s.buffer[: s.pending] = s.view[s.start : s.end]
+            s.start, s.end = 0, s.pending
+        length = sock.recv_into(s.view[s.end :])
+        s.end += length
+        return length
+
+    def readable(s, sock):
+        return isinstance(sock, ssl.SSLSocket) and sock.pending() > 0
+
+    def space(s):
+        return s.size - s.pending
+
+
+class RelayPipe(object):
+    # Kernel pipe used to move data from one socket to another with splice()
+    #   without copying it into Python.
+
+    def __init__(s, size):
+        s.pending = 0
+        s.full = False
+        s.fd_read, s.fd_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        s.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        try:
+            s.size = fcntl.fcntl(s.fd_write, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            # Requested size is above /proc/sys/fs/pipe-max-size. Use the default capacity.
+            s.size = fcntl.fcntl(s.fd_write, fcntl.F_GETPIPE_SZ)
+
+    def close(s):
+        for fd in (s.fd_read, s.fd_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def drain(s, sock):
+        while s.pending:
+            try:
+                sent = os.splice(s.fd_read, sock.fileno(), s.pending, flags=s.flags)
+            except BlockingIOError:
+                return
+            s.pending -= sent
+            s.full = False
+
+    def fill(s, sock):
+        try:
+            length = os.splice(sock.fileno(), s.fd_write, s.space(), flags=s.flags)
+        except BlockingIOError:
+            # Pipe capacity is counted in pages, so a pipe holding partial pages
+            #   can fill before its byte count says so. Stop reading until it drains.
+            s.full = s.pending > 0
+            raise
+        s.pending += length
+        return length
+
+    def readable(s, sock):
+        return False
+
+    def space(s):
+        if s.full:
+            return 0
+        return s.size - s.pending
+
+
+class MetricsListener(object):
+    # Minimal HTTP listener that serves Prometheus text-format metrics from the relay's own epoll loop.
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    TIMEOUT = 5
+
+    def __init__(s, srv, addr):
+        s.server = srv
+        s.clients = {}
+
+        s.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.socket.setblocking(False)
+        s.socket.bind(addr)
+        s.socket.listen(5)
+        srv.epoll_socket.register(s.socket.fileno(), EPOLLIN)
+
+    def __contains__(s, fd):
+        return fd == s.socket.fileno() or fd in s.clients
+
+    def close(s, fd):
+        sock = s.clients.pop(fd)[0]
+        s.server.epoll_socket.unregister(fd)
+        sock.close()
+
+    def expire(s):
+        now = time.time()
+        for fd in [fd for fd in s.clients if now - s.clients[fd][1] > s.TIMEOUT]:
+            s.close(fd)
+
+    def handle(s, fd, event):
+        if fd == s.socket.fileno():
+            try:
+                while True:
+                    sock, addr = s.socket.accept()
+                    sock.setblocking(False)
+                    s.clients[sock.fileno()] = [sock, time.time(), b'', None]
+                    s.server.epoll_socket.register(sock.fileno(), EPOLLIN)
+            except BlockingIOError:
+                pass
+            return
+
+        client = s.clients[fd]
+        sock = client[0]
+        try:
+            if client[3] is None:
+                data = sock.recv(4096)
+                client[2] += data
+                if not data or len(client[2]) > 8192:
+                    s.close(fd)
+                    return
+                if b'\r\n\r\n' not in client[2]:
+                    return
+                client[3] = s.respond(client[2])
+                s.server.epoll_socket.modify(fd, EPOLLOUT)
+
+            client[3] = client[3][sock.send(client[3]) :]
+            if not client[3]:
+                s.close(fd)
+        except BlockingIOError:
+            pass
+        except OSError:
+            s.close(fd)
+
+    def respond(s, request):
+        fields = request.split(b'\r\n', 1)[0].split()
+        if len(fields) > 1 and fields[1].split(b'?')[0] == b'/metrics':
+            status = '200 OK'
+            body = s.server.render_metrics().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not Found\n'
+        header = (
+            'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+            % (
+                status,
+                s.CONTENT_TYPE,
+                len(body),
+            )
+        )
+        return header.encode() + body
+
+
+def render_metric(name, metric_type, description, samples):
+    # samples: List of (suffix, labels, value) tuples, where labels is a dictionary.
+    #   The suffix is appended to the metric name (e.g. '_sum' and '_count' for summaries).
+    lines = ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, metric_type)]
+    for suffix, labels, value in samples:
+        label_text = ','.join(['%s="%s"' % (k, labels[k]) for k in sorted(labels)])
+        if label_text:
+            lines.append('%s%s{%s} %s' % (name, suffix, label_text, value))
+        else:
+            lines.append('%s%s %s' % (name, suffix, value))
+    return '\n'.join(lines) + '\n'
+
+
+class TcpRelayStats(object):
+    # Counters for a relay process. Kept as plain integers so that workers can
+    #   hand them back to the parent process as JSON.
+
+    FIELDS = (
+        'sessions',
+        'denied',
+        'failed',
+        'resumed',
+        'bytes_up',
+        'bytes_down',
+        'loops',
+        'loop_seconds',
+    )
+
+    def __init__(s, **kwargs):
+        for field in s.FIELDS:
+            setattr(s, field, kwargs.get(field, 0))
+
+    def __str__(s):
+        text = (
+            '%s sessions (%s denied, %s failed), %s bytes to targets, %s bytes to clients'
+            % (
+                colour_text(s.sessions),
+                colour_text(s.denied),
+                colour_text(s.failed),
+                colour_text(s.bytes_up),
+                colour_text(s.bytes_down),
+            )
+        )
+        if s.resumed:
+            text += ', %s resumed SSL handshakes' % colour_text(s.resumed)
+        return text
+
+    def add(s, other):
+        for field in s.FIELDS:
+            setattr(s, field, getattr(s, field) + getattr(other, field))
+
+    def to_dict(s):
+        return dict([(field, getattr(s, field)) for field in s.FIELDS])
+
+
 class RelayTarget(object):
+
+    # Consecutive failed connections before a target is taken out of rotation.
+    FAILURE_THRESHOLD = 2
+    # Weight of the newest sample in the connect latency average.
+    LATENCY_WEIGHT = 0.3
+
     def __init__(s, t_ip, t_port, t_host):
         s.ip = t_ip
         s.port = t_port
         s.hostname = t_host
 
+        s.active = 0
+        s.failures = 0
+        s.healthy = True
+        s.latency = None
+        s.connects = 0
+        s.connect_seconds = 0
+        # Last SSL session negotiated with this target, offered to resume the next connection.
+        s.ssl_session = None
+
     __str__ = lambda s: colour_addr(s.ip, s.port, s.hostname)
     get_addr = lambda s: (s.ip, s.port)
 
+    def mark_failure(s):
+        s.failures += 1
+        if s.healthy and s.failures >= s.FAILURE_THRESHOLD:
+            s.healthy = False
+            log_error('Target is not responding, removing from rotation: %s' % s)
+
+    def mark_success(s, latency):
+        s.failures = 0
+        s.connects += 1
+        s.connect_seconds += latency
+        if s.latency is None:
+            s.latency = latency
+        else:
+            s.latency += s.LATENCY_WEIGHT * (latency - s.latency)
+        if not s.healthy:
+            s.healthy = True
+            log_notice('Target is responding again, returning to rotation: %s' % s)
+
+
+class TargetHealthCheck(object):
+    # Non-blocking connection attempt to a target, completed through the relay's epoll loop.
+
+    TIMEOUT = 3
+
+    def __init__(s, srv, target):
+        s.server = srv
+        s.target = target
+        s.started = time.time()
+        s.sock = srv.new_socket()
+
+        result = s.sock.connect_ex(target.get_addr())
+        if result == errno.EINPROGRESS:
+            srv.register_socket(s.sock, EPOLLOUT | EPOLLONESHOT)
+            srv.health_checks[s.sock.fileno()] = s
+        else:
+            s.finish(not result)
+
+    def finish(s, success):
+        fd = s.sock.fileno()
+        if fd in s.server.health_checks:
+            del s.server.health_checks[fd]
+            s.server.unregister_descriptor(fd)
+        s.sock.close()
+
+        if success:
+            s.target.mark_success(time.time() - s.started)
+        else:
+            s.target.mark_failure()
+
+    def handle(s, event):
+        error = s.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        s.finish(not error and not event & EPOLLERR)
+
 
 # Run
 if __name__ == '__main__':
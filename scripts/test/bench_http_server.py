@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of request handling in the base CoreHttpServer handler.
+# Browser-like requests are pipelined into a handler over a loopback connection,
+#   each one answered with a small page, and the rate that they are answered at is reported.
+#
+# To compare before and after a change, point it at another copy of the module:
+#   git show HEAD~1:scripts/networking/http-servers/CoreHttpServer.py > /tmp/CoreHttpServer.py
+#   ./bench_http_server.py /tmp/CoreHttpServer.py
+#   ./bench_http_server.py
+
+import os, socket, sys, threading, time
+
+import common
+
+DEFAULT_PATH = common.TOOLS_DIR + '/scripts/networking/http-servers/CoreHttpServer.py'
+DEFAULT_REQUESTS = 20000
+ROUNDS = 5
+
+CONTENT = "<html><body><p>Hello</p></body></html>"
+
+REQUEST = (
+    "GET /index.html?view=list HTTP/1.1\r\n"
+    "Host: localhost:8080\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Language: en-CA,en-US;q=0.7,en;q=0.3\r\n"
+    "Accept-Encoding: gzip, deflate, br\r\n"
+    "Referer: http://localhost:8080/\r\n"
+    "Connection: %s\r\n"
+    "Upgrade-Insecure-Requests: 1\r\n"
+    "Sec-Fetch-Dest: document\r\n"
+    "Sec-Fetch-Mode: navigate\r\n"
+    "Sec-Fetch-Site: same-origin\r\n"
+    "Cache-Control: max-age=0\r\n"
+    "\r\n"
+)
+
+class StubServer:
+    # Just enough of ThreadedHTTPServer for a handler to run against.
+    alive = True
+    # Keep the connection with the handler between requests.
+    parking = False
+
+    def __init__(self):
+        self.attempts = {}
+        self.data = None
+
+    def waiting(self):
+        # For older copies of the module.
+        return False
+
+def get_handler(mod):
+
+    class BenchHandler(mod.CoreHttpServer):
+
+        def do_GET(self):
+            return self.serve_content(CONTENT)
+
+        def log_message(self, fmt, *values):
+            # Not what is being measured.
+            pass
+
+    return BenchHandler
+
+def run_round(handler, count):
+    # Returns requests per second over one connection.
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    conn, address = listener.accept()
+    listener.close()
+
+    # The last request closes the connection, ending the handler.
+    payload = (REQUEST % "keep-alive").encode() * (count - 1) + (REQUEST % "close").encode()
+    received = []
+
+    def send():
+        client.sendall(payload)
+
+    def receive():
+        while True:
+            data = client.recv(256*1024)
+            if not data:
+                break
+            received.append(data)
+
+    threads = [threading.Thread(target = send), threading.Thread(target = receive)]
+    for t in threads:
+        t.start()
+
+    start = time.time()
+    h = handler(conn, address, StubServer())
+    h.run()
+    conn.close()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    client.close()
+
+    answered = b"".join(received).count(b"HTTP/1.1 200 ")
+    if answered != count:
+        raise Exception("Expected %d responses, got %d" % (count, answered))
+    return count / elapsed
+
+def main():
+    path = os.path.realpath(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REQUESTS
+
+    mod = common.load('CoreHttpServer', path)
+    handler = get_handler(mod)
+
+    # Warm up before measuring.
+    run_round(handler, min(count, 1000))
+    rates = sorted([run_round(handler, count) for i in range(ROUNDS)])
+
+    print("%s: %d requests x %d rounds, best %.0f req/s, median %.0f req/s" % (path, count, ROUNDS, rates[-1], rates[len(rates) // 2]))
+
+if __name__ == '__main__':
+    main()
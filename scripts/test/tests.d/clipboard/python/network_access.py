@@ -110,6 +110,51 @@ class NetworkAccessTests(common.TestCase):
         self.assertFalse(self.access.is_allowed('192.168.0.255')) # Test an address below the whitelisted range
         self.assertFalse(self.access.is_allowed('192.168.2.0')) # Test an address above the whitelisted range
 
+    '''
+    Confirm that overlapping and nested blacklisted networks are all honoured.
+    '''
+    def test_block_blacklist_network_overlap(self):
+        self.access.add_blacklist('10.0.0.0/24')
+        self.access.add_blacklist('10.0.0.128/25')
+        self.access.add_blacklist('10.0.1.0/24')
+        self.access.add_blacklist('10.0.3.7')
+        self.assertFalse(self.access.is_allowed('10.0.0.0'))
+        self.assertFalse(self.access.is_allowed('10.0.1.255'))
+        self.assertTrue(self.access.is_allowed('10.0.2.0'))
+        self.assertFalse(self.access.is_allowed('10.0.3.7'))
+        self.assertTrue(self.access.is_allowed('10.0.3.8'))
+
+    '''
+    Confirm that IPv6 addresses and networks are handled.
+    '''
+    def test_block_blacklist_ipv6(self):
+        self.access.add_blacklist('2001:db8::/32')
+        self.access.add_blacklist('fe80::1')
+        self.assertFalse(self.access.is_allowed('2001:db8::1'))
+        self.assertFalse(self.access.is_allowed('2001:db8:ffff::1'))
+        self.assertTrue(self.access.is_allowed('2001:db9::1'))
+        self.assertFalse(self.access.is_allowed('fe80::1'))
+        self.assertFalse(self.access.is_allowed('fe80::1%eth0')) # Zone index is ignored
+        self.assertTrue(self.access.is_allowed('fe80::2'))
+        self.assertTrue(self.access.is_allowed('10.0.0.1'))
+
+    '''
+    Confirm that IPv4 rules apply to IPv4-mapped IPv6 addresses, as reported by dual-stack sockets.
+    '''
+    def test_block_blacklist_ipv4_mapped(self):
+        self.access.add_blacklist('10.0.0.0/8')
+        self.assertFalse(self.access.is_allowed('::ffff:10.1.2.3'))
+        self.assertTrue(self.access.is_allowed('::ffff:11.1.2.3'))
+
+    '''
+    Confirm that invalid rules are reported as errors.
+    '''
+    def test_errors(self):
+        self.assertFalse(self.access.add_blacklist('10.0.0.0/33'))
+        self.assertFalse(self.access.add_blacklist('2001:db8::/129'))
+        self.assertFalse(self.access.add_whitelist('10.0.0.0/abc'))
+        self.assertEqual(3, len(self.access.errors))
+
     '''
     Test behavior of loading a file containing blacklisted addresses.
     '''
@@ -126,6 +171,65 @@ class NetworkAccessTests(common.TestCase):
             self.assertFalse(self.access.is_allowed('192.168.1.1')) # Test an unwanted address in the blacklisted CIDR range.
             self.assertTrue(self.access.is_allowed('192.168.0.2')) # Test a not-unwanted field
 
+    '''
+    Confirm that comments and blank lines in an access file are skipped.
+    '''
+    def test_file_comments(self):
+        with tempfile.TemporaryDirectory() as src:
+            path = os.path.join(src, 'access-file')
+            with open(path, 'w') as f:
+                f.write('# Blocked hosts\n')
+                f.write('\n')
+                f.write('192.168.0.1 # Noisy neighbour\n')
+
+            self.access.load_blacklist_file(path)
+
+            self.assertEqual([], self.access.errors)
+            self.assertEqual(1, len(self.access.denied))
+            self.assertFalse(self.access.is_allowed('192.168.0.1'))
+            self.assertTrue(self.access.is_allowed('0.0.0.0'))
+
+    '''
+    Confirm that reloading picks up changes to an access file.
+    '''
+    def test_file_reload(self):
+        with tempfile.TemporaryDirectory() as src:
+            path = os.path.join(src, 'access-file')
+            with open(path, 'w') as f:
+                f.write('192.168.0.1\n')
+
+            self.access.add_blacklist('10.0.0.1')
+            self.access.load_blacklist_file(path)
+            self.assertFalse(self.access.is_allowed('192.168.0.1'))
+            self.assertTrue(self.access.is_allowed('192.168.0.2'))
+
+            with open(path, 'w') as f:
+                f.write('192.168.0.2\n')
+
+            self.assertEqual([], self.access.reload())
+            self.assertTrue(self.access.is_allowed('192.168.0.1'))
+            self.assertFalse(self.access.is_allowed('192.168.0.2'))
+            self.assertFalse(self.access.is_allowed('10.0.0.1')) # Rules given directly are kept
+
+    '''
+    Confirm that a reload that runs into errors keeps the previous rules.
+    '''
+    def test_file_reload_error(self):
+        with tempfile.TemporaryDirectory() as src:
+            path = os.path.join(src, 'access-file')
+            with open(path, 'w') as f:
+                f.write('192.168.0.1\n')
+
+            self.access.load_blacklist_file(path)
+
+            with open(path, 'w') as f:
+                f.write('192.168.0.2\n')
+                f.write('192.168.0.0/99\n')
+
+            self.assertEqual(1, len(self.access.reload()))
+            self.assertFalse(self.access.is_allowed('192.168.0.1'))
+            self.assertTrue(self.access.is_allowed('192.168.0.2'))
+
     '''
     Test behavior of loading a file containing whitelisted addresses.
     '''
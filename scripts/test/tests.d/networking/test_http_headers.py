@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import common, unittest # General test requirements
+
+import io
+
+mod = common.load('CoreHttpServer', common.TOOLS_DIR + '/scripts/networking/http-servers/CoreHttpServer.py')
+
+class MockHandler(mod.CoreHttpServer):
+    # Only as much of a handler as read_headers() needs, with errors recorded instead of sent.
+
+    def __init__(self, data):
+        self.rfile = io.BytesIO(data)
+        self.errors = []
+
+    def send_error(self, code, message = None):
+        self.errors.append(code)
+
+class BaseHeaderTest(common.TestCase):
+
+    def read(self, *lines):
+        handler = MockHandler(("".join(["%s\r\n" % l for l in lines]) + "\r\n").encode('iso-8859-1'))
+        self.result = handler.read_headers()
+        self.errors = handler.errors
+        return handler.headers
+
+class ReadHeadersTests(BaseHeaderTest):
+
+    def test_basic(self):
+        headers = self.read("Host: localhost", "Accept:text/html  ")
+        self.assertTrue(self.result)
+        self.assertEqual("localhost", headers["host"])
+        self.assertEqual("text/html", headers["ACCEPT"])
+        self.assertEqual(["Host", "Accept"], headers.keys())
+
+    def test_empty(self):
+        headers = self.read()
+        self.assertTrue(self.result)
+        self.assertEmpty(headers)
+
+    def test_folding(self):
+        headers = self.read("X-Long: first", " second", "\tthird", "Host: localhost")
+        self.assertTrue(self.result)
+        self.assertEqual("first second third", headers["X-Long"])
+        self.assertEqual("localhost", headers["Host"])
+
+    def test_folding_first_line(self):
+        # Nothing to continue, so the line is ignored.
+        headers = self.read(" stray", "Host: localhost")
+        self.assertTrue(self.result)
+        self.assertEqual(["Host"], headers.keys())
+
+    def test_repeated(self):
+        headers = self.read("Accept: text/html", "X-Other: a", "accept: text/plain")
+        self.assertEqual("text/html, text/plain", headers["Accept"])
+        self.assertEqual(2, len(headers))
+
+    def test_repeated_cookie(self):
+        headers = self.read("Cookie: a=1", "Cookie: b=2", "cookie: c=3")
+        self.assertEqual("a=1; b=2; c=3", headers["Cookie"])
+
+    def test_no_colon(self):
+        headers = self.read("Host: localhost", "not a header", "Accept: */*")
+        self.assertTrue(self.result)
+        self.assertEqual(["Host", "Accept"], headers.keys())
+
+    def test_no_colon_folding(self):
+        # A folded line after a line without a colon does not continue an earlier header.
+        headers = self.read("Host: localhost", "not a header", " more")
+        self.assertTrue(self.result)
+        self.assertEqual("localhost", headers["Host"])
+
+    def test_no_end(self):
+        # The connection closing ends the headers.
+        handler = MockHandler(b"Host: localhost\r\n")
+        self.assertTrue(handler.read_headers())
+        self.assertEqual("localhost", handler.headers["Host"])
+
+    def test_bare_newlines(self):
+        handler = MockHandler(b"Host: localhost\nAccept: */*\n\nbody")
+        self.assertTrue(handler.read_headers())
+        self.assertEqual(["Host", "Accept"], handler.headers.keys())
+        self.assertEqual(b"body", handler.rfile.read())
+
+    def test_limit_count(self):
+        self.read(*["X-Header-%d: %d" % (i, i) for i in range(mod.CoreHttpServer.max_headers)])
+        self.assertTrue(self.result)
+        self.assertEmpty(self.errors)
+
+    def test_limit_count_exceeded(self):
+        self.read(*["X-Header-%d: %d" % (i, i) for i in range(mod.CoreHttpServer.max_headers + 1)])
+        self.assertFalse(self.result)
+        self.assertEqual([431], self.errors)
+
+    def test_limit_line(self):
+        headers = self.read("X-Long: %s" % ("a" * (65536 - 10)))
+        self.assertTrue(self.result)
+        self.assertEqual(65536 - 10, len(headers["X-Long"]))
+
+    def test_limit_line_exceeded(self):
+        self.read("X-Long: %s" % ("a" * 65536))
+        self.assertFalse(self.result)
+        self.assertEqual([431], self.errors)
+
+class CaselessDictTests(common.TestCase):
+
+    def test_lookup(self):
+        d = mod.CaselessDict()
+        d["Content-Type"] = "text/html"
+        self.assertTrue("content-type" in d)
+        self.assertTrue("CONTENT-TYPE" in d)
+        self.assertEqual("text/html", d["content-TYPE"])
+        self.assertEqual("", d["Missing"])
+        self.assertEqual("default", d.get("Missing", "default"))
+
+    def test_copy(self):
+        d = mod.CaselessDict({"X-One": "1", "x-two": "2"})
+        self.assertEqual(["X-One", "x-two"], d.keys())
+        self.assertEqual("2", d["X-Two"])
+
+    def test_delete(self):
+        d = mod.CaselessDict()
+        d["X-One"] = "1"
+        d["X-Two"] = "2"
+        del d["x-ONE"]
+        self.assertFalse("X-One" in d)
+        self.assertEqual(["X-Two"], d.keys())
+        self.assertEqual([("X-Two", "2")], d.items())
+        self.assertEqual(["X-Two"], list(d))
+
+    def test_iteration(self):
+        d = mod.CaselessDict()
+        d["Host"] = "localhost"
+        d["X-Forwarded-For"] = "127.0.0.1"
+        self.assertEqual(["Host", "X-Forwarded-For"], list(d))
+        self.assertEqual([("Host", "localhost"), ("X-Forwarded-For", "127.0.0.1")], d.items())
+
+    def test_last_name_kept(self):
+        # The name a key was last stored under is the one that is listed.
+        d = mod.CaselessDict()
+        d["x-header"] = "1"
+        d["X-Header"] = "2"
+        self.assertEqual(1, len(d))
+        self.assertEqual([("X-Header", "2")], d.items())
+
+    def test_strip(self):
+        d = mod.CaselessDict()
+        d["Host"] = "  localhost \t"
+        self.assertEqual("localhost", d["host"])
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import common, unittest # General test requirements
+
+import socket, threading, time, traceback
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+mod = common.load('CoreHttpServer', common.TOOLS_DIR + '/scripts/networking/http-servers/CoreHttpServer.py')
+
+CONTENT = "<html><body><p>Hello</p></body></html>"
+
+class MockHandler(mod.CoreHttpServer):
+
+    def do_GET(self):
+        return self.serve_content(CONTENT)
+
+    def log_message(self, fmt, *values):
+        pass
+
+class MockServer(mod.ThreadedHTTPServer):
+    # Errors are recorded rather than printed.
+
+    # Connections only expire when a new client needs room, not on a timer.
+    sweep_interval = 60
+
+    def __init__(self, *args, **kwargs):
+        self.errors = []
+        mod.ThreadedHTTPServer.__init__(self, *args, **kwargs)
+
+    def handle_error(self, request, client_address):
+        self.errors.append(traceback.format_exc())
+
+class ThreadedHTTPServerTests(common.TestCase):
+
+    max_connections = 32
+    workers = 4
+
+    def setUp(self):
+        self.server = MockServer(('127.0.0.1', 0), MockHandler, self.workers, self.max_connections, 5)
+        self.thread = threading.Thread(target = self.server.serve_forever, kwargs = {'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.kill_requests()
+        self.server.server_close()
+
+    def connect(self):
+        return HTTPConnection('127.0.0.1', self.server.server_address[1], timeout = 10)
+
+    def wait_idle(self):
+        # Wait for every connection to be closed and its slot given back, returning the free slots.
+        deadline = time.time() + 5
+        while True:
+            acquired = 0
+            while self.server.slots.acquire(False):
+                acquired += 1
+            for i in range(acquired):
+                self.server.slots.release()
+            if acquired == self.max_connections or time.time() >= deadline:
+                return acquired
+            time.sleep(0.05)
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        for i in range(5):
+            conn.request('GET', '/')
+            resp = conn.getresponse()
+            self.assertEqual(200, resp.status)
+            self.assertEqual(CONTENT.encode(), resp.read())
+            # Long enough for the connection to be handed back to wait on its next request.
+            time.sleep(0.05)
+        conn.close()
+        self.assertEqual(self.max_connections, self.wait_idle())
+        self.assertEmpty(self.server.errors)
+
+    def test_keep_alive_concurrent(self):
+        # Many clients that keep their connections alive, each connection moving between workers.
+        failures = []
+
+        def client():
+            conn = self.connect()
+            try:
+                for i in range(200):
+                    conn.request('GET', '/')
+                    resp = conn.getresponse()
+                    if resp.status != 200 or resp.read() != CONTENT.encode():
+                        failures.append(resp.status)
+            except Exception as e:
+                failures.append(e)
+            conn.close()
+
+        threads = [threading.Thread(target = client) for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEmpty(failures)
+        self.assertEqual(self.max_connections, self.wait_idle())
+        self.assertEmpty(self.server.errors)
+        self.assertTrue(all(t.is_alive() for t in self.server.workers))
+
+    def test_limit_expired(self):
+        # A new client at the limit is taken in once stalled connections have expired.
+        self.server.request_timeout = 0.5
+        stalled = []
+        for i in range(self.max_connections):
+            s = socket.create_connection(self.server.server_address)
+            s.sendall(b'GET / HTTP/1.1\r\n')
+            stalled.append(s)
+            # Not faster than the server's listen backlog can take.
+            time.sleep(0.005)
+        time.sleep(0.6)
+        self.assertEqual(self.max_connections, len(self.server.parked))
+
+        conn = self.connect()
+        conn.request('GET', '/')
+        self.assertEqual(200, conn.getresponse().status)
+        conn.close()
+        self.assertEqual(0, self.server.shed)
+        for s in stalled:
+            # Told that their requests timed out.
+            self.assertContains(b' 408 ', s.recv(1024))
+            s.close()
+
+    def test_limit_shed(self):
+        # A new client at the limit is turned away if no connection can make room for it.
+        stalled = []
+        for i in range(self.max_connections):
+            s = socket.create_connection(self.server.server_address)
+            s.sendall(b'GET / HTTP/1.1\r\n')
+            stalled.append(s)
+            time.sleep(0.005)
+        time.sleep(0.1)
+
+        conn = self.connect()
+        conn.request('GET', '/')
+        self.assertEqual(503, conn.getresponse().status)
+        conn.close()
+        self.assertEqual(1, self.server.shed)
+        for s in stalled:
+            s.close()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+import common, unittest # General test requirements
+
+import io, os, shutil, socket, sys, tempfile, threading
+
+HTTP_SERVERS_DIR = common.TOOLS_DIR + '/scripts/networking/http-servers'
+# verbose_share imports CoreHttpServer by name.
+sys.path.append(HTTP_SERVERS_DIR)
+mod = common.load('verbose_share', HTTP_SERVERS_DIR + '/verbose_share.py')
+
+BOUNDARY = 'xYzZY'
+
+def make_multipart(*parts):
+    # Build a multipart/form-data body out of (name, filename, data) parts.
+    body = b''
+    for name, filename, data in parts:
+        disposition = 'form-data; name="%s"' % name
+        if filename is not None:
+            disposition += '; filename="%s"' % filename
+        body += ('--%s\r\nContent-Disposition: %s\r\n\r\n' % (BOUNDARY, disposition)).encode() + data + b'\r\n'
+    return body + ('--%s--\r\n' % BOUNDARY).encode()
+
+class MockServer:
+    # Just enough of ThreadedHTTPServer for a handler to run against.
+    alive = True
+    parking = False
+
+    def __init__(self):
+        self.attempts = {}
+        self.data = None
+
+class MockSource:
+    # Hands out data a few bytes at a time, as a client on a slow connection would send it.
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.reads = 0
+
+    def read(self, size = None):
+        self.reads += 1
+        data = self.data[:min(size or self.size, self.size)]
+        self.data = self.data[len(data):]
+        return data
+
+class TimeoutSource:
+
+    def read(self, size = None):
+        raise socket.timeout()
+
+class MockHandler(mod.SimpleHTTPVerboseReqeustHandler):
+
+    def log_message(self, fmt, *values):
+        pass
+
+class MockRangeHandler(mod.SimpleHTTPVerboseReqeustHandler):
+    # Only as much of a handler as range parsing needs, with errors recorded instead of sent.
+
+    def __init__(self, header_range):
+        self.headers = mod.common.CaselessDict({'Range': header_range})
+        self.errors = []
+
+    def send_error(self, code, message = None):
+        self.errors.append(code)
+
+class Response:
+
+    def __init__(self, data):
+        head, sep, self.body = data.partition(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        self.status = int(lines[0].split(' ')[1])
+        # By lower-case name.
+        self.headers = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(':')
+            self.headers[key.strip().lower()] = value.strip()
+
+class BaseVerboseShareTest(common.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        mod.args[mod.TITLE_UPLOAD] = True
+
+    def tearDown(self):
+        mod.args[mod.TITLE_UPLOAD] = None
+        mod.args[mod.common.TITLE_TIMEOUT] = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def read_file(self, name):
+        with open(os.path.join(self.dir, name), 'rb') as f:
+            return f.read()
+
+    def request(self, method, path, headers = None, body = b'', end = True):
+        """Run one request through a handler over a loopback connection, returning the response.
+        If end is False, the client leaves the connection open after sending the request.
+        """
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        conn, address = listener.accept()
+        listener.close()
+
+        def serve():
+            MockHandler(conn, address, MockServer()).run()
+            conn.close()
+
+        t = threading.Thread(target = serve)
+        t.start()
+
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: localhost', 'Connection: close']
+        for key, value in (headers or {}).items():
+            lines.append('%s: %s' % (key, value))
+        client.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        if end:
+            client.shutdown(socket.SHUT_WR)
+
+        data = b''
+        client.settimeout(10)
+        while True:
+            piece = client.recv(65536)
+            if not piece:
+                break
+            data += piece
+        client.close()
+        t.join()
+        return Response(data)
+
+class MultipartReaderTests(common.TestCase):
+
+    def read_parts(self, body, size = 65536):
+        reader = mod.MultipartReader(MockSource(body, size), BOUNDARY.encode())
+        parts = []
+        while True:
+            headers = reader.next_part()
+            if headers is None:
+                return parts
+            parts.append((headers['Content-Disposition'], b''.join(reader.read_part())))
+
+    def test_single(self):
+        parts = self.read_parts(make_multipart(('file', 'a.txt', b'hello')))
+        self.assertEqual([('form-data; name="file"; filename="a.txt"', b'hello')], parts)
+
+    def test_several(self):
+        parts = self.read_parts(make_multipart(('a', 'a.txt', b'first'), ('field', None, b'value'), ('b', 'b.txt', b'second\r\n')))
+        self.assertEqual([b'first', b'value', b'second\r\n'], [p[1] for p in parts])
+
+    def test_delimiter_split(self):
+        # The same parts come out however the body is split up between reads.
+        data = b'line\r\n--xYzZ almost a delimiter\r\n-'
+        body = make_multipart(('a', 'a.txt', data), ('b', 'b.txt', b''), ('c', 'c.txt', data * 3))
+        for size in range(1, len(BOUNDARY) + 8):
+            parts = self.read_parts(body, size)
+            self.assertEqual([data, b'', data * 3], [p[1] for p in parts])
+
+    def test_preamble_and_epilogue(self):
+        body = b'preamble\r\n' + make_multipart(('a', 'a.txt', b'data')) + b'epilogue'
+        self.assertEqual([b'data'], [p[1] for p in self.read_parts(body, 7)])
+
+    def test_skip_part(self):
+        # Moving on to the next part without reading the current one.
+        reader = mod.MultipartReader(MockSource(make_multipart(('a', 'a.txt', b'x' * 1000), ('b', 'b.txt', b'kept')), 100), BOUNDARY.encode())
+        reader.next_part()
+        reader.next_part()
+        self.assertEqual(b'kept', b''.join(reader.read_part()))
+        self.assertNone(reader.next_part())
+
+    def test_error_header_too_long(self):
+        body = ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\ndata\r\n--%s--\r\n' % (BOUNDARY, 'a' * mod.MultipartReader.header_limit, BOUNDARY)).encode()
+        with self.assertRaises(mod.UploadError) as ctx:
+            self.read_parts(body, 4096)
+        self.assertEqual(400, ctx.exception.code)
+
+    def test_error_truncated(self):
+        body = make_multipart(('a', 'a.txt', b'data'))
+        for cut in (5, len(body) // 2, len(body) - 4):
+            with self.assertRaises(mod.UploadError) as ctx:
+                self.read_parts(body[:cut], 3)
+            self.assertEqual(400, ctx.exception.code)
+
+class BodyReaderTests(common.TestCase):
+
+    def test_exact(self):
+        reader = mod.BodyReader(MockSource(b'abcdefghij' + b'next request', 4), 10)
+        self.assertEqual(b'abcdefghij', b''.join(reader.pieces()))
+        self.assertEqual(b'', reader.read())
+
+    def test_error_short(self):
+        reader = mod.BodyReader(MockSource(b'abc', 4), 10)
+        with self.assertRaises(mod.UploadError) as ctx:
+            list(reader.pieces())
+        self.assertEqual(400, ctx.exception.code)
+
+    def test_error_timeout(self):
+        with self.assertRaises(mod.UploadError) as ctx:
+            mod.BodyReader(TimeoutSource(), 10).read()
+        self.assertEqual(408, ctx.exception.code)
+
+class UploadTests(BaseVerboseShareTest):
+
+    def put_piece(self, name, start, end, total, data):
+        return self.request('PUT', '/' + name, {'Content-Length': len(data), 'Content-Range': 'bytes %d-%d/%d' % (start, end, total)}, data)
+
+    def test_post_several_files(self):
+        body = make_multipart(('a', 'a.txt', b'first'), ('field', None, b'value'), ('b', 'b.txt', b'second'))
+        resp = self.request('POST', '/', {'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY, 'Content-Length': len(body)}, body)
+        self.assertEqual(200, resp.status)
+        self.assertEqual(b'first', self.read_file('a.txt'))
+        self.assertEqual(b'second', self.read_file('b.txt'))
+        self.assertFalse(os.path.exists('field'))
+
+    def test_post_truncated(self):
+        body = make_multipart(('a', 'a.txt', b'x' * 10000))
+        resp = self.request('POST', '/', {'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY, 'Content-Length': len(body)}, body[:5000])
+        self.assertEqual(400, resp.status)
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_put(self):
+        resp = self.request('PUT', '/a.txt', {'Content-Length': 5}, b'hello')
+        self.assertEqual(200, resp.status)
+        self.assertEqual(b'hello', self.read_file('a.txt'))
+
+    def test_put_truncated(self):
+        resp = self.request('PUT', '/a.txt', {'Content-Length': 100}, b'x' * 10)
+        self.assertEqual(400, resp.status)
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_put_timeout(self):
+        mod.args[mod.common.TITLE_TIMEOUT] = 0.2
+        resp = self.request('PUT', '/a.txt', {'Content-Length': 100}, b'x' * 10, end = False)
+        self.assertEqual(408, resp.status)
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_put_no_length(self):
+        resp = self.request('PUT', '/a.txt', {'Transfer-Encoding': 'chunked'}, b'5\r\nhello\r\n0\r\n\r\n')
+        self.assertEqual(411, resp.status)
+
+    def test_put_pieces(self):
+        data = b'0123456789abcdefghijklmnopqrst'
+        resp = self.put_piece('a.txt', 0, 9, 30, data[:10])
+        self.assertEqual(202, resp.status)
+        self.assertEqual('bytes=0-9', resp.headers['range'])
+
+        # Out of order, to be resumed from what has been received.
+        resp = self.put_piece('a.txt', 20, 29, 30, data[20:])
+        self.assertEqual(409, resp.status)
+        self.assertEqual('bytes=0-9', resp.headers['range'])
+
+        # Overlapping what has been received.
+        resp = self.put_piece('a.txt', 5, 14, 30, data[5:15])
+        self.assertEqual(409, resp.status)
+        self.assertEqual('bytes=0-9', resp.headers['range'])
+
+        resp = self.put_piece('a.txt', 10, 19, 30, data[10:20])
+        self.assertEqual(202, resp.status)
+        self.assertEqual('bytes=0-19', resp.headers['range'])
+        self.assertFalse(os.path.exists('a.txt'))
+
+        # Asking how far along the upload is.
+        resp = self.request('PUT', '/a.txt', {'Content-Length': 0, 'Content-Range': 'bytes */30'})
+        self.assertEqual(202, resp.status)
+        self.assertEqual('bytes=0-19', resp.headers['range'])
+
+        resp = self.put_piece('a.txt', 20, 29, 30, data[20:])
+        self.assertEqual(200, resp.status)
+        self.assertEqual(data, self.read_file('a.txt'))
+        self.assertEqual(['a.txt'], os.listdir(self.dir))
+
+    def test_put_pieces_none_received(self):
+        resp = self.request('PUT', '/a.txt', {'Content-Length': 0, 'Content-Range': 'bytes */30'})
+        self.assertEqual(202, resp.status)
+        self.assertFalse('range' in resp.headers)
+
+        resp = self.put_piece('a.txt', 10, 19, 30, b'x' * 10)
+        self.assertEqual(409, resp.status)
+        self.assertFalse('range' in resp.headers)
+
+    def test_put_pieces_mismatch(self):
+        # The range does not match the length of the body.
+        resp = self.request('PUT', '/a.txt', {'Content-Length': 5, 'Content-Range': 'bytes 0-9/30'}, b'x' * 5)
+        self.assertEqual(400, resp.status)
+        # Past the end of the file.
+        resp = self.put_piece('a.txt', 25, 34, 30, b'x' * 10)
+        self.assertEqual(400, resp.status)
+
+class RangeTests(common.TestCase):
+
+    def parse(self, header_range, length = None):
+        handler = MockRangeHandler(header_range)
+        self.result = handler.parse_header_range()
+        self.errors = handler.errors
+        if length is None:
+            return handler.ranges
+        return handler.resolve_ranges(length)
+
+    def test_single(self):
+        self.assertEqual([(0, 9)], self.parse('bytes=0-9', 100))
+        self.assertEqual([(90, 99)], self.parse('bytes=90-', 100))
+        self.assertEqual([(90, 99)], self.parse('bytes=90-200', 100))
+        self.assertEqual([(50, 50)], self.parse('bytes=50-50', 100))
+
+    def test_suffix(self):
+        self.assertEqual([(90, 99)], self.parse('bytes=-10', 100))
+
+    def test_suffix_longer_than_content(self):
+        self.assertEqual([(0, 99)], self.parse('bytes=-500', 100))
+
+    def test_suffix_zero(self):
+        # Accepted, but never satisfiable.
+        self.assertEqual([(None, 0)], self.parse('bytes=-0'))
+        self.assertTrue(self.result)
+        self.assertEqual([], self.parse('bytes=-0', 100))
+        self.assertEqual([(0, 9)], self.parse('bytes=-0,0-9', 100))
+
+    def test_merge_overlapping(self):
+        self.assertEqual([(0, 14)], self.parse('bytes=0-9,5-14', 100))
+        self.assertEqual([(0, 19)], self.parse('bytes=5-9,0-19', 100))
+        self.assertEqual([(80, 99)], self.parse('bytes=-20,90-', 100))
+
+    def test_merge_adjacent(self):
+        self.assertEqual([(0, 19)], self.parse('bytes=10-19,0-9', 100))
+        self.assertEqual([(0, 9), (11, 19)], self.parse('bytes=0-9,11-19', 100))
+
+    def test_unsatisfiable_dropped(self):
+        self.assertEqual([(0, 9)], self.parse('bytes=0-9,100-109', 100))
+        self.assertEqual([], self.parse('bytes=100-,200-300', 100))
+        self.assertEqual([], self.parse('bytes=-10', 0))
+
+    def test_units(self):
+        # Other units are ignored rather than refused.
+        self.assertEqual([], self.parse('items=0-9'))
+        self.assertTrue(self.result)
+        self.assertEmpty(self.errors)
+        self.assertEqual([(0, 9)], self.parse(' Bytes =0-9'))
+
+    def test_empty_elements(self):
+        self.assertEqual([(0, 9), (20, 29)], self.parse('bytes=, 0-9 ,,20-29,'))
+
+    def test_max_ranges(self):
+        specs = ','.join(['%d-%d' % (i * 2, i * 2) for i in range(mod.SimpleHTTPVerboseReqeustHandler.max_ranges)])
+        self.assertEqual(mod.SimpleHTTPVerboseReqeustHandler.max_ranges, len(self.parse('bytes=' + specs)))
+        # Past the limit, the whole content is served instead.
+        self.assertEqual([], self.parse('bytes=%s,1000-1000' % specs))
+        self.assertTrue(self.result)
+        self.assertEmpty(self.errors)
+
+    def test_error_bad(self):
+        for header_range in ('bytes=', 'bytes=-', 'bytes=a-b', 'bytes=10-5', 'bytes=0-9;x', 'bytes=,,'):
+            self.parse(header_range)
+            self.assertFalse(self.result)
+            self.assertEqual([400], self.errors)
+
+class RangeRequestTests(BaseVerboseShareTest):
+
+    content = bytes(bytearray(range(100)))
+
+    def setUp(self):
+        super(RangeRequestTests, self).setUp()
+        with open('a.bin', 'wb') as f:
+            f.write(self.content)
+
+    def get(self, header_range, headers = None):
+        headers = dict(headers or {})
+        headers['Range'] = header_range
+        return self.request('GET', '/a.bin', headers)
+
+    def test_single(self):
+        resp = self.get('bytes=10-19')
+        self.assertEqual(206, resp.status)
+        self.assertEqual('bytes 10-19/100', resp.headers['content-range'])
+        self.assertEqual(self.content[10:20], resp.body)
+
+    def test_suffix_longer_than_content(self):
+        resp = self.get('bytes=-500')
+        self.assertEqual(206, resp.status)
+        self.assertEqual('bytes 0-99/100', resp.headers['content-range'])
+        self.assertEqual(self.content, resp.body)
+
+    def test_merged(self):
+        # Merged into a single range, so not sent as multipart.
+        resp = self.get('bytes=0-9,10-19,5-14')
+        self.assertEqual(206, resp.status)
+        self.assertEqual('bytes 0-19/100', resp.headers['content-range'])
+        self.assertEqual(self.content[:20], resp.body)
+
+    def test_multiple(self):
+        resp = self.get('bytes=0-9,-10')
+        self.assertEqual(206, resp.status)
+        self.assertTrue(resp.headers['content-type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(resp.headers['content-length']), len(resp.body))
+        self.assertContains(b'Content-Range: bytes 0-9/100\r\n\r\n' + self.content[:10], resp.body)
+        self.assertContains(b'Content-Range: bytes 90-99/100\r\n\r\n' + self.content[90:], resp.body)
+
+    def test_unsatisfiable(self):
+        for header_range in ('bytes=100-', 'bytes=-0', 'bytes=200-300,100-150'):
+            resp = self.get(header_range)
+            self.assertEqual(416, resp.status)
+            self.assertEqual('bytes */100', resp.headers['content-range'])
+            self.assertEqual(b'', resp.body)
+
+    def test_max_ranges(self):
+        specs = ','.join(['%d-%d' % (i, i) for i in range(0, 100, 2)] + ['%d-%d' % (i, i) for i in range(1, 100, 2)])
+        resp = self.get('bytes=' + specs)
+        self.assertEqual(200, resp.status)
+        self.assertEqual(self.content, resp.body)
+
+    def test_bad(self):
+        self.assertEqual(400, self.get('bytes=10-5').status)
+
+    def test_if_range(self):
+        etag = self.request('GET', '/a.bin').headers['etag']
+        resp = self.get('bytes=10-19', {'If-Range': etag})
+        self.assertEqual(206, resp.status)
+        self.assertEqual(self.content[10:20], resp.body)
+
+    def test_if_range_mismatch(self):
+        # The client's copy is out of date, so it gets the whole content.
+        for if_range in ('"stale"', 'Wed, 01 Jan 2020 00:00:00 GMT'):
+            resp = self.get('bytes=10-19', {'If-Range': if_range})
+            self.assertEqual(200, resp.status)
+            self.assertFalse('content-range' in resp.headers)
+            self.assertEqual(self.content, resp.body)